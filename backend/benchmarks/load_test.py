@@ -0,0 +1,393 @@
+"""
+负载测试 / 基准测试
+按目标并发依次驱动 /api/analyze → /api/infer → /api/execute，
+输出每个阶段的 p50/p95/p99 延迟、吞吐量和峰值内存。
+
+默认在进程内运行（httpx.ASGITransport 直接调用 main.app），并使用 synthetic 模型与 SERP 后端，
+不消耗 API 配额；也可以用 --url 对已启动的服务进行测试。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.load_test --requests 200 --concurrency 16
+    python -m benchmarks.load_test --mode pipelined --images 20 --json results.json
+    MODEL_BACKEND=replay python -m benchmarks.load_test --requests 50
+    python -m benchmarks.load_test --url http://localhost:8000 --pid 12345
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import tracemalloc
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image, ImageDraw
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ("analyze", "infer", "execute")
+
+
+# ----------------------
+# 测试图片
+# ----------------------
+
+def make_image(seed: int, size=(1024, 768), quality: int = 85) -> bytes:
+    """生成内容由 seed 决定的 JPEG（渐变背景 + 随机色块），不同 seed 的图片字节不同"""
+    rng = random.Random(seed)
+    width, height = size
+    base = Image.linear_gradient("L").resize(size)
+    image = Image.merge("RGB", (base, base.rotate(90).resize(size), base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randint(20, width // 3), y0 + rng.randint(20, height // 3)
+        draw.rectangle((x0, y0, x1, y1), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+# ----------------------
+# 统计
+# ----------------------
+
+def percentile(values: List[float], q: float) -> float:
+    """最近秩法百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.peak_rss: Optional[int] = None
+        self.peak_traced: Optional[int] = None
+
+    def record(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def error(self, reason: str):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def report(self) -> dict:
+        ms = [value * 1000 for value in self.latencies]
+        elapsed = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        return {
+            "stage": self.name,
+            "ok": len(ms),
+            "errors": sum(self.errors.values()),
+            "error_reasons": self.errors,
+            "p50_ms": round(percentile(ms, 50), 1),
+            "p95_ms": round(percentile(ms, 95), 1),
+            "p99_ms": round(percentile(ms, 99), 1),
+            "mean_ms": round(sum(ms) / len(ms), 1) if ms else 0.0,
+            "max_ms": round(max(ms), 1) if ms else 0.0,
+            "throughput_rps": round(len(ms) / elapsed, 2) if elapsed > 0 else 0.0,
+            "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1) if self.peak_rss else None,
+            "peak_traced_mb": round(self.peak_traced / 1024 / 1024, 1) if self.peak_traced else None,
+        }
+
+
+def read_rss(pid: str = "self") -> Optional[int]:
+    """读取进程常驻内存（字节，仅 Linux）"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler:
+    """后台线程定时采样 RSS，记录当前阶段的峰值"""
+
+    def __init__(self, pid: str = "self", interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = read_rss(self.pid)
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+            self._stop.wait(self.interval)
+
+    def reset(self) -> int:
+        """返回上一段的峰值并重新开始计量"""
+        peak, self.peak = self.peak, read_rss(self.pid) or 0
+        return peak
+
+    def start(self):
+        self.peak = read_rss(self.pid) or 0
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+# ----------------------
+# 请求
+# ----------------------
+
+class Flow:
+    """一个虚拟用户的完整流程：上传 → 点击 → 编辑"""
+
+    def __init__(self, index: int, image: bytes):
+        self.index = index
+        self.image = image
+        self.session_id: Optional[str] = None
+        self.target: Optional[dict] = None
+        self.intent: Optional[dict] = None
+
+
+async def timed(stats: StageStats, request) -> Optional[httpx.Response]:
+    started = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError as e:
+        stats.error(type(e).__name__)
+        return None
+    if response.status_code >= 400:
+        stats.error(f"HTTP {response.status_code}")
+        return None
+    stats.record(time.perf_counter() - started)
+    return response
+
+
+async def run_analyze(client: httpx.AsyncClient, flow: Flow, stats: StageStats):
+    response = await timed(stats, client.post(
+        "/api/analyze", files={"file": (f"bench-{flow.index}.jpg", flow.image, "image/jpeg")}
+    ))
+    if response is None:
+        return
+    data = response.json()
+    flow.session_id = data["session_id"]
+    flow.target = data["objects"][0] if data["objects"] else None
+    if flow.target is None:
+        stats.error("no objects")
+
+
+async def run_infer(client: httpx.AsyncClient, flow: Flow, stats: StageStats):
+    if flow.session_id is None or flow.target is None:
+        return
+    x, y = flow.target["center"]
+    response = await timed(stats, client.post(
+        "/api/infer", data={"session_id": flow.session_id, "click_x": str(x), "click_y": str(y)}
+    ))
+    if response is None:
+        return
+    intents = response.json()["intents"]
+    flow.intent = next((intent for intent in intents if intent.get("action_type") == "edit"), None)
+    if flow.intent is None:
+        stats.error("no edit intent")
+
+
+async def run_execute(client: httpx.AsyncClient, flow: Flow, stats: StageStats, job_wait: float):
+    if flow.intent is None:
+        return
+    started = time.perf_counter()
+    try:
+        response = await client.post("/api/execute", data={
+            "intent_id": str(flow.intent["id"]),
+            "action_type": "edit",
+            "session_id": flow.session_id,
+            "prompt": flow.intent.get("editor_prompt") or flow.intent["label"],
+            "box_json": json.dumps(flow.target["box_2d"]),
+            "wait": "true",
+        })
+        # 服务端等待超时后只返回 job_id，继续长轮询直到完成（延迟从提交时算起）
+        while response.status_code == 200 and response.json().get("status") == "queued":
+            job_id = response.json()["job_id"]
+            response = await client.get(f"/api/jobs/{job_id}/result", params={"wait": job_wait})
+            while response.status_code == 202:
+                response = await client.get(f"/api/jobs/{job_id}/result", params={"wait": job_wait})
+    except httpx.HTTPError as e:
+        stats.error(type(e).__name__)
+        return
+    if response.status_code >= 400:
+        stats.error(f"HTTP {response.status_code}")
+        return
+    stats.record(time.perf_counter() - started)
+
+
+async def run_pool(items, worker, concurrency: int):
+    """以固定并发执行 worker(item)"""
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def consume():
+        while not queue.empty():
+            await worker(queue.get_nowait())
+
+    await asyncio.gather(*(consume() for _ in range(concurrency)))
+
+
+async def benchmark(client: httpx.AsyncClient, args, sampler: Optional[MemorySampler]) -> dict:
+    images = [make_image(args.seed + i, args.size, args.quality) for i in range(args.images or args.requests)]
+    flows = [Flow(i, images[i % len(images)]) for i in range(args.requests)]
+    stats = {name: StageStats(name) for name in STAGES}
+    runners = {
+        "analyze": lambda flow: run_analyze(client, flow, stats["analyze"]),
+        "infer": lambda flow: run_infer(client, flow, stats["infer"]),
+        "execute": lambda flow: run_execute(client, flow, stats["execute"], args.job_wait),
+    }
+
+    def begin(names):
+        if sampler is not None:
+            sampler.reset()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        for name in names:
+            stats[name].started = time.perf_counter()
+
+    def end(names):
+        peak_rss = sampler.reset() if sampler is not None else None
+        peak_traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+        for name in names:
+            stats[name].finished = time.perf_counter()
+            stats[name].peak_rss = peak_rss
+            stats[name].peak_traced = peak_traced
+
+    total_started = time.perf_counter()
+    if args.mode == "phased":
+        # 每个阶段全部完成后再进入下一阶段，峰值内存可以按阶段区分
+        for name in STAGES:
+            begin([name])
+            await run_pool(flows, runners[name], args.concurrency)
+            end([name])
+    else:
+        # 每个虚拟用户连续执行三个阶段，更接近真实流量（峰值内存为整体峰值）
+        async def pipeline(flow):
+            for name in STAGES:
+                await runners[name](flow)
+
+        begin(STAGES)
+        await run_pool(flows, pipeline, args.concurrency)
+        end(STAGES)
+
+    server_stats = None
+    try:
+        response = await client.get("/api/cache/stats")
+        if response.status_code == 200:
+            server_stats = response.json()
+    except httpx.HTTPError:
+        pass
+
+    return {
+        "config": {
+            "target": args.url or "in-process",
+            "mode": args.mode,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "images": len(images),
+            "image_size": list(args.size),
+            "model_backend": os.getenv("MODEL_BACKEND"),
+            "serp_backend": os.getenv("SERP_BACKEND"),
+        },
+        "elapsed_s": round(time.perf_counter() - total_started, 2),
+        "stages": [stats[name].report() for name in STAGES],
+        "server": server_stats,
+    }
+
+
+def print_report(result: dict):
+    config = result["config"]
+    print(f"\n📊 {config['target']} | mode={config['mode']} requests={config['requests']} "
+          f"concurrency={config['concurrency']} images={config['images']} | {result['elapsed_s']}s")
+    header = f"{'stage':<9}{'ok':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'req/s':>9}{'rss MB':>9}{'heap MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for stage in result["stages"]:
+        print(f"{stage['stage']:<9}{stage['ok']:>6}{stage['errors']:>6}{stage['p50_ms']:>10}{stage['p95_ms']:>10}"
+              f"{stage['p99_ms']:>10}{stage['mean_ms']:>10}{stage['throughput_rps']:>9}"
+              f"{stage['peak_rss_mb'] if stage['peak_rss_mb'] is not None else '-':>9}"
+              f"{stage['peak_traced_mb'] if stage['peak_traced_mb'] is not None else '-':>9}")
+        if stage["error_reasons"]:
+            print(f"         errors: {stage['error_reasons']}")
+
+
+def parse_size(value: str):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+async def run(args) -> dict:
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.url:
+        sampler = MemorySampler(str(args.pid)) if args.pid else None
+        if sampler is not None:
+            sampler.start()
+        try:
+            async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+                return await benchmark(client, args, sampler)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+
+    # 进程内运行：导入前设置默认后端，不读取/写入持久化缓存，保证每次运行可比较
+    os.environ.setdefault("MODEL_BACKEND", "synthetic")
+    os.environ.setdefault("SERP_BACKEND", "synthetic")
+    os.environ.setdefault("ANALYSIS_CACHE_DIR", "")
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    if args.tracemalloc:
+        tracemalloc.start()
+    import main as app_module
+
+    sampler = MemorySampler()
+    sampler.start()
+    try:
+        async with app_module.app.router.lifespan_context(app_module.app):
+            transport = httpx.ASGITransport(app=app_module.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=timeout) as client:
+                return await benchmark(client, args, sampler)
+    finally:
+        sampler.stop()
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RippleUI analyze → infer → execute load test")
+    parser.add_argument("--url", help="被测服务地址；不指定时在进程内运行（默认使用 synthetic 后端）")
+    parser.add_argument("--pid", type=int, help="与 --url 一起使用：采样该进程的 RSS")
+    parser.add_argument("--requests", type=int, default=100, help="流程数（每个流程依次调用三个接口）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的流程数")
+    parser.add_argument("--images", type=int, default=0, help="不同图片的数量，0 表示每个流程一张新图片")
+    parser.add_argument("--size", type=parse_size, default=(1024, 768), help="图片尺寸，例如 1024x768")
+    parser.add_argument("--quality", type=int, default=85, help="测试图片的 JPEG 质量")
+    parser.add_argument("--seed", type=int, default=0, help="测试图片的随机种子")
+    parser.add_argument("--mode", choices=("phased", "pipelined"), default="phased",
+                        help="phased: 逐阶段执行；pipelined: 每个流程连续执行三个阶段")
+    parser.add_argument("--job-wait", type=float, default=30, help="编辑任务长轮询的单次等待时间（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时时间（秒）")
+    parser.add_argument("--tracemalloc", action="store_true", help="进程内运行时统计 Python 堆峰值（有额外开销）")
+    parser.add_argument("--json", dest="json_path", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Results written to {args.json_path}")
@@ -1,14 +1,53 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from services.ai_service import AIService
-from services.utils import image_to_base64
-from schemas import AnalysisResponse, InferenceResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from services.ai_service import AIService, MODEL_NAME
+from services.analysis_cache import (
+    AnalysisCache, bytes_key, hash_pixels,
+    ANALYSIS_CACHE_PIXEL_HASH, ANALYSIS_PROMPT_VERSION
+)
+from services.perceptual_hash import perceptual_hash
+from services.intent_cache import IntentCache, intent_cache_key
+from services.prefetch import IntentPrefetcher, PREFETCH_ENABLED
+from services.session_store import create_session_store, SESSION_BACKEND
+from services.spatial_index import SpatialIndex
+from services.cache import LRUCache
+from services.job_queue import JobQueue, QueueFullError, SUCCEEDED, FAILED
+from services.image_store import ImageStore
+from services.edit_history import EditHistory
+from services.upload import hash_upload, decode_image, UploadError, UploadSizeLimitMiddleware
+from services.telemetry import REGISTRY, TelemetryMiddleware, get_logger, span
+from services.usage import usage_tracker, bind_usage
+from services.resilience import (
+    bind_deadline, DegradedResult, UpstreamUnavailable,
+    DEADLINE_ANALYZE_SECONDS, DEADLINE_INFER_SECONDS, DEADLINE_EDIT_SECONDS,
+)
+from services.rate_limiter import bind_priority, INTERACTIVE, ANALYSIS, EDIT
+from schemas import AnalysisResponse, InferenceResponse, HitTestResponse
 import uvicorn
-from PIL import Image
-import io
+from contextlib import asynccontextmanager
 import os
+import json
+import asyncio
+
+logger = get_logger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 会话存储的读写在线程池中执行，淘汰通知转交回事件循环
+    session_store.bind_loop(asyncio.get_running_loop())
+    yield
+    # 关闭时取消排队的编辑任务，释放模型调用线程池和 SERP 连接池
+    await edit_queue.close()
+    ai_service.model_client.close()
+    if ai_service.serp_service:
+        await ai_service.serp_service.close()
+
+app = FastAPI(title="Ripple UI Backend", lifespan=lifespan)
 
-app = FastAPI(title="Ripple UI Backend")
+# 按 Content-Length 提前拒绝过大的上传，分块传输时边读边计数（放在 CORS 之前注册，使 413 响应也带有跨域头）
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # 允许跨域 (供 Vite 前端调用)
 # 生产环境：替换为实际的前端域名
@@ -21,12 +60,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 请求计数、耗时与 Server-Timing 响应头（最后注册，位于最外层，被拒绝的请求也会统计）
+app.add_middleware(TelemetryMiddleware)
+
 # 初始化 AI 服务（启用网络搜索）
 ai_service = AIService(enable_web_search=True)
 
-# 内存缓存 (MVP 简化版，生产环境应用 Redis)
-# 格式: { "image_id": { "image_data": PIL.Image, "objects": [...] } }
-GLOBAL_CACHE = {}
+# 会话存储：按 session_id 保存图片和识别结果（LRU + TTL + 内存上限）
+# 多 worker 部署时设置 SESSION_BACKEND=sqlite 共享会话
+session_store = create_session_store()
+
+# 场景分析缓存：相同图片重复上传时直接返回缓存结果，跳过 Gemini 调用
+analysis_cache = AnalysisCache(namespace=f"{MODEL_NAME}-{ANALYSIS_PROMPT_VERSION}")
+
+# 意图缓存：同一图片中的同一物体被重复点击时直接返回
+intent_cache = IntentCache()
+
+
+# 图片存储：编辑结果按内容哈希保存，通过 /api/images/{name} 以二进制返回（IMAGE_FORMAT / IMAGE_QUALITY）
+image_store = ImageStore()
+
+# 编辑历史：按会话保存每次编辑变化区域的压缩差量，支持撤销/重做（EDIT_HISTORY_MAX_BYTES）
+# 与编辑任务一样保存在本进程中
+edit_history = EditHistory()
+session_store.add_eviction_listener(edit_history.drop)
+
+# 图像编辑任务队列：编辑请求立即返回 job_id，由固定数量的 worker 执行（EDIT_WORKERS / EDIT_QUEUE_SIZE）
+# 任务保存在本进程中，多 worker 部署时查询任务的请求需要落在提交任务的 worker 上
+edit_queue = JobQueue(name="edit")
+if SESSION_BACKEND == "sqlite" and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+    logger.warning("⚠️ Edit jobs and edit history are per-process; run edits on a single worker or route requests by session")
+# 客户端轮询任务时单次最长等待时间（秒）
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+
+# 推理上下文中周围物体的数量
+NEARBY_K = int(os.getenv("NEARBY_K", "5"))
+
+# 空间索引：每个会话的物体在分析时建立一次网格索引，用于点击命中测试和按距离排序周围物体
+# （物体列表在会话内不变，编辑图片不影响索引；sqlite 后端下每个 worker 各自缓存）
+spatial_indexes = LRUCache(maxsize=int(os.getenv("SPATIAL_INDEX_CACHE_SIZE", "1024")))
+
+
+def get_spatial_index(session_id: str, objects) -> SpatialIndex:
+    """获取会话的空间索引，不存在时根据会话中的物体建立"""
+    index = spatial_indexes.get(session_id)
+    if index is None:
+        index = SpatialIndex(objects)
+        spatial_indexes.set(session_id, index)
+    return index
+
+
+session_store.add_eviction_listener(spatial_indexes.pop)
+
+
+def get_nearby_labels(objects, clicked_object=None, index=None):
+    """获取点击物体的上下文（距离最近的周围物体标签），/api/infer 与预取共用以保证缓存键一致"""
+    if clicked_object is None:
+        return [obj.label for obj in objects][:NEARBY_K]
+    index = index or SpatialIndex(objects)
+    return [obj.label for obj in index.nearest_to(clicked_object, NEARBY_K)]
+
+
+# 意图预取：分析完成后在后台为主要物体提前推理意图（PREFETCH_ENABLED=true 启用）
+prefetcher = None
+if PREFETCH_ENABLED:
+    prefetcher = IntentPrefetcher(ai_service.infer_intent, intent_cache, get_nearby_labels)
+    session_store.add_eviction_listener(prefetcher.cancel)
 
 @app.get("/")
 def read_root():
@@ -37,78 +136,477 @@ async def analyze_image(file: UploadFile = File(...)):
     """
     阶段 1: 上传并预分析图片
     """
+    bind_usage("analyze")
+    bind_deadline(DEADLINE_ANALYZE_SECONDS)
+    bind_priority(ANALYSIS)
+    degraded = False
     try:
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
+        # 分块读取并计算哈希（不把整个文件读入内存），先检查文件头中的尺寸再在线程池中解码
+        with span("upload_read"):
+            digest, _ = await hash_upload(file)
+        with span("upload_decode"):
+            image = await run_in_threadpool(decode_image, file.file)
         
-        # 1. AI 分析全图物体
-        detected_objects = await ai_service.analyze_scene(image)
+        # 1. 先按图片内容哈希查找缓存，未命中再调用 AI 分析全图物体
+        # 像素哈希与感知哈希（缩放 + DCT）在线程池中计算
+        cache_keys = [bytes_key(digest)]
+        if ANALYSIS_CACHE_PIXEL_HASH:
+            cache_keys.append(await run_in_threadpool(hash_pixels, image))
+        # 精确哈希未命中时按感知哈希查找近似重复图片（缩放/重新压缩过的同一张图）
+        phash = None
+        if analysis_cache.perceptual_index is not None:
+            phash = await run_in_threadpool(perceptual_hash, image)
+        # 缓存查找与写入会读写磁盘 JSON 和感知哈希索引文件，在线程池中执行
+        detected_objects = await run_in_threadpool(analysis_cache.get, *cache_keys, image=image, phash=phash)
+        if detected_objects is None:
+            try:
+                detected_objects = await ai_service.analyze_scene(image, image_key=cache_keys[0])
+            except DegradedResult as e:
+                # 部分分块失败：返回已有结果但不缓存
+                detected_objects, degraded = list(e.result), True
+            # 分析失败（空结果）或部分结果不写入缓存，下次重新分析
+            if detected_objects and not degraded:
+                await run_in_threadpool(analysis_cache.set, cache_keys, detected_objects, image.width, image.height,
+                                        phash=phash)
+        else:
+            logger.info("⚡️ Analysis cache hit (%d objects)", len(detected_objects))
         
-        # 2. 缓存图片和结果 (简单的 session 机制)
-        # 实际项目中应该返回一个 session_id
-        GLOBAL_CACHE["current_image"] = image
-        GLOBAL_CACHE["objects"] = detected_objects
+        # 2. 缓存图片和结果，返回 session_id 供后续请求使用（sqlite 后端写入图片，在线程池中执行）
+        session = await run_in_threadpool(session_store.create, image, detected_objects, image_hash=cache_keys[0])
+        usage_tracker.assign_session(session.session_id)
+        get_spatial_index(session.session_id, detected_objects)
+        
+        # 3. 后台预取主要物体的意图
+        if prefetcher:
+            prefetcher.schedule(session.session_id, image, detected_objects, session.image_hash)
         
         return AnalysisResponse(
+            session_id=session.session_id,
             objects=detected_objects,
             image_width=image.width,
-            image_height=image.height
+            image_height=image.height,
+            degraded=degraded
         )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except UpstreamUnavailable as e:
+        raise upstream_unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def upstream_unavailable(error: UpstreamUnavailable) -> HTTPException:
+    """上游不可用时返回 503，并按熔断剩余时间设置 Retry-After"""
+    logger.warning("⚠️ Upstream unavailable: %s", error)
+    retry_after = max(1, int(error.retry_after or 5))
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": str(retry_after)})
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    """缓存与会话存储的统计信息"""
+    return {
+        "analysis_cache": analysis_cache.stats(),
+        "intent_cache": intent_cache.stats(),
+        "prefetch": prefetcher.stats() if prefetcher else None,
+        "ai": ai_service.stats(),
+        "serp": ai_service.serp_service.stats() if ai_service.serp_service else None,
+        "sessions": session_store.stats(),
+        "edit_queue": edit_queue.stats(),
+        "images": image_store.stats(),
+        "edit_history": edit_history.stats(),
+    }
+
+def collect_metrics():
+    """/metrics 导出时读取各组件已有的统计信息（缓存命中、队列深度、内存占用）"""
+    serp = ai_service.serp_service.stats() if ai_service.serp_service else None
+    analysis = analysis_cache.stats()
+    caches = {
+        "analysis": (analysis["memory_hits"] + analysis["disk_hits"] + analysis["near_duplicate_hits"],
+                     analysis["misses"]),
+        "intent": (intent_cache.stats()["hits"], intent_cache.stats()["misses"]),
+        "model_image": (ai_service.stats()["model_image_cache"]["hits"],
+                        ai_service.stats()["model_image_cache"]["misses"]),
+        "spatial_index": (spatial_indexes.stats()["hits"], spatial_indexes.stats()["misses"]),
+    }
+    if serp is not None:
+        lookups = serp["cache"]["hits"] + serp["cache"]["misses"]
+        hits = serp["cache"]["hits"] + serp["disk_hits"]
+        caches["serp"] = (hits, lookups - hits)
+    queue = edit_queue.stats()
+    sessions = session_store.stats()
+    return [
+        ("ripple_cache_hits_total", "counter", "Cache lookups that hit",
+         [({"cache": name}, hits) for name, (hits, _) in caches.items()]),
+        ("ripple_cache_misses_total", "counter", "Cache lookups that missed",
+         [({"cache": name}, misses) for name, (_, misses) in caches.items()]),
+        ("ripple_cache_hit_ratio", "gauge", "Cache hit ratio since start",
+         [({"cache": name}, hits / (hits + misses) if hits + misses else 0.0) for name, (hits, misses) in caches.items()]),
+        ("ripple_edit_queue_depth", "gauge", "Edit jobs waiting for a worker", [({}, queue["depth"])]),
+        ("ripple_edit_jobs_running", "gauge", "Edit jobs being executed", [({}, queue["running"])]),
+        ("ripple_edit_jobs_rejected_total", "counter", "Edit jobs rejected because the queue was full",
+         [({}, queue["rejected"])]),
+        ("ripple_sessions", "gauge", "Active sessions", [({}, sessions["sessions"])]),
+        ("ripple_session_bytes", "gauge", "Memory held by session images", [({}, sessions["total_bytes"])]),
+        ("ripple_edit_history_bytes", "gauge", "Memory held by edit history deltas",
+         [({}, edit_history.stats()["total_bytes"])]),
+        ("ripple_image_store_bytes", "gauge", "Memory held by encoded result images", [({}, image_store.stats()["bytes"])]),
+        ("ripple_prefetch_in_flight", "gauge", "Intent prefetch tasks in progress",
+         [({}, prefetcher.stats()["in_flight"] if prefetcher else 0)]),
+    ]
+
+
+REGISTRY.register_collector(collect_metrics)
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 文本格式的指标（阶段耗时、请求数、缓存命中率、进行中的调用、上游错误）"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/usage")
+def usage_summary():
+    """模型 token 用量、SERP 请求数与估算费用（按接口、模型汇总）"""
+    return usage_tracker.summary()
+
+@app.get("/api/usage/{session_id}")
+def session_usage(session_id: str):
+    """单个会话的累计用量"""
+    usage = usage_tracker.session(session_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="No usage recorded for this session")
+    return {"session_id": session_id, **usage}
+
+@app.get("/api/hit", response_model=HitTestResponse)
+async def hit_test(session_id: str, x: int, y: int, k: int = NEARBY_K):
+    """
+    悬停/点击命中测试：返回坐标处最内层的物体和按距离排序的周围物体（不调用模型）
+    """
+    found = await run_in_threadpool(session_store.get_objects, session_id)
+    if not found:
+        raise HTTPException(status_code=400, detail="No image uploaded or session expired. Please upload an image first.")
+    index = get_spatial_index(session_id, found[0])
+    hit = index.hit_test(x, y)
+    return HitTestResponse(object=hit, nearby=index.nearest(x, y, k, exclude=hit))
+
+async def resolve_click(session_id: str, clicked_label, click_x: int, click_y: int):
+    """
+    /api/infer 与 /api/infer/stream 共用：查找会话、确定被点击的物体和周围物体上下文
+    （只读取物体列表和图片指纹，图片在意图缓存未命中时才由 session_image 读取）
+
+    Returns:
+        (clicked_label, nearby_labels, cache_key)
+    """
+    found = await run_in_threadpool(session_store.get_objects, session_id)
+    if not found:
+        logger.warning("❌ Session not found: %s", session_id)
+        raise HTTPException(status_code=400, detail="No image uploaded or session expired. Please upload an image first.")
+    objects, image_hash = found
+    
+    # 根据点击坐标找到被点击的最内层物体
+    index = get_spatial_index(session_id, objects)
+    clicked_object = index.hit_test(click_x, click_y)
+    if clicked_label and (clicked_object is None or clicked_object.label != clicked_label):
+        # 客户端指定的标签与命中结果不一致时，取距离点击位置最近的同名物体
+        same_label = [obj for obj in index.nearest(click_x, click_y, len(index.objects)) if obj.label == clicked_label]
+        clicked_object = same_label[0] if same_label else clicked_object
+    if not clicked_label:
+        if clicked_object is None:
+            raise HTTPException(status_code=400, detail=f"No object at ({click_x}, {click_y})")
+        clicked_label = clicked_object.label
+    
+    # 上下文：按距离排序的周围物体
+    nearby_labels = get_nearby_labels(objects, clicked_object, index)
+    cache_key = intent_cache_key(clicked_label, nearby_labels, image_hash)
+    return clicked_label, nearby_labels, cache_key
+
+
+async def session_image(session_id: str, clicked_label: str, nearby_labels):
+    """
+    意图缓存未命中时读取会话图片；图片在此期间被编辑过时按新的内容指纹重新计算缓存键
+
+    Returns:
+        (session, cache_key)
+    """
+    session = await get_session_or_400(session_id)
+    return session, intent_cache_key(clicked_label, nearby_labels, session.image_hash)
+
+
+async def cached_intents(cache_key, fresh: str):
+    """先查意图缓存，再等待正在进行的预取任务（fresh=true 时跳过），都没有时返回 None"""
+    if fresh.lower() in ("true", "1", "yes", "on"):
+        return None
+    intents = intent_cache.get(cache_key)
+    if intents is None and prefetcher:
+        intents = await prefetcher.join(cache_key)
+    if intents is not None:
+        logger.info("⚡️ Intent cache hit for: %s", cache_key[0])
+    return intents
+
+
 @app.post("/api/infer", response_model=InferenceResponse)
 async def infer_intent(
-    clicked_label: str = Form(...),
+    session_id: str = Form(...),
+    clicked_label: str = Form(None),  # 可选：不传时由服务端根据点击坐标命中测试确定
     click_x: int = Form(...),
-    click_y: int = Form(...)
+    click_y: int = Form(...),
+    fresh: str = Form("false")  # 可选：跳过缓存，重新推理
 ):
     """
     阶段 2: 点击触发意图推理
     """
+    bind_usage("infer", session_id)
+    bind_deadline(DEADLINE_INFER_SECONDS)
+    bind_priority(INTERACTIVE)
+    degraded = False
     try:
-        image = GLOBAL_CACHE.get("current_image")
-        if not image:
-            print("❌ Error: No image in cache")
-            raise HTTPException(status_code=400, detail="No image uploaded. Please upload an image first.")
-        
-        # 简单的上下文获取 (获取周围物体)
-        nearby_labels = [obj.label for obj in GLOBAL_CACHE.get("objects", [])][:5]
+        clicked_label, nearby_labels, cache_key = await resolve_click(session_id, clicked_label, click_x, click_y)
         
-        print(f"🔍 Inferring intent for: {clicked_label} at ({click_x}, {click_y})")
+        logger.info("🔍 Inferring intent for: %s at (%d, %d)", clicked_label, click_x, click_y)
         
-        # AI 推理
-        intents = await ai_service.infer_intent(image, clicked_label, nearby_labels)
+        # 先查意图缓存，未命中再调用 AI 推理
+        intents = await cached_intents(cache_key, fresh)
+        if intents is None:
+            session, cache_key = await session_image(session_id, clicked_label, nearby_labels)
+            try:
+                intents = await ai_service.infer_intent(
+                    session.image, clicked_label, nearby_labels, image_key=session.image_hash
+                )
+                intent_cache.set(cache_key, intents)
+            except DegradedResult as e:
+                # 模型不可用：返回降级意图，不写入缓存
+                intents, degraded = e.result, True
         
-        print(f"✅ Found {len(intents)} intents")
-        return InferenceResponse(intents=intents)
+        logger.info("✅ Found %d intents%s", len(intents), " (degraded)" if degraded else "")
+        return InferenceResponse(intents=intents, degraded=degraded)
     except HTTPException:
         raise
+    except UpstreamUnavailable as e:
+        raise upstream_unavailable(e)
     except Exception as e:
-        print(f"❌ Inference error: {e}")
+        logger.error("❌ Inference error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Inference error: {str(e)}")
 
+def sse_event(event: str, data) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/infer/stream")
+async def infer_intent_stream(
+    session_id: str = Form(...),
+    clicked_label: str = Form(None),
+    click_x: int = Form(...),
+    click_y: int = Form(...),
+    fresh: str = Form("false")
+):
+    """
+    阶段 2（流式）: 与 /api/infer 参数相同，以 Server-Sent Events 返回意图
+    - event: intent  每个意图生成完毕后立即推送
+    - event: done    最终校验后的完整意图列表 {"intents": [...], "degraded": false}
+                     （模型不可用时 degraded 为 true，意图为降级结果或已推送的部分意图）
+    - event: error   推理失败
+    """
+    bind_usage("infer_stream", session_id)
+    bind_deadline(DEADLINE_INFER_SECONDS)
+    bind_priority(INTERACTIVE)
+    clicked_label, nearby_labels, cache_key = await resolve_click(session_id, clicked_label, click_x, click_y)
+    logger.info("🔍 Streaming intents for: %s at (%d, %d)", clicked_label, click_x, click_y)
+
+    async def events():
+        degraded = False
+        try:
+            intents = await cached_intents(cache_key, fresh)
+            if intents is None:
+                session, key = await session_image(session_id, clicked_label, nearby_labels)
+                async for event, payload in ai_service.infer_intent_stream(
+                    session.image, clicked_label, nearby_labels, image_key=session.image_hash
+                ):
+                    if event == "intent":
+                        yield sse_event("intent", payload.model_dump())
+                    else:
+                        intents, degraded = payload, event == "degraded"
+                if not degraded:
+                    intent_cache.set(key, intents)
+            else:
+                for intent in intents:
+                    yield sse_event("intent", intent.model_dump())
+            logger.info("✅ Streamed %d intents%s", len(intents), " (degraded)" if degraded else "")
+            yield sse_event("done", {"intents": [intent.model_dump() for intent in intents], "degraded": degraded})
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail})
+        except Exception as e:
+            logger.error("❌ Streaming inference error: %s", e, exc_info=True)
+            yield sse_event("error", {"detail": f"Inference error: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def replace_session_image(session_id: str, image, image_hash: str):
+    """替换会话图片：取消基于旧图片的预取，并更新内容指纹使旧缓存失效"""
+    if prefetcher:
+        prefetcher.cancel(session_id)
+    if await run_in_threadpool(session_store.update_image, session_id, image, image_hash=image_hash) is None:
+        # 会话在编辑期间被淘汰（可能由其他 worker 淘汰）：丢弃刚记录的历史，不返回已无法继续使用的结果
+        edit_history.drop(session_id)
+        raise HTTPException(status_code=400, detail="Session expired during the edit. Please upload the image again.")
+
+async def deliver_image(image) -> dict:
+    """在线程池中编码并保存图片，返回图片地址和尺寸（不在 JSON 中内嵌图片）"""
+    with span("image_encode"):
+        stored = await run_in_threadpool(image_store.put, image)
+    return {
+        "image_url": f"/api/images/{stored['image_name']}",
+        "thumbnail_url": f"/api/images/{stored['thumbnail_name']}" if stored["thumbnail_name"] else None,
+        "width": stored["width"],
+        "height": stored["height"]
+    }
+
+async def run_edit(session_id: str, prompt: str, box_2d, enable_edit: bool, edit_mode):
+    """编辑任务：在 worker 中执行，开始执行时读取会话的最新图片（截止时间从开始执行时计算）"""
+    bind_deadline(DEADLINE_EDIT_SECONDS)
+    bind_priority(EDIT)
+    session = await run_in_threadpool(session_store.get, session_id)
+    if not session:
+        raise HTTPException(status_code=400, detail="No image context or session expired. Please upload an image first.")
+    image_copy = session.image.copy()
+    new_image = await ai_service.execute_edit(image_copy, prompt, box_2d, enable_edit, edit_mode)
+    if new_image is not image_copy:
+        # 图片内容已改变：记录差量到编辑历史，再替换会话图片
+        # （差量在线程池中计算，记录与替换在同一步完成，任务被取消时两者都不会发生）
+        new_hash = await run_in_threadpool(hash_pixels, new_image)
+        delta = await run_in_threadpool(edit_history.diff, image_copy, new_image, session.image_hash, new_hash)
+        edit_history.record(session_id, delta)
+        await replace_session_image(session_id, new_image, new_hash)
+    
+    return {
+        "status": "success",
+        "action_type": "edit",
+        **(await deliver_image(new_image)),
+        "version": edit_history.version(session_id)
+    }
+
+async def get_session_or_400(session_id: str):
+    """读取会话（sqlite 后端读取并解码图片，在线程池中执行），不存在时返回 400"""
+    session = await run_in_threadpool(session_store.get, session_id)
+    if not session:
+        raise HTTPException(status_code=400, detail="No image uploaded or session expired. Please upload an image first.")
+    return session
+
+async def restore_version(session_id: str, version: int):
+    """撤销/重做/跳转的公共流程：取消进行中的编辑，按差量重建目标版本并替换会话图片"""
+    session = await get_session_or_400(session_id)
+    edit_queue.cancel_group(session_id)
+    restored = await run_in_threadpool(edit_history.checkout, session_id, session.image, version, session.image_hash)
+    if restored is None:
+        raise HTTPException(status_code=409, detail=f"Version {version} is not available in edit history")
+    image, image_hash, from_version = restored
+    if not edit_history.move(session_id, from_version, version):
+        raise HTTPException(status_code=409, detail="Edit history changed concurrently, please retry")
+    await replace_session_image(session_id, image, image_hash)
+    logger.info("⏪ Session %s restored to version %d", session_id[:8], version)
+    return {
+        "status": "success",
+        **(await deliver_image(image)),
+        **edit_history.describe(session_id)
+    }
+
+@app.get("/api/history/{session_id}")
+async def history_status(session_id: str):
+    """编辑历史状态：当前版本、可用版本范围、能否撤销/重做"""
+    if not await run_in_threadpool(session_store.get_objects, session_id):
+        raise HTTPException(status_code=400, detail="No image uploaded or session expired. Please upload an image first.")
+    return edit_history.describe(session_id)
+
+@app.post("/api/history/{session_id}/undo")
+async def undo_edit(session_id: str):
+    """撤销上一次编辑（不调用模型）"""
+    return await restore_version(session_id, edit_history.version(session_id) - 1)
+
+@app.post("/api/history/{session_id}/redo")
+async def redo_edit(session_id: str):
+    """重做被撤销的编辑"""
+    return await restore_version(session_id, edit_history.version(session_id) + 1)
+
+@app.post("/api/history/{session_id}/checkout")
+async def checkout_version(session_id: str, version: int = Form(...)):
+    """跳转到指定版本（0 为上传的原图，被淘汰的旧版本不可用）"""
+    return await restore_version(session_id, version)
+
+@app.get("/api/images/{name}")
+def get_image(name: str, if_none_match: str = Header(None)):
+    """
+    返回已保存的图片（内容寻址，地址不变则内容不变，可长期缓存）
+    """
+    etag = f'"{name.rsplit(".", 1)[0]}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    stored = image_store.get(name)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Image not found: {name}")
+    data, media_type = stored
+    return Response(content=data, media_type=media_type, headers=headers)
+
+def get_job(job_id: str):
+    job = edit_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found or expired: {job_id}")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str, wait: float = 0):
+    """
+    查询编辑任务状态（wait > 0 时最多等待 wait 秒直到任务结束）
+    """
+    job = await edit_queue.wait(get_job(job_id), min(wait, JOB_MAX_WAIT_SECONDS))
+    return {**job.to_dict(), "position": edit_queue.position(job)}
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str, wait: float = 0):
+    """
+    获取编辑结果：完成时返回与同步编辑相同的响应；未完成时返回 202 和任务状态；
+    失败返回 500，被取消或被取代返回 410
+    """
+    job = await edit_queue.wait(get_job(job_id), min(wait, JOB_MAX_WAIT_SECONDS))
+    if job.status == SUCCEEDED:
+        return job.result
+    if job.status == FAILED:
+        raise HTTPException(status_code=500, detail=f"Execute error: {job.error}")
+    if job.finished:
+        raise HTTPException(status_code=410, detail=f"Job {job.status}")
+    return JSONResponse(status_code=202, content={**job.to_dict(), "position": edit_queue.position(job)})
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """取消编辑任务"""
+    job = get_job(job_id)
+    return {"job_id": job.job_id, "cancelled": edit_queue.cancel(job_id), "status": job.status}
+
 @app.post("/api/execute")
 async def execute_action(
     intent_id: int = Form(...),
     action_type: str = Form(...),
+    session_id: str = Form(None),  # 可选：图像编辑时需要
     prompt: str = Form(None),  # 可选：图像编辑提示词
     box_json: str = Form(None),  # 可选：边界框
     action_data_json: str = Form(None),  # 可选：其他操作数据
-    enable_image_edit: str = Form("true")
+    enable_image_edit: str = Form("true"),
+    edit_mode: str = Form(None),  # 可选：full | region，默认读取 EDIT_MODE
+    wait: str = Form("false")  # 可选：编辑时等待任务完成后直接返回结果
 ):
     """
     阶段 3: 执行操作（支持多种操作类型）
-    - edit: 图像编辑
+    - edit: 图像编辑（提交到任务队列，返回 job_id，通过 /api/jobs/{job_id}/result 获取结果）
     - info: 返回信息
     - navigate: 返回导航链接
     - search: 返回搜索结果
     """
     import json
+    bind_usage("execute", session_id)
     try:
         enable_edit = enable_image_edit.lower() in ("true", "1", "yes", "on")
         
-        print(f"🎯 Executing action: {action_type} (intent_id: {intent_id})")
+        logger.info("🎯 Executing action: %s (intent_id: %d)", action_type, intent_id)
         
         # 根据操作类型执行不同的逻辑
         if action_type == "edit":
@@ -117,21 +615,40 @@ async def execute_action(
                 raise HTTPException(status_code=400, detail="Missing prompt or box_json for edit action")
             
             box_2d = json.loads(box_json)
-            image = GLOBAL_CACHE.get("current_image")
+            if not await run_in_threadpool(session_store.get_objects, session_id):
+                raise HTTPException(status_code=400, detail="No image context or session expired. Please upload an image first.")
             
-            if not image:
-                raise HTTPException(status_code=400, detail="No image context. Please upload an image first.")
+            # 图像编辑模型熔断中：直接拒绝，而不是排队后失败
+            breaker = ai_service.model_client.upstream(ai_service.image_edit_model_name).breaker
+            if enable_edit and breaker.state == breaker.OPEN and breaker.retry_after() > 0:
+                raise HTTPException(status_code=503, detail=f"{breaker.name}: circuit open",
+                                    headers={"Retry-After": str(max(1, int(breaker.retry_after())))})
             
-            print(f"🎨 Editing image: {prompt}")
-            print(f"📦 Box: {box_2d}")
+            logger.info("🎨 Queueing image edit: %s", prompt, extra={"box_2d": box_2d})
             
-            new_image = await ai_service.execute_edit(image.copy(), prompt, box_2d, enable_edit)
-            GLOBAL_CACHE["current_image"] = new_image
+            # 提交到编辑队列；同一会话中尚未完成的旧编辑会被取代
+            try:
+                job = edit_queue.submit(
+                    lambda: run_edit(session_id, prompt, box_2d, enable_edit, edit_mode),
+                    group=session_id
+                )
+            except QueueFullError as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+            
+            if wait.lower() in ("true", "1", "yes", "on"):
+                # 同步模式：等待编辑完成后直接返回结果
+                await edit_queue.wait(job, JOB_MAX_WAIT_SECONDS)
+                if job.status == SUCCEEDED:
+                    return job.result
+                if job.status == FAILED:
+                    raise HTTPException(status_code=500, detail=f"Execute error: {job.error}")
             
             return {
-                "status": "success",
+                "status": "queued",
                 "action_type": "edit",
-                "image_base64": image_to_base64(new_image)
+                "job_id": job.job_id,
+                "job_status": job.status,
+                "position": edit_queue.position(job)
             }
         
         elif action_type == "info":
@@ -192,12 +709,12 @@ async def execute_action(
             raise HTTPException(status_code=400, detail=f"Unknown action_type: {action_type}")
             
     except json.JSONDecodeError as e:
-        print(f"❌ JSON decode error: {e}")
+        logger.warning("❌ JSON decode error: %s", e)
         raise HTTPException(status_code=400, detail=f"Invalid JSON format: {str(e)}")
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Execute error: {e}")
+        logger.error("❌ Execute error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Execute error: {str(e)}")
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 # ----------------------
 # 响应模型 (Response)
@@ -19,9 +19,11 @@ class DetectedObject(BaseModel):
     confidence: float = 1.0
 
 class AnalysisResponse(BaseModel):
+    session_id: str
     objects: List[DetectedObject]
     image_width: int
     image_height: int
+    degraded: bool = False  # 上游不可用，只返回了部分分块的结果
 
 class RippleIntent(BaseModel):
     id: int
@@ -36,6 +38,11 @@ class RippleIntent(BaseModel):
 
 class InferenceResponse(BaseModel):
     intents: List[RippleIntent]
+    degraded: bool = False  # 模型不可用，意图由搜索结果和物体标签生成
+
+class HitTestResponse(BaseModel):
+    object: Optional[DetectedObject] = None  # 点击位置最内层的物体
+    nearby: List[DetectedObject] = []  # 按距离排序的周围物体
 
 # ----------------------
 # 请求模型 (Request)
@@ -1,58 +1,149 @@
 import os
+import logging
 import json
 import base64
+import asyncio
 from io import BytesIO
-from dotenv import load_dotenv
-from typing import List
+from typing import Any, AsyncIterator, List, Optional, Tuple
 from PIL import Image
-from services.utils import clean_json_string
+from services.utils import clean_json_string, JsonArrayStream
 from services.serp_service import SerpService
+from services.model_client import ModelClient, USE_NEW_SDK, types
+from services.singleflight import SingleFlight
+from services.intent_cache import intent_cache_key
+from services.image_ops import edit_region, composite_region, encode_for_model, match_image
+from services.cache import LRUCache
+from services.detection import tile_grid, merge_detections
+from services.telemetry import get_logger, span
+from services.prompts import build_intent_prompt, intent_system_instruction, prompt_variant
+from services.context_cache import ContextCache
+from services.resilience import FALLBACKS, DegradedResult, UpstreamUnavailable, is_transient
 from schemas import DetectedObject, RippleIntent
 
-load_dotenv()
-
-# 尝试使用新的 SDK，如果不可用则回退到旧的
-try:
-    from google import genai
-    from google.genai import types
-    USE_NEW_SDK = True
-    client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
-    print("✅ Using new Google Genai SDK")
-except ImportError:
-    import google.generativeai as genai
-    USE_NEW_SDK = False
-    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-    print("⚠️ Using old google-generativeai SDK")
+logger = get_logger(__name__)
 
 # 使用便宜快速的模型
 MODEL_NAME = 'gemini-2.0-flash'
 # 图像编辑模型（根据官方文档，需要使用专门的图像生成模型）
 IMAGE_EDIT_MODEL = 'gemini-2.5-flash-image'  # 官方推荐的图像编辑模型
 
+# 意图推理中网络搜索与模型调用的编排方式: sequential | parallel | deadline
+INTENT_SEARCH_MODE = os.getenv("INTENT_SEARCH_MODE", "sequential")
+# deadline 模式下等待网络搜索的最长时间（秒）
+SERP_DEADLINE_SECONDS = float(os.getenv("SERP_DEADLINE_SECONDS", "1.5"))
+# 图像编辑模式: full（整图）| region（只编辑目标区域并融合回原图）
+EDIT_MODE = os.getenv("EDIT_MODE", "full")
+# region 模式下裁剪区域的上下文边距（占目标框边长的比例）
+EDIT_REGION_MARGIN = float(os.getenv("EDIT_REGION_MARGIN", "0.25"))
+# 发送给模型前将图片长边缩小到的上限（像素，0 表示发送原图）
+ANALYZE_MAX_EDGE = int(os.getenv("ANALYZE_MAX_EDGE", "1024"))
+INFER_MAX_EDGE = int(os.getenv("INFER_MAX_EDGE", "768"))
+EDIT_MAX_EDGE = int(os.getenv("EDIT_MAX_EDGE", "0"))
+# 大图分块分析：长边达到 TILED_ANALYSIS_MIN_EDGE 时，将图片切成重叠分块并发分析后合并
+TILED_ANALYSIS = os.getenv("TILED_ANALYSIS", "false").lower() in ("true", "1", "yes", "on")
+TILED_ANALYSIS_MIN_EDGE = int(os.getenv("TILED_ANALYSIS_MIN_EDGE", "2048"))
+ANALYZE_TILE_SIZE = int(os.getenv("ANALYZE_TILE_SIZE", "1024"))
+ANALYZE_TILE_OVERLAP = float(os.getenv("ANALYZE_TILE_OVERLAP", "0.2"))
+ANALYZE_TILE_CONCURRENCY = int(os.getenv("ANALYZE_TILE_CONCURRENCY", "4"))
+ANALYZE_TILE_NMS_IOU = float(os.getenv("ANALYZE_TILE_NMS_IOU", "0.5"))
+ANALYZE_TILE_MAX_OBJECTS = int(os.getenv("ANALYZE_TILE_MAX_OBJECTS", "30"))
+# 发送给模型的 JPEG 质量
+MODEL_IMAGE_QUALITY = int(os.getenv("MODEL_IMAGE_QUALITY", "85"))
+# 缓存的缩小后图片数量（按 图片指纹 + 尺寸上限 缓存）
+MODEL_IMAGE_CACHE_SIZE = int(os.getenv("MODEL_IMAGE_CACHE_SIZE", "256"))
+
 class AIService:
-    def __init__(self, enable_web_search: bool = True):
+    def __init__(self, enable_web_search: bool = True, model_client: Optional[ModelClient] = None):
         """
         初始化 AI 服务
         
         Args:
             enable_web_search: 是否启用网络搜索功能（默认 True）
+            model_client: 异步模型调用客户端，如果为 None 则自动创建
+
+        上游不可用时：分析抛出 UpstreamUnavailable（分块分析部分成功时抛出带部分结果的 DegradedResult），
+        意图推理抛出带降级意图（由搜索结果和物体标签生成）的 DegradedResult。
         """
-        if USE_NEW_SDK:
-            self.model_name = MODEL_NAME
-            self.image_edit_model_name = IMAGE_EDIT_MODEL
-        else:
-            self.model = genai.GenerativeModel(MODEL_NAME)
-            self.image_edit_model = genai.GenerativeModel(IMAGE_EDIT_MODEL)
+        self.model_name = MODEL_NAME
+        self.image_edit_model_name = IMAGE_EDIT_MODEL
+        self.model_client = model_client or ModelClient()
+        # 合并相同图片/相同物体的并发模型调用
+        self._flights = SingleFlight("ai")
+        # 缩小并编码后的模型输入图片，同一会话图片的多次调用复用
+        self._model_images = LRUCache(maxsize=MODEL_IMAGE_CACHE_SIZE)
+        # 意图推理的系统指令 + 会话图片在模型端的缓存（CONTEXT_CACHE 开启时）
+        self.context_cache = ContextCache(self.model_client)
         
         # 初始化 SERP 服务（如果启用）
         self.enable_web_search = enable_web_search
         self.serp_service = SerpService() if enable_web_search else None
 
-    async def analyze_scene(self, image) -> List[DetectedObject]:
+    async def analyze_scene(self, image, image_key: Optional[str] = None) -> List[DetectedObject]:
         """
         Step 1: 全局扫描 (Pre-indexing)
         识别图中所有主要物体，返回坐标。
+        
+        Args:
+            image: PIL Image 对象
+            image_key: 图片内容指纹；提供时，相同图片的并发分析只调用一次模型
+        """
+        if image_key is None:
+            return await self._analyze_scene(image)
+        results = await self._flights.do(("analyze", image_key), lambda: self._analyze_scene(image, image_key))
+        return list(results)
+
+    async def _analyze_scene(self, image, image_key: Optional[str] = None) -> List[DetectedObject]:
+        if TILED_ANALYSIS and max(image.size) >= TILED_ANALYSIS_MIN_EDGE:
+            return await self._analyze_tiled(image, image_key)
+        return await self._detect_objects(image, image_key)
+
+    async def _analyze_tiled(self, image, image_key: Optional[str] = None) -> List[DetectedObject]:
         """
+        分块分析大图：全图 + 各重叠分块并发检测（数量受 ANALYZE_TILE_CONCURRENCY 限制），
+        分块坐标平移回原图后用 NMS 合并重复检测。
+        """
+        tiles = tile_grid(image.width, image.height, ANALYZE_TILE_SIZE, ANALYZE_TILE_OVERLAP)
+        semaphore = asyncio.Semaphore(ANALYZE_TILE_CONCURRENCY)
+        logger.info("🧩 Tiled analysis: %d tiles + full frame for %dx%d", len(tiles), image.width, image.height)
+
+        async def detect(tile) -> List[DetectedObject]:
+            async with semaphore:
+                if tile is None:
+                    # 全图检测：保证跨越多个分块的大物体被完整识别
+                    return await self._detect_objects(image, image_key)
+                left, top, _, _ = tile
+                tile_key = f"{image_key}:tile:{left},{top}" if image_key else None
+                objects = await self._detect_objects(image.crop(tile), tile_key)
+                return [
+                    obj.model_copy(update={"box_2d": [
+                        obj.box_2d[0] + top, obj.box_2d[1] + left,
+                        obj.box_2d[2] + top, obj.box_2d[3] + left
+                    ]})
+                    for obj in objects
+                ]
+
+        groups = await asyncio.gather(*(detect(tile) for tile in [None] + tiles), return_exceptions=True)
+        failures = [group for group in groups if isinstance(group, BaseException)]
+        for failure in failures:
+            if not isinstance(failure, UpstreamUnavailable):
+                raise failure
+        if len(failures) == len(groups):
+            raise failures[0]
+        detections = [obj for group in groups if not isinstance(group, BaseException) for obj in group]
+        merged = merge_detections(
+            detections, iou_threshold=ANALYZE_TILE_NMS_IOU, max_objects=ANALYZE_TILE_MAX_OBJECTS
+        )
+        logger.info("🧩 Merged %d detections into %d objects", len(detections), len(merged))
+        if failures:
+            # 部分分块失败：返回其余分块的结果
+            logger.warning("⚠️ %d of %d tiles failed, returning partial analysis: %s",
+                           len(failures), len(groups), failures[0])
+            FALLBACKS.inc(kind="analyze_partial")
+            raise DegradedResult(merged, failures[0])
+        return merged
+
+    async def _detect_objects(self, image, image_key: Optional[str] = None) -> List[DetectedObject]:
+        """对单张图片（或分块）调用模型检测物体，返回该图片像素坐标下的结果"""
         prompt = """
         Detect all significant interactable objects in this image.
         Return a JSON list. Each entry MUST follow this format:
@@ -66,20 +157,19 @@ class AIService:
         """
         
         try:
+            config = None
             if USE_NEW_SDK:
-                response = client.models.generate_content(
-                    model=self.model_name,
-                    contents=[prompt, image],
-                    config=types.GenerateContentConfig(
-                        temperature=0.5,
-                        thinking_config=types.ThinkingConfig(thinking_budget=0)
-                    )
+                config = types.GenerateContentConfig(
+                    temperature=0.5,
+                    thinking_config=types.ThinkingConfig(thinking_budget=0)
                 )
-                json_str = clean_json_string(response.text)
-            else:
-                response = self.model.generate_content([prompt, image])
-                json_str = clean_json_string(response.text)
-            data = json.loads(json_str)
+            # 发送缩小后的图片；模型返回 0-1000 归一化坐标，下面按原图尺寸映射回像素坐标
+            model_image = await self.prepare_image(image, ANALYZE_MAX_EDGE, image_key)
+            response = await self.model_client.generate_content(
+                self.model_name, [prompt, model_image], config=config
+            )
+            with span("json_parse"):
+                data = json.loads(clean_json_string(response.text))
             
             results = []
             width, height = image.size
@@ -104,164 +194,367 @@ class AIService:
                     center=center
                 ))
             return results
+        except UpstreamUnavailable:
+            raise
         except Exception as e:
-            print(f"Analysis Error: {e}")
+            logger.error("Analysis Error: %s", e, exc_info=True)
             return []
 
-    async def infer_intent(self, image, clicked_label: str, nearby_labels: List[str]) -> List[RippleIntent]:
-        """
-        Step 2: 意图推理 (Cached Inference with Web Search)
-        根据点击的物体，结合互联网资源，生成 Ripple Menu 选项。
-        """
-        # 构建基础 prompt
-        base_prompt = f"""
-        User clicked on a '{clicked_label}' in the image.
-        Context objects nearby: {nearby_labels}.
+    def stats(self) -> dict:
+        """返回请求合并与模型输入图片缓存的统计信息"""
+        return {
+            "singleflight": self._flights.stats(),
+            "model_image_cache": self._model_images.stats(),
+            "model_backend": self.model_client.backend.stats(),
+            "context_cache": self.context_cache.stats(),
+            "model_client": self.model_client.stats(),
+        }
+
+    async def prepare_image(self, image, max_edge: int, image_key: Optional[str] = None):
         """
+        生成发送给模型的图片：长边缩小到 max_edge 并编码为 JPEG（在线程池中执行），
+        提供 image_key 时按 (image_key, max_edge) 缓存，避免每次调用都重新缩放和编码。
         
-        # 检测是否为商品
+        Returns:
+            可直接放入 contents 的图片（max_edge <= 0 时返回原图）
+        """
+        if max_edge <= 0:
+            return image
+        cache_key = (image_key, max_edge) if image_key else None
+        if cache_key is not None:
+            cached = self._model_images.get(cache_key)
+            if cached is not None:
+                return cached
+        with span("model_image_encode"):
+            data = await self.model_client.run_sync(encode_for_model, image, max_edge, MODEL_IMAGE_QUALITY)
+        if USE_NEW_SDK:
+            payload = types.Part.from_bytes(data=data, mime_type="image/jpeg")
+        else:
+            payload = {"mime_type": "image/jpeg", "data": data}
+        if cache_key is not None:
+            self._model_images.set(cache_key, payload)
+        return payload
+
+    @staticmethod
+    def _is_product(clicked_label: str) -> bool:
+        """检测点击的物体是否为商品"""
         product_keywords = ['clothing', 'clothes', 'shirt', 'dress', 'jacket', 'shoe', 'bag', 
                           'accessory', 'product', 'item', '商品', '衣服', '鞋子', '包', '配饰']
-        is_product = any(keyword.lower() in clicked_label.lower() for keyword in product_keywords)
-        
-        # 如果启用了网络搜索，先搜索相关信息
-        web_context = ""
-        web_results = []
-        if self.enable_web_search and self.serp_service:
-            print(f"🌐 Searching web for: {clicked_label} {'(product)' if is_product else ''}")
-            web_context, web_results = await self.serp_service.search_related_actions(
-                clicked_label, 
-                nearby_labels,
-                is_product=is_product
+        return any(keyword.lower() in clicked_label.lower() for keyword in product_keywords)
+
+    async def _intent_request(self, image, image_key: Optional[str], prompt: str,
+                              use_cache: bool = True) -> Tuple[list, Any, bool]:
+        """
+        组装意图推理请求：静态系统指令和会话图片在前（同一会话的每次点击都相同，
+        可以命中模型端缓存），只有动态部分 prompt 随点击变化
+
+        Returns:
+            (contents, config, 是否使用了上下文缓存)
+        """
+        model_image = await self.prepare_image(image, INFER_MAX_EDGE, image_key)
+        instruction = intent_system_instruction()
+        if not USE_NEW_SDK:
+            # 旧 SDK 的系统指令绑定在模型对象上，这里直接作为第一段内容发送
+            return [instruction, model_image, prompt], None, False
+        if use_cache:
+            cache_name = await self.context_cache.get(
+                self.model_name, prompt_variant(), image_key, instruction, model_image
             )
+            if cache_name is not None:
+                return [prompt], self._intent_config(cached_content=cache_name), True
+        return [model_image, prompt], self._intent_config(system_instruction=instruction), False
+
+    @staticmethod
+    def _parse_intents(text: str, clicked_label: str, is_product: bool, web_results: List[dict],
+                       fill_missing: bool = False) -> List[RippleIntent]:
+        """
+        解析模型输出的意图列表，并用网络搜索结果补全 action_data
+
+        Args:
+            fill_missing: 为 True 时（搜索结果未进入 prompt），除了补全空的 action_data，
+                          还会补全 action_data 中缺失的链接和摘要
+        """
+        with span("json_parse"):
+            data = json.loads(clean_json_string(text))
+        with span("intent_postprocess"):
+            return [
+                AIService._complete_intent(item, clicked_label, is_product, web_results, fill_missing)
+                for item in data
+            ]
+
+    @staticmethod
+    def _complete_intent(item: dict, clicked_label: str, is_product: bool, web_results: List[dict],
+                         fill_missing: bool = False) -> RippleIntent:
+        """补全并校验单个意图（_parse_intents 与流式推理共用）"""
+        # 如果 AI 没有生成 action_type，根据 editor_prompt 推断
+        if "action_type" not in item:
+            item["action_type"] = "edit" if item.get("editor_prompt") else "info"
         
-        # 构建完整的 prompt - 从用户意图出发
-        prompt = f"""
-        {base_prompt}
-        
-        {web_context if web_context else ""}
-        
-        **Think from the user's perspective**: When a user clicks on '{clicked_label}' in an image, what are their most likely intentions?
-        
-        Step 1: Analyze user intentions
-        Consider what a real person would want to do when they see and click on this object:
-        - What questions might they have?
-        - What actions would they naturally want to take?
-        - What information would be useful to them?
-        - What creative possibilities interest them?
+        # 如果 action_type 是 navigate/search 但没有 action_data，尝试从 web_results 填充
+        if item["action_type"] in ["navigate", "search"] and not item.get("action_data"):
+            if web_results:
+                # 对于商品，如果是搜索类型，优先使用 eBay 搜索格式
+                if is_product and item["action_type"] == "search":
+                    item["action_data"] = {
+                        "search_query": f"{clicked_label} site:ebay.com",
+                        "search_engine": "ebay",
+                        "title": f"Search {clicked_label} on eBay"
+                    }
+                else:
+                    # 使用第一个搜索结果作为默认链接
+                    item["action_data"] = {
+                        "url": web_results[0].get("link", ""),
+                        "title": web_results[0].get("title", ""),
+                        "search_query": f"{clicked_label} {item['label']}"
+                    }
         
-        Step 2: Generate actions based on intentions
-        For each identified user intention, provide the most appropriate action type and functionality.
+        # 如果 action_type 是 info 但没有 action_data，从 web_results 填充信息
+        if item["action_type"] == "info" and not item.get("action_data"):
+            if web_results:
+                item["action_data"] = {
+                    "info_text": web_results[0].get("snippet", ""),
+                    "source_url": web_results[0].get("link", "")
+                }
         
-        Action types available:
-        1. **Image Edit** (action_type: "edit"): When user wants to modify the image
-           - Change appearance (color, style, effects)
-           - Remove or replace the object
-           - Add elements or transform
-           
-        2. **Information** (action_type: "info"): When user wants to learn more
-           - Get details, specifications, history
-           - Understand usage or context
-           
-        3. **Navigate** (action_type: "navigate"): When user wants to visit related resources
-           - Official websites, stores, services
-           - Purchase or booking pages
-           
-        4. **Search** (action_type: "search"): When user wants to find related content
-           - Similar items, reviews, tutorials
-           - **For products**: Search on eBay or shopping platforms (use "site:ebay.com {clicked_label}" format)
+        # 并行模式下模型没有看到搜索结果，补全缺失的链接和摘要
+        if fill_missing and web_results and isinstance(item.get("action_data"), dict):
+            action_data = item["action_data"]
+            if item["action_type"] == "navigate" and not action_data.get("url"):
+                action_data["url"] = web_results[0].get("link", "")
+                action_data.setdefault("title", web_results[0].get("title", ""))
+            elif item["action_type"] == "info":
+                if not action_data.get("info_text"):
+                    action_data["info_text"] = web_results[0].get("snippet", "")
+                if not action_data.get("source_url"):
+                    action_data["source_url"] = web_results[0].get("link", "")
         
-        Step 3: Return 4-6 actions
-        Return JSON list with actions that match real user intentions:
-        [
-            {{
-                "id": 1,
-                "label": "Short Button Text (user-friendly)",
-                "emoji": "Icon",
-                "description": "Clear description of what this action does",
-                "color": "Hex Code (Green for Nav, Blue for Use, Orange for Edit, Purple for Info)",
-                "probability": 0.8,
-                "action_type": "edit|info|navigate|search",
-                "editor_prompt": "Prompt for image generation AI (only if action_type='edit')",
-                "action_data": {{
-                    "url": "https://...",  // for navigate/search
-                    "search_query": "...",  // for search (use "site:ebay.com {clicked_label}" for eBay)
-                    "info_text": "...",  // for info
-                    "search_engine": "ebay"  // optional: "ebay" for eBay searches
-                }}
-            }}
-        ]
+        return RippleIntent(**item)
+
+    async def infer_intent(self, image, clicked_label: str, nearby_labels: List[str],
+                           search_mode: Optional[str] = None, image_key: Optional[str] = None) -> List[RippleIntent]:
+        """
+        Step 2: 意图推理 (Cached Inference with Web Search)
+        根据点击的物体，结合互联网资源，生成 Ripple Menu 选项。
         
-        Guidelines:
-        - **User-first thinking**: Start with "What would a user want?" not "What features can I show?"
-        - **Natural intentions**: Common user intentions include:
-          * "I want to change how this looks" → edit action
-          * "I want to know more about this" → info action
-          * "I want to buy/find this" → search/navigate action (for products, naturally include eBay)
-          * "I want to remove this" → edit action
-          * "I want to see similar items" → search action
-        - **Product context**: If '{clicked_label}' is a product (clothing, shoes, bags, accessories), 
-          users naturally want to: find where to buy it, see prices, compare options → provide eBay search naturally
-        - **Creative possibilities**: Users also enjoy creative exploration → include 1-2 creative editing options
-        - **Balance**: Mix practical and creative intentions based on what real users would want
-        - **Web context**: If search results are provided, use them to inform realistic user intentions
+        Args:
+            search_mode: 网络搜索与模型调用的编排方式（默认读取 INTENT_SEARCH_MODE）
+                - sequential: 先搜索，搜索结果加入 prompt 后再调用模型（延迟 = SERP + LLM）
+                - parallel: 模型调用立即开始，搜索结果在模型返回后用于补全 action_data（延迟 = max(SERP, LLM)）
+                - deadline: 搜索最多等待 SERP_DEADLINE_SECONDS 秒，按时返回则加入 prompt，否则丢弃
+            image_key: 图片内容指纹；提供时，对同一图片中同一物体的并发推理只执行一次
         """
+        mode = (search_mode or INTENT_SEARCH_MODE).lower()
+        if image_key is None:
+            return await self._infer_intent(image, clicked_label, nearby_labels, mode)
+        key = ("infer", intent_cache_key(clicked_label, nearby_labels, image_key), mode)
+        intents = await self._flights.do(
+            key, lambda: self._infer_intent(image, clicked_label, nearby_labels, mode, image_key)
+        )
+        return [intent.model_copy(deep=True) for intent in intents]
+
+    async def _infer_intent(self, image, clicked_label: str, nearby_labels: List[str],
+                            mode: str, image_key: Optional[str] = None) -> List[RippleIntent]:
+        is_product = self._is_product(clicked_label)
+        web_context, web_results, search_task = await self._start_search(
+            clicked_label, nearby_labels, is_product, mode
+        )
+        prompt = build_intent_prompt(clicked_label, nearby_labels, web_context, web_results)
         
         try:
-            if USE_NEW_SDK:
-                response = client.models.generate_content(
-                    model=self.model_name,
-                    contents=[prompt, image],
-                    config=types.GenerateContentConfig(
-                        temperature=0.7,  # 稍微提高温度以利用网络搜索结果
-                        thinking_config=types.ThinkingConfig(thinking_budget=0)
-                    )
+            contents, config, cached = await self._intent_request(image, image_key, prompt)
+            try:
+                response = await self.model_client.generate_content(
+                    self.model_name, contents, config=config, hedge=True
+                )
+            except UpstreamUnavailable:
+                raise
+            except Exception as e:
+                if not cached:
+                    raise
+                # 缓存可能已过期或被删除：丢弃后发送完整内容重试一次
+                logger.warning("⚠️ Cached intent request failed, retrying without context cache: %s", e)
+                self.context_cache.invalidate(self.model_name, prompt_variant(), image_key)
+                contents, config, _ = await self._intent_request(image, image_key, prompt, use_cache=False)
+                response = await self.model_client.generate_content(
+                    self.model_name, contents, config=config, hedge=True
                 )
-            else:
-                response = self.model.generate_content([prompt, image]) 
             
-            json_str = clean_json_string(response.text)
-            data = json.loads(json_str)
+            # 并行模式：模型返回后再合并搜索结果
+            fill_missing = search_task is not None
+            if search_task is not None:
+                _, web_results = await search_task
             
-            intents = []
-            for item in data:
-                # 如果 AI 没有生成 action_type，根据 editor_prompt 推断
-                if "action_type" not in item:
-                    item["action_type"] = "edit" if item.get("editor_prompt") else "info"
-                
-                # 如果 action_type 是 navigate/search 但没有 action_data，尝试从 web_results 填充
-                if item["action_type"] in ["navigate", "search"] and not item.get("action_data"):
-                    if web_results:
-                        # 对于商品，如果是搜索类型，优先使用 eBay 搜索格式
-                        if is_product and item["action_type"] == "search":
-                            item["action_data"] = {
-                                "search_query": f"{clicked_label} site:ebay.com",
-                                "search_engine": "ebay",
-                                "title": f"Search {clicked_label} on eBay"
-                            }
-                        else:
-                            # 使用第一个搜索结果作为默认链接
-                            item["action_data"] = {
-                                "url": web_results[0].get("link", ""),
-                                "title": web_results[0].get("title", ""),
-                                "search_query": f"{clicked_label} {item['label']}"
-                            }
-                
-                # 如果 action_type 是 info 但没有 action_data，从 web_results 填充信息
-                if item["action_type"] == "info" and not item.get("action_data"):
-                    if web_results:
-                        item["action_data"] = {
-                            "info_text": web_results[0].get("snippet", ""),
-                            "source_url": web_results[0].get("link", "")
-                        }
-                
-                intents.append(RippleIntent(**item))
-            return intents
+            return self._parse_intents(response.text, clicked_label, is_product, web_results, fill_missing)
+        except UpstreamUnavailable as e:
+            if search_task is not None:
+                _, web_results = await search_task
+            raise DegradedResult(self._fallback_intents(clicked_label, is_product, web_results), e)
         except Exception as e:
-            print(f"Inference Error: {e}")
+            logger.error("Inference Error: %s", e, exc_info=True)
             return []
+        finally:
+            if search_task is not None and not search_task.done():
+                search_task.cancel()
+
+    @staticmethod
+    def _fallback_intents(clicked_label: str, is_product: bool, web_results: List[dict]) -> List[RippleIntent]:
+        """模型不可用时的降级意图：只使用搜索结果和物体标签，不包含需要模型的编辑操作"""
+        FALLBACKS.inc(kind="intents")
+        logger.warning("⚠️ Model unavailable, serving fallback intents for %s", clicked_label)
+        items = []
+        if is_product:
+            items.append({
+                "label": "Find on eBay", "emoji": "🛒", "description": f"Search eBay for {clicked_label}",
+                "color": "#10B981", "probability": 0.8, "action_type": "search",
+                "action_data": {"search_query": f"{clicked_label} site:ebay.com", "search_engine": "ebay"},
+            })
+        if web_results:
+            top = web_results[0]
+            items.append({
+                "label": "Learn more", "emoji": "ℹ️", "description": top.get("title", ""),
+                "color": "#8B5CF6", "probability": 0.7, "action_type": "info",
+                "action_data": {"info_text": top.get("snippet", ""), "source_url": top.get("link", "")},
+            })
+            items.extend({
+                "label": (result.get("title") or "Open link")[:32], "emoji": "🔗", "description": result.get("snippet", ""),
+                "color": "#22C55E", "probability": 0.5, "action_type": "navigate",
+                "action_data": {"url": result.get("link", ""), "title": result.get("title", "")},
+            } for result in web_results[:2])
+        items.append({
+            "label": "Search the web", "emoji": "🔍", "description": f"Search for {clicked_label}",
+            "color": "#3B82F6", "probability": 0.4, "action_type": "search",
+            "action_data": {"search_query": clicked_label},
+        })
+        return [RippleIntent(id=i, **item) for i, item in enumerate(items, 1)]
+
+    async def _start_search(self, clicked_label: str, nearby_labels: List[str], is_product: bool,
+                            mode: str) -> Tuple[str, List[dict], Optional[asyncio.Task]]:
+        """
+        按编排方式启动网络搜索
+
+        Returns:
+            (web_context, web_results, search_task)；parallel 模式下搜索仍在进行，
+            结果由调用方在模型返回后从 search_task 获取，其他模式下 search_task 为 None
+        """
+        if not (self.enable_web_search and self.serp_service):
+            return "", [], None
+        logger.info("🌐 Searching web for: %s%s [mode=%s]", clicked_label, " (product)" if is_product else "", mode)
+        search_task = asyncio.create_task(self.serp_service.search_related_actions(
+            clicked_label, 
+            nearby_labels,
+            is_product=is_product
+        ))
+        if mode == "parallel":
+            return "", [], search_task
+        if mode == "deadline":
+            done, _ = await asyncio.wait({search_task}, timeout=SERP_DEADLINE_SECONDS)
+            if search_task in done and search_task.exception() is None:
+                web_context, web_results = search_task.result()
+                return web_context, web_results, None
+            logger.info("⏱️ Web search missed the %ss deadline, continuing without it", SERP_DEADLINE_SECONDS)
+            search_task.cancel()
+            return "", [], None
+        web_context, web_results = await search_task
+        return web_context, web_results, None
+
+    @staticmethod
+    def _intent_config(system_instruction: Optional[str] = None, cached_content: Optional[str] = None):
+        """意图推理的生成配置；使用上下文缓存时系统指令已在缓存中，不能重复设置"""
+        if not USE_NEW_SDK:
+            return None
+        return types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            cached_content=cached_content,
+            temperature=0.7,  # 稍微提高温度以利用网络搜索结果
+            thinking_config=types.ThinkingConfig(thinking_budget=0)
+        )
 
-    async def execute_edit(self, image, prompt: str, box_2d: List[int], enable_image_edit: bool = True):
+    async def infer_intent_stream(self, image, clicked_label: str, nearby_labels: List[str],
+                                  search_mode: Optional[str] = None,
+                                  image_key: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        流式意图推理：模型输出中每个意图对象闭合时立即返回，结束后重新解析完整输出进行校验
+
+        Yields:
+            ("intent", RippleIntent)：逐个返回的意图
+            ("done", List[RippleIntent])：最终校验后的完整意图列表（解析失败时为已返回的意图）
+            ("degraded", List[RippleIntent])：模型不可用或流中断时代替 done，内容为降级意图或已返回的部分意图（不应缓存）
+        """
+        mode = (search_mode or INTENT_SEARCH_MODE).lower()
+        is_product = self._is_product(clicked_label)
+        web_context, web_results, search_task = await self._start_search(
+            clicked_label, nearby_labels, is_product, mode
+        )
+        prompt = build_intent_prompt(clicked_label, nearby_labels, web_context, web_results)
+        
+        streamed: List[RippleIntent] = []
+        chunks: List[str] = []
+        parser = JsonArrayStream()
+        try:
+            try:
+                use_cache = True
+                while True:
+                    contents, config, cached = await self._intent_request(image, image_key, prompt, use_cache)
+                    try:
+                        async for text in self.model_client.generate_content_stream(
+                            self.model_name, contents, config=config
+                        ):
+                            chunks.append(text)
+                            # 并行模式：搜索已完成时立即用其结果补全，否则留到最终列表中补全
+                            if search_task is not None and search_task.done() and not search_task.cancelled() \
+                                    and search_task.exception() is None:
+                                _, web_results = search_task.result()
+                            for item in parser.feed(text):
+                                try:
+                                    intent = self._complete_intent(item, clicked_label, is_product, web_results,
+                                                                   search_task is not None)
+                                except Exception as e:
+                                    logger.warning("⚠️ Skipping invalid streamed intent: %s", e)
+                                    continue
+                                streamed.append(intent)
+                                yield "intent", intent
+                        break
+                    except UpstreamUnavailable:
+                        raise
+                    except Exception as e:
+                        # 只在还没有收到任何输出时去掉上下文缓存重试
+                        if not cached or chunks:
+                            raise
+                        logger.warning("⚠️ Cached intent stream failed, retrying without context cache: %s", e)
+                        self.context_cache.invalidate(self.model_name, prompt_variant(), image_key)
+                        use_cache = False
+            except Exception as e:
+                if not (isinstance(e, UpstreamUnavailable) or is_transient(e)):
+                    raise
+                if search_task is not None:
+                    _, web_results = await search_task
+                if streamed:
+                    # 流中途断开：已返回的意图作为部分结果
+                    logger.warning("⚠️ Intent stream interrupted after %d intents: %s", len(streamed), e)
+                    FALLBACKS.inc(kind="intents_partial")
+                    yield "degraded", streamed
+                    return
+                intents = self._fallback_intents(clicked_label, is_product, web_results)
+                for intent in intents:
+                    yield "intent", intent
+                yield "degraded", intents
+                return
+            
+            fill_missing = search_task is not None
+            if search_task is not None:
+                _, web_results = await search_task
+            try:
+                intents = self._parse_intents("".join(chunks), clicked_label, is_product, web_results, fill_missing)
+            except Exception as e:
+                logger.warning("⚠️ Final intent validation failed, using streamed intents: %s", e)
+                intents = streamed
+            yield "done", intents
+        finally:
+            if search_task is not None and not search_task.done():
+                search_task.cancel()
+
+    async def execute_edit(self, image, prompt: str, box_2d: List[int], enable_image_edit: bool = True,
+                           edit_mode: Optional[str] = None):
         """
         Step 3: 执行图像编辑 (Gemini Image Editing)
         使用 Gemini API 进行图像编辑，返回处理后的图片。
@@ -271,16 +564,44 @@ class AIService:
             prompt: 编辑提示词
             box_2d: 目标区域 [y0, x0, y1, x1]
             enable_image_edit: 是否启用真实的图像编辑（False 时返回原图）
+            edit_mode: 编辑模式（默认读取 EDIT_MODE）
+                - full: 发送整张图片，用返回结果替换原图
+                - region: 只发送目标框及周围边距的裁剪图，结果缩放回原尺寸后羽化融合进原图
         """
-        print(f"⚡️ Calling Gemini Image Edit with prompt: {prompt}")
-        print(f"📍 Target Region: {box_2d}")
-        print(f"🔄 Image Edit Enabled: {enable_image_edit}")
+        mode = (edit_mode or EDIT_MODE).lower()
+        logger.info("⚡️ Calling Gemini Image Edit with prompt: %s", prompt,
+                    extra={"box_2d": box_2d, "edit_enabled": enable_image_edit, "mode": mode})
         
         if not enable_image_edit:
             # 如果禁用图像编辑，返回原图（用于测试或演示）
-            print("⚠️ Image editing is disabled, returning original image")
+            logger.info("⚠️ Image editing is disabled, returning original image")
             return image
         
+        if mode != "region":
+            edited = await self._edit_image(image, prompt, box_2d)
+            if edited is not image and (edited.size != image.size or edited.mode != image.mode):
+                # 输入图片被缩小过，或模型返回了不同的尺寸/模式：转换回原图的尺寸和模式，
+                # 保持已识别物体的坐标有效，编辑历史也只需保存实际变化的区域
+                edited = await self.model_client.run_sync(match_image, edited, image)
+            return edited
+        
+        # 局部编辑：只把目标区域（含上下文边距）发给模型
+        crop_box, inner_box, feather = edit_region(
+            box_2d, image.width, image.height, margin_ratio=EDIT_REGION_MARGIN
+        )
+        crop = image.crop(crop_box)
+        logger.info("✂️ Region edit: crop %s (%dx%d of %dx%d)", crop_box, crop.width, crop.height, image.width, image.height)
+        edited_crop = await self._edit_image(crop, prompt, inner_box)
+        if edited_crop is crop:
+            # 编辑失败，返回原图
+            return image
+        with span("image_composite"):
+            return await self.model_client.run_sync(
+                composite_region, image, edited_crop, crop_box, inner_box, feather
+            )
+
+    async def _edit_image(self, image, prompt: str, box_2d: List[int]):
+        """调用图像编辑模型编辑 image 中 box_2d 区域，失败时原样返回 image（上游不可用时抛出 UpstreamUnavailable）"""
         try:
             # 构建编辑提示词，包含区域信息
             width, height = image.size
@@ -303,33 +624,34 @@ Keep the rest of the image unchanged. Return the edited image."""
             # 根据官方文档，使用 gemini-2.5-flash-image 模型进行图像编辑
             # 官方示例使用 [text_input, image_input] 或 [image_input, text_input]
             # 使用 response_modalities=['Image'] 确保只返回图片，不返回文本
+            # 旧 SDK 也使用相同的顺序：文本在前，图片在后
+            config = None
             if USE_NEW_SDK:
-                response = client.models.generate_content(
-                    model=self.image_edit_model_name,
-                    contents=[full_prompt, image],  # 按照官方示例：文本在前，图片在后
-                    config=types.GenerateContentConfig(
-                        response_modalities=['Image'],  # 只返回图片，不返回文本
-                        # image_config=types.ImageConfig(
-                        #     aspect_ratio="16:9",  # 可选：控制输出图片的显示比例
-                        # ),
-                    )
+                config = types.GenerateContentConfig(
+                    response_modalities=['Image'],  # 只返回图片，不返回文本
+                    # image_config=types.ImageConfig(
+                    #     aspect_ratio="16:9",  # 可选：控制输出图片的显示比例
+                    # ),
                 )
-            else:
-                # 旧 SDK 也尝试使用相同的顺序
-                response = self.image_edit_model.generate_content([full_prompt, image])
+            model_image = await self.prepare_image(image, EDIT_MAX_EDGE)
+            response = await self.model_client.generate_content(
+                self.image_edit_model_name,
+                [full_prompt, model_image],  # 按照官方示例：文本在前，图片在后
+                config=config
+            )
             
             # 检查响应是否有效
             if not response:
-                print("⚠️ Empty response from API")
+                logger.warning("⚠️ Empty response from API")
                 return image
             
             # 检查 candidates（响应可能被安全策略阻止）
             if hasattr(response, 'candidates'):
                 if not response.candidates or len(response.candidates) == 0:
-                    print("⚠️ No candidates in response (may be blocked by safety settings)")
+                    logger.warning("⚠️ No candidates in response (may be blocked by safety settings)")
                     # 检查是否有阻止原因
                     if hasattr(response, 'prompt_feedback'):
-                        print(f"📋 Prompt feedback: {response.prompt_feedback}")
+                        logger.warning("📋 Prompt feedback: %s", response.prompt_feedback)
                     return image
             
             # 从响应中提取图片（按照官方文档的方式）
@@ -339,33 +661,34 @@ Keep the rest of the image unchanged. Return the edited image."""
                     for part in response.parts:
                         # 方法1: 检查文本响应
                         if hasattr(part, 'text') and part.text is not None:
-                            print(f"📝 Response text: {part.text}")
+                            logger.debug("📝 Response text: %s", part.text)
                         
                         # 方法2: 检查 inline_data 并使用 as_image()（官方推荐方式）
                         # 根据官方文档：https://ai.google.dev/gemini-api/docs/image-generation
                         # part.as_image() 返回的对象可以直接调用 save() 方法
                         elif hasattr(part, 'inline_data') and part.inline_data is not None:
                             # 先打印 inline_data 的结构用于调试
-                            print(f"📋 inline_data type: {type(part.inline_data)}")
-                            print(f"📋 inline_data attributes: {[attr for attr in dir(part.inline_data) if not attr.startswith('_')]}")
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug("📋 inline_data type: %s, attributes: %s", type(part.inline_data),
+                                             [attr for attr in dir(part.inline_data) if not attr.startswith('_')])
                             
                             try:
                                 # 方法1: 尝试直接使用 as_image()（官方推荐）
                                 edited_image = part.as_image()
-                                print(f"📋 as_image() returned type: {type(edited_image)}")
+                                logger.debug("📋 as_image() returned type: %s", type(edited_image))
                                 if edited_image:
                                     # 检查是否是 PIL Image
                                     if isinstance(edited_image, Image.Image):
                                         if edited_image.mode != 'RGB':
                                             edited_image = edited_image.convert('RGB')
-                                        print("✅ Image editing successful (from part.as_image() - PIL Image)")
+                                        logger.info("✅ Image editing successful (from part.as_image() - PIL Image)")
                                         return edited_image
                                     else:
-                                        print(f"⚠️ as_image() returned non-PIL type: {type(edited_image)}")
+                                        logger.warning("⚠️ as_image() returned non-PIL type: %s", type(edited_image))
                                         # 如果不是 PIL Image，尝试其他方法
                                         raise ValueError(f"as_image() returned non-PIL type: {type(edited_image)}")
                             except Exception as e:
-                                print(f"⚠️ Error using as_image(): {e}")
+                                logger.warning("⚠️ Error using as_image(): %s", e)
                                 
                             # 方法2: 尝试从 inline_data 手动解码
                             try:
@@ -375,7 +698,7 @@ Keep the rest of the image unchanged. Return the edited image."""
                                 # 方式1: 直接访问 data 属性
                                 if hasattr(part.inline_data, 'data'):
                                     data_attr = part.inline_data.data
-                                    print(f"📋 inline_data.data type: {type(data_attr)}")
+                                    logger.debug("📋 inline_data.data type: %s", type(data_attr))
                                     if isinstance(data_attr, str):
                                         # 如果是字符串，尝试 base64 解码
                                         image_data = base64.b64decode(data_attr)
@@ -407,15 +730,13 @@ Keep the rest of the image unchanged. Return the edited image."""
                                     edited_image = Image.open(BytesIO(image_data))
                                     if edited_image.mode != 'RGB':
                                         edited_image = edited_image.convert('RGB')
-                                    print("✅ Image editing successful (from inline_data manual decode)")
+                                    logger.info("✅ Image editing successful (from inline_data manual decode)")
                                     return edited_image
                                 else:
                                     raise ValueError("Could not extract image data from inline_data")
                                     
                             except Exception as e2:
-                                print(f"⚠️ Error in manual decoding: {e2}")
-                                import traceback as tb
-                                tb.print_exc()
+                                logger.warning("⚠️ Error in manual decoding: %s", e2, exc_info=True)
                 
                 # 新 SDK 可能还有其他方式访问图片
                 # 注意：根据官方文档，应该使用 response.parts，而不是 response.images
@@ -423,7 +744,7 @@ Keep the rest of the image unchanged. Return the edited image."""
                 # if USE_NEW_SDK:
                 #     if hasattr(response, 'images') and response.images:
                 #         edited_image = response.images[0]
-                #         print("✅ Image editing successful (from response.images)")
+                #         logger.info("✅ Image editing successful (from response.images)")
                 #         return edited_image
                 
                 # 旧 SDK 的 candidates 方式（向后兼容）
@@ -438,10 +759,10 @@ Keep the rest of the image unchanged. Return the edited image."""
                                     edited_image = Image.open(BytesIO(image_data))
                                     if edited_image.mode != 'RGB':
                                         edited_image = edited_image.convert('RGB')
-                                    print("✅ Image editing successful (from candidate inline_data)")
+                                    logger.info("✅ Image editing successful (from candidate inline_data)")
                                     return edited_image
                                 except Exception as e:
-                                    print(f"⚠️ Error decoding candidate inline_data: {e}")
+                                    logger.warning("⚠️ Error decoding candidate inline_data: %s", e)
                                     # 回退到 as_image()
                                     try:
                                         edited_image = part.as_image()
@@ -454,29 +775,31 @@ Keep the rest of the image unchanged. Return the edited image."""
                                                     edited_image = Image.open(BytesIO(image_data))
                                             if edited_image.mode != 'RGB':
                                                 edited_image = edited_image.convert('RGB')
-                                            print("✅ Image editing successful (from candidate.parts.as_image())")
+                                            logger.info("✅ Image editing successful (from candidate.parts.as_image())")
                                             return edited_image
                                     except Exception as e2:
-                                        print(f"⚠️ Error using candidate as_image(): {e2}")
+                                        logger.warning("⚠️ Error using candidate as_image(): %s", e2)
                     
             except Exception as e:
-                print(f"⚠️ Error parsing response: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.warning("⚠️ Error parsing response: %s", e, exc_info=True)
             
             # 如果没有返回图片，返回原图
-            print("⚠️ No image data in response, returning original image")
-            print(f"📋 Response type: {type(response)}")
-            if hasattr(response, 'text'):
-                print(f"📋 Response text (first 200 chars): {response.text[:200]}")
-            if hasattr(response, 'parts'):
-                print(f"📋 Response has {len(response.parts)} parts")
-                for i, part in enumerate(response.parts):
-                    print(f"📋 Part {i} attributes: {[attr for attr in dir(part) if not attr.startswith('_')]}")
+            logger.warning("⚠️ No image data in response, returning original image")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📋 Response type: %s", type(response))
+                if hasattr(response, 'text'):
+                    logger.debug("📋 Response text (first 200 chars): %s", (response.text or "")[:200])
+                if hasattr(response, 'parts'):
+                    logger.debug("📋 Response has %d parts", len(response.parts))
+                    for i, part in enumerate(response.parts):
+                        logger.debug("📋 Part %d attributes: %s", i, [attr for attr in dir(part) if not attr.startswith('_')])
             return image
             
+        except UpstreamUnavailable:
+            # 上游不可用：让编辑任务失败，而不是当作编辑成功返回原图
+            raise
         except Exception as e:
-            print(f"❌ Image editing error: {e}")
+            logger.error("❌ Image editing error: %s", e, exc_info=True)
             # 出错时返回原图
             return image
 
@@ -0,0 +1,220 @@
+"""
+场景分析缓存
+按上传图片内容的哈希值缓存 analyze_scene 的结果：
+内存 LRU 作为一级缓存，磁盘 JSON 文件作为二级缓存（重启后仍然有效）。
+精确哈希未命中时，再通过感知哈希查找近似重复图片，并将物体框缩放到新图片尺寸。
+"""
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from typing import List, Optional
+from PIL import Image
+from services.cache import LRUCache
+from services.perceptual_hash import PerceptualIndex, perceptual_hash
+from schemas import DetectedObject
+from services.telemetry import get_logger
+
+logger = get_logger(__name__)
+
+# 磁盘缓存目录（设置为空字符串则只使用内存缓存）
+ANALYSIS_CACHE_DIR = os.getenv(
+    "ANALYSIS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "analysis")
+)
+# 内存中最多缓存的分析结果数量
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "2048"))
+# 是否额外按解码后的像素计算哈希（同一图片以不同元数据/容器重新保存时也能命中）
+ANALYSIS_CACHE_PIXEL_HASH = os.getenv("ANALYSIS_CACHE_PIXEL_HASH", "false").lower() in ("true", "1", "yes", "on")
+# 是否启用感知哈希近似重复查找
+ANALYSIS_CACHE_NEAR_DUPLICATES = os.getenv("ANALYSIS_CACHE_NEAR_DUPLICATES", "true").lower() in ("true", "1", "yes", "on")
+# 分析 prompt 的版本号，修改 prompt 后递增以使旧缓存失效
+ANALYSIS_PROMPT_VERSION = "v1"
+
+
+def hash_bytes(data: bytes) -> str:
+    """计算上传文件原始字节的哈希"""
+    return bytes_key(hashlib.sha256(data).hexdigest())
+
+
+def bytes_key(sha256_hex: str) -> str:
+    """由已计算好的 SHA-256 摘要（例如分块读取上传文件时计算的）生成字节哈希键"""
+    return "b-" + sha256_hex
+
+
+def hash_pixels(image: Image.Image) -> str:
+    """计算解码后像素的哈希（包含尺寸和模式）"""
+    digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return "p-" + digest.hexdigest()
+
+
+def rescale_objects(objects: List[DetectedObject], from_size: tuple, to_size: tuple) -> List[DetectedObject]:
+    """将物体框从原图尺寸 (宽, 高) 等比例映射到新图片尺寸"""
+    from_width, from_height = from_size
+    to_width, to_height = to_size
+    if (from_width, from_height) == (to_width, to_height):
+        return objects
+    scale_x = to_width / from_width
+    scale_y = to_height / from_height
+    results = []
+    for obj in objects:
+        y0, x0, y1, x1 = obj.box_2d
+        box = [int(y0 * scale_y), int(x0 * scale_x), int(y1 * scale_y), int(x1 * scale_x)]
+        center = ((box[1] + box[3]) // 2, (box[0] + box[2]) // 2)
+        results.append(obj.model_copy(update={"box_2d": box, "center": center}))
+    return results
+
+
+class AnalysisCache:
+    """内容寻址的场景分析缓存（内存 LRU + 磁盘持久化）"""
+
+    def __init__(self, namespace: str, cache_dir: Optional[str] = None, maxsize: Optional[int] = None,
+                 near_duplicates: Optional[bool] = None):
+        """
+        初始化分析缓存
+
+        Args:
+            namespace: 缓存命名空间（通常为模型名 + prompt 版本），不同命名空间互不影响
+            cache_dir: 磁盘缓存目录，为空字符串时禁用磁盘缓存
+            maxsize: 内存缓存条目上限
+            near_duplicates: 是否启用感知哈希近似重复查找
+        """
+        self.namespace = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in namespace)
+        base_dir = ANALYSIS_CACHE_DIR if cache_dir is None else cache_dir
+        self.cache_dir = os.path.join(base_dir, self.namespace) if base_dir else ""
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._memory = LRUCache(maxsize=maxsize if maxsize is not None else ANALYSIS_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.near_duplicate_hits = 0
+        self.misses = 0
+
+        use_index = ANALYSIS_CACHE_NEAR_DUPLICATES if near_duplicates is None else near_duplicates
+        self.perceptual_index = None
+        if use_index:
+            index_path = os.path.join(self.cache_dir, "perceptual_index.jsonl") if self.cache_dir else None
+            # 没有磁盘缓存时，被内存 LRU 淘汰的结果无法再命中，索引条目数不超过内存缓存容量
+            max_entries = None if self.cache_dir else self._memory.maxsize
+            self.perceptual_index = PerceptualIndex(index_path=index_path, max_entries=max_entries)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:4], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[dict]:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, entry: dict):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子替换，避免多个 worker 读到写了一半的文件
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("⚠️ Analysis cache write error: %s", e)
+
+    def _lookup(self, key: str) -> tuple:
+        """先查内存再查磁盘，返回 (条目, 是否来自磁盘)"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            return entry, False
+        entry = self._read_disk(key)
+        if entry is not None:
+            self._memory.set(key, entry)
+            return entry, True
+        return None, False
+
+    def get(self, *keys: str, image: Optional[Image.Image] = None,
+            phash: Optional[int] = None) -> Optional[List[DetectedObject]]:
+        """
+        按顺序查找多个键（例如字节哈希、像素哈希），返回第一个命中的结果；
+        都未命中且提供了图片时，再按感知哈希查找近似重复图片
+
+        Args:
+            keys: 精确内容哈希
+            image: 当前图片（用于计算感知哈希和缩放物体框）
+            phash: 预先计算好的感知哈希
+
+        Returns:
+            缓存的物体列表（坐标已对应当前图片尺寸），未命中时返回 None
+        """
+        for key in keys:
+            if not key:
+                continue
+            entry, from_disk = self._lookup(key)
+            if entry is not None:
+                with self._lock:
+                    if from_disk:
+                        self.disk_hits += 1
+                    else:
+                        self.memory_hits += 1
+                objects = [DetectedObject(**item) for item in entry["objects"]]
+                if image is not None and (entry["width"], entry["height"]) != image.size:
+                    # 同一文件以不同分辨率解码（例如 UPLOAD_MAX_EDGE 改变），将物体框映射到当前尺寸
+                    return rescale_objects(objects, (entry["width"], entry["height"]), image.size)
+                return objects
+
+        if image is not None and self.perceptual_index is not None:
+            value = phash if phash is not None else perceptual_hash(image)
+            match = self.perceptual_index.find(value, image.width, image.height)
+            if match is not None:
+                key, cached_width, cached_height, distance = match
+                entry, _ = self._lookup(key)
+                if entry is not None:
+                    with self._lock:
+                        self.near_duplicate_hits += 1
+                    logger.info("🔁 Near-duplicate analysis hit (distance=%d, %dx%d -> %dx%d)",
+                                distance, cached_width, cached_height, image.width, image.height)
+                    objects = [DetectedObject(**item) for item in entry["objects"]]
+                    return rescale_objects(objects, (entry["width"], entry["height"]), image.size)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, keys: List[str], objects: List[DetectedObject], width: int, height: int,
+            image: Optional[Image.Image] = None, phash: Optional[int] = None):
+        """将分析结果写入所有给定的键，并把图片加入感知哈希索引"""
+        entry = {
+            "width": width,
+            "height": height,
+            "objects": [obj.model_dump() for obj in objects],
+        }
+        keys = [key for key in keys if key]
+        for key in keys:
+            self._memory.set(key, entry)
+            self._write_disk(key, entry)
+
+        if keys and self.perceptual_index is not None and (image is not None or phash is not None):
+            value = phash if phash is not None else perceptual_hash(image)
+            self.perceptual_index.add(value, keys[0], width, height)
+
+    def stats(self) -> dict:
+        """返回命中/未命中计数"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits + self.near_duplicate_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "near_duplicate_hits": self.near_duplicate_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 4) if total else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_enabled": bool(self.cache_dir),
+                "perceptual_index_entries": len(self.perceptual_index) if self.perceptual_index is not None else 0,
+            }
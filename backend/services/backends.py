@@ -0,0 +1,621 @@
+"""
+可替换的模型与 SERP 后端
+用于在不消耗 API 配额的情况下进行基准测试和离线开发：
+- synthetic: 按可配置的延迟分布返回确定性的模拟结果（物体框、意图、编辑后的图片、搜索结果）
+- record: 调用真实后端，同时把请求与响应记录到 JSONL 文件
+- replay: 从录制文件中按请求内容查找并返回响应（可选按录制时的耗时等待）
+
+通过 MODEL_BACKEND（gemini | synthetic | record | replay）和
+SERP_BACKEND（serpapi | synthetic | record | replay）选择。
+"""
+import os
+import json
+import math
+import base64
+import random
+import asyncio
+import hashlib
+import threading
+import time
+from io import BytesIO
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+from services.telemetry import get_logger
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+# 模型后端: gemini | synthetic | record | replay
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+# SERP 后端: serpapi | synthetic | record | replay
+SERP_BACKEND = os.getenv("SERP_BACKEND", "serpapi").lower()
+# 录制文件路径（record 写入，replay 读取）
+_RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "recordings")
+MODEL_RECORDINGS_PATH = os.getenv("MODEL_RECORDINGS_PATH", os.path.join(_RECORDINGS_DIR, "model.jsonl"))
+SERP_RECORDINGS_PATH = os.getenv("SERP_RECORDINGS_PATH", os.path.join(_RECORDINGS_DIR, "serp.jsonl"))
+# replay 时是否按录制时的耗时等待
+REPLAY_LATENCY = os.getenv("REPLAY_LATENCY", "false").lower() in ("true", "1", "yes", "on")
+# synthetic 后端的延迟分布（毫秒），格式见 LatencyModel.parse
+SYNTHETIC_LATENCY_ANALYZE = os.getenv("SYNTHETIC_LATENCY_ANALYZE", "lognormal:1500,0.3")
+SYNTHETIC_LATENCY_INFER = os.getenv("SYNTHETIC_LATENCY_INFER", "lognormal:1200,0.3")
+SYNTHETIC_LATENCY_EDIT = os.getenv("SYNTHETIC_LATENCY_EDIT", "lognormal:6000,0.3")
+SYNTHETIC_LATENCY_SERP = os.getenv("SYNTHETIC_LATENCY_SERP", "lognormal:600,0.4")
+# synthetic 后端的随机种子（延迟序列与模拟结果都由它决定）
+SYNTHETIC_SEED = int(os.getenv("SYNTHETIC_SEED", "0"))
+# 自定义模拟结果的 JSON 文件：{"analyze": [...], "infer": [...], "serp": [...]}，缺省的部分使用内置结果
+SYNTHETIC_FIXTURES_PATH = os.getenv("SYNTHETIC_FIXTURES_PATH", "")
+
+_SYNTHETIC_LABELS = [
+    "Window", "Door", "Chair", "Table", "Lamp", "Sofa", "Plant", "Poster",
+    "Vending Machine", "Bicycle", "Dress", "Shoes", "Bag", "Phone Booth", "Sign", "Car",
+]
+
+_SYNTHETIC_INTENTS = [
+    {"id": 1, "label": "Recolor", "emoji": "🎨", "description": "Change the color", "color": "#3B82F6",
+     "probability": 0.8, "action_type": "edit", "editor_prompt": "Change the color to a warm red"},
+    {"id": 2, "label": "Remove", "emoji": "🧽", "description": "Remove it from the scene", "color": "#EF4444",
+     "probability": 0.6, "action_type": "edit", "editor_prompt": "Remove the object and fill the background"},
+    {"id": 3, "label": "Learn more", "emoji": "ℹ️", "description": "Read about it", "color": "#10B981",
+     "probability": 0.5, "action_type": "info", "action_data": {}},
+    {"id": 4, "label": "Shop", "emoji": "🛒", "description": "Find similar items", "color": "#F59E0B",
+     "probability": 0.4, "action_type": "search", "action_data": {}},
+    {"id": 5, "label": "Restyle", "emoji": "✨", "description": "Make it look vintage", "color": "#8B5CF6",
+     "probability": 0.3, "action_type": "edit", "editor_prompt": "Give it a vintage look"},
+]
+
+
+class LatencyModel:
+    """延迟分布（毫秒），sample() 返回秒"""
+
+    def __init__(self, kind: str, params: List[float]):
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        """
+        解析延迟分布描述：
+            "0" / "fixed:200"           固定延迟
+            "uniform:100,300"           均匀分布
+            "normal:800,200"            正态分布（均值, 标准差），截断到 0 以上
+            "lognormal:800,0.4"         对数正态分布（中位数, sigma），接近真实 API 的长尾
+        """
+        spec = (spec or "0").strip()
+        kind, _, args = spec.partition(":")
+        if not args:
+            kind, args = "fixed", kind
+        params = [float(value) for value in args.split(",") if value.strip()]
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        return cls(kind, params)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            ms = self.params[0] if self.params else 0.0
+        elif self.kind == "uniform":
+            ms = rng.uniform(self.params[0], self.params[1])
+        elif self.kind == "normal":
+            ms = rng.gauss(self.params[0], self.params[1])
+        else:
+            ms = self.params[0] * math.exp(rng.gauss(0.0, self.params[1]))
+        return max(0.0, ms) / 1000.0
+
+
+# ----------------------
+# 请求内容处理
+# ----------------------
+
+def _image_bytes(part: Any) -> Optional[bytes]:
+    """取出 contents 中图片的字节（新 SDK 的 Part、旧 SDK 的 dict 或 PIL Image）"""
+    if isinstance(part, Image.Image):
+        return f"{part.mode}:{part.size}".encode() + part.tobytes()
+    if isinstance(part, dict) and "data" in part:
+        return part["data"]
+    inline_data = getattr(part, "inline_data", None)
+    if inline_data is not None and getattr(inline_data, "data", None) is not None:
+        return inline_data.data
+    return None
+
+
+def _split_contents(contents: List[Any]) -> Tuple[str, List[Any]]:
+    """将 contents 拆分为 (拼接后的文本, 图片列表)"""
+    texts, images = [], []
+    for part in contents:
+        if isinstance(part, str):
+            texts.append(part)
+        elif getattr(part, "text", None):
+            texts.append(part.text)
+        else:
+            images.append(part)
+    return "\n".join(texts), images
+
+
+def _with_system(contents: List[Any], config: Any) -> List[Any]:
+    """把 config 中的系统指令并入 contents，使请求键和用量估算也覆盖系统指令"""
+    system_instruction = getattr(config, "system_instruction", None)
+    if isinstance(system_instruction, str) and system_instruction:
+        return [system_instruction, *contents]
+    return contents
+
+
+def request_key(model: str, contents: List[Any]) -> str:
+    """按模型、提示词和图片内容计算请求键（录制与回放使用同一个键）"""
+    text, images = _split_contents(contents)
+    digest = hashlib.sha256(f"{model}\n{text}".encode())
+    for image in images:
+        data = _image_bytes(image)
+        if data is not None:
+            digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+def _to_pil(part: Any) -> Optional[Image.Image]:
+    if isinstance(part, Image.Image):
+        return part
+    data = _image_bytes(part)
+    if data is None:
+        return None
+    return Image.open(BytesIO(data)).convert("RGB")
+
+
+# ----------------------
+# 模拟响应对象（与 SDK 响应中被用到的属性一致）
+# ----------------------
+
+class _InlineData:
+    def __init__(self, data: bytes, mime_type: str = "image/png"):
+        self.data = data
+        self.mime_type = mime_type
+
+
+class _Part:
+    def __init__(self, text: Optional[str] = None, image: Optional[Image.Image] = None):
+        self.text = text
+        self._image = image
+        self.inline_data = None
+        if image is not None:
+            buffered = BytesIO()
+            image.save(buffered, format="PNG", compress_level=1)
+            self.inline_data = _InlineData(buffered.getvalue())
+
+    def as_image(self) -> Optional[Image.Image]:
+        return self._image
+
+
+class _Content:
+    def __init__(self, parts: List[_Part]):
+        self.parts = parts
+
+
+class _Candidate:
+    def __init__(self, parts: List[_Part]):
+        self.content = _Content(parts)
+
+
+class UsageMetadata:
+    """与 SDK 的 usage_metadata 字段相同的 token 用量"""
+
+    def __init__(self, prompt_token_count: int = 0, candidates_token_count: int = 0,
+                 cached_content_token_count: int = 0, thoughts_token_count: int = 0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.thoughts_token_count = thoughts_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count + thoughts_token_count
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def _usage_metadata(response: Any) -> Optional[dict]:
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return None
+    return {
+        name: int(getattr(metadata, name, 0) or 0)
+        for name in ("prompt_token_count", "candidates_token_count", "cached_content_token_count", "thoughts_token_count")
+    }
+
+
+class BackendResponse:
+    """synthetic / replay 后端返回的响应（提供 text、parts、candidates、usage_metadata）"""
+
+    def __init__(self, text: Optional[str] = None, images: Optional[List[Image.Image]] = None,
+                 usage_metadata: Optional[UsageMetadata] = None):
+        self.parts = ([_Part(text=text)] if text is not None else []) + [_Part(image=image) for image in images or []]
+        self.candidates = [_Candidate(self.parts)]
+        self.prompt_feedback = None
+        self.usage_metadata = usage_metadata
+        self._text = text
+
+    @property
+    def text(self) -> Optional[str]:
+        return self._text
+
+
+# ----------------------
+# 模型后端
+# ----------------------
+
+def _image_tokens(width: int, height: int) -> int:
+    """按 Gemini 的规则估算图片输入的 token 数（不超过 384px 为 258，否则按 768px 分块每块 258）"""
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+
+def _image_size(part: Any) -> Optional[Tuple[int, int]]:
+    if isinstance(part, Image.Image):
+        return part.size
+    data = _image_bytes(part)
+    if data is None:
+        return None
+    try:
+        return Image.open(BytesIO(data)).size  # 只读取文件头
+    except Exception:
+        return None
+
+
+def estimate_usage(contents: List[Any], text: Optional[str], output_images: int = 0) -> UsageMetadata:
+    """估算一次调用的 token 用量（约 4 个字符一个 token，输出图片按 1290 token 计）"""
+    prompt, images = _split_contents(contents)
+    prompt_tokens = math.ceil(len(prompt) / 4)
+    for image in images:
+        size = _image_size(image)
+        prompt_tokens += _image_tokens(*size) if size else 258
+    return UsageMetadata(prompt_tokens, math.ceil(len(text or "") / 4) + output_images * 1290)
+
+
+def estimate_prompt_tokens(contents: List[Any], config: Any = None) -> int:
+    """估算请求的输入 token 数（包括 config 中的系统指令，用于调用前的配额预扣）"""
+    return estimate_usage(_with_system(contents, config), None).prompt_token_count
+
+
+def _load_fixtures() -> Dict[str, Any]:
+    if not SYNTHETIC_FIXTURES_PATH:
+        return {}
+    with open(SYNTHETIC_FIXTURES_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class SyntheticModelBackend:
+    """模拟模型：按请求类型采样延迟，返回由请求内容决定的确定性结果"""
+
+    def __init__(self, seed: Optional[int] = None, latencies: Optional[Dict[str, str]] = None,
+                 fixtures: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            seed: 随机种子
+            latencies: 各请求类型的延迟分布 {"analyze": ..., "infer": ..., "edit": ...}
+            fixtures: 自定义模拟结果 {"analyze": [...], "infer": [...]}
+        """
+        self.seed = SYNTHETIC_SEED if seed is None else seed
+        latencies = latencies or {}
+        self.latencies = {
+            "analyze": LatencyModel.parse(latencies.get("analyze", SYNTHETIC_LATENCY_ANALYZE)),
+            "infer": LatencyModel.parse(latencies.get("infer", SYNTHETIC_LATENCY_INFER)),
+            "edit": LatencyModel.parse(latencies.get("edit", SYNTHETIC_LATENCY_EDIT)),
+        }
+        self.fixtures = _load_fixtures() if fixtures is None else fixtures
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+        self.calls = {kind: 0 for kind in self.latencies}
+
+    @staticmethod
+    def _kind(model: str, text: str) -> str:
+        if "Detect all significant" in text:
+            return "analyze"
+        if model.endswith("-image") or "Return the edited image" in text:
+            return "edit"
+        return "infer"
+
+    def _latency(self, kind: str) -> float:
+        with self._lock:
+            self.calls[kind] += 1
+            return self.latencies[kind].sample(self._rng)
+
+    def _respond(self, model: str, contents: List[Any], config=None) -> Tuple[str, BackendResponse]:
+        contents = _with_system(contents, config)
+        text, images = _split_contents(contents)
+        kind = self._kind(model, text)
+        rng = random.Random(f"{self.seed}:{request_key(model, contents)}")
+        if kind == "analyze":
+            objects = self.fixtures.get("analyze")
+            if objects is None:
+                objects = []
+                for label in rng.sample(_SYNTHETIC_LABELS, rng.randint(4, 10)):
+                    y0, x0 = rng.randint(0, 800), rng.randint(0, 800)
+                    objects.append({
+                        "label": label,
+                        "box_2d": [y0, x0, rng.randint(y0 + 50, 1000), rng.randint(x0 + 50, 1000)],
+                    })
+            text = json.dumps(objects, ensure_ascii=False)
+            return kind, BackendResponse(text=text, usage_metadata=estimate_usage(contents, text))
+        if kind == "infer":
+            intents = self.fixtures.get("infer") or rng.sample(_SYNTHETIC_INTENTS, rng.randint(4, 5))
+            text = "```json\n" + json.dumps(intents, ensure_ascii=False) + "\n```"
+            return kind, BackendResponse(text=text, usage_metadata=estimate_usage(contents, text))
+        # 编辑：返回与输入同尺寸的图片（反色），响应中的图片数据与 SDK 一样是已编码的 PNG
+        source = _to_pil(images[0]) if images else None
+        edited = ImageOps.invert(source.convert("RGB")) if source is not None else None
+        outputs = [edited] if edited is not None else []
+        return kind, BackendResponse(images=outputs, usage_metadata=estimate_usage(contents, None, len(outputs)))
+
+    async def generate_content(self, model: str, contents: List[Any], config=None) -> BackendResponse:
+        # 请求哈希、图片解码/反色/编码在线程中执行，模拟延迟只由采样的等待时间决定，不占用事件循环
+        kind, response = await asyncio.to_thread(self._respond, model, contents, config)
+        await asyncio.sleep(self._latency(kind))
+        return response
+
+    async def generate_content_stream(self, model: str, contents: List[Any], config=None) -> AsyncIterator[BackendResponse]:
+        kind, response = await asyncio.to_thread(self._respond, model, contents, config)
+        total = self._latency(kind)
+        text = response.text or ""
+        # 首个片段在总延迟的 30% 时到达，其余片段均匀分布；用量随最后一个片段返回（与 SDK 相同）
+        chunks = [text[i:i + 64] for i in range(0, len(text), 64)] or [""]
+        await asyncio.sleep(total * 0.3)
+        for i, chunk in enumerate(chunks):
+            last = i == len(chunks) - 1
+            yield BackendResponse(text=chunk, usage_metadata=response.usage_metadata if last else None)
+            await asyncio.sleep(total * 0.7 / len(chunks))
+
+    def stats(self) -> dict:
+        return {"backend": "synthetic", "calls": dict(self.calls)}
+
+
+class _Recordings:
+    """JSONL 录制文件（按请求键索引，后写入的记录覆盖先前的）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self._entries[entry["key"]] = entry
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._entries.get(key)
+
+    def add(self, entry: dict):
+        with self._lock:
+            self._entries[entry["key"]] = entry
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _response_images(response: Any) -> List[bytes]:
+    images = []
+    for part in getattr(response, "parts", None) or []:
+        inline_data = getattr(part, "inline_data", None)
+        if inline_data is not None and getattr(inline_data, "data", None):
+            data = inline_data.data
+            images.append(base64.b64decode(data) if isinstance(data, str) else data)
+    return images
+
+
+def _response_text(response: Any) -> Optional[str]:
+    try:
+        return response.text
+    except Exception:
+        # 只有图片的响应访问 text 可能抛出异常
+        return None
+
+
+class RecordReplayModelBackend:
+    """录制 / 回放模型后端"""
+
+    def __init__(self, path: str, inner=None, replay_latency: Optional[bool] = None):
+        """
+        Args:
+            path: 录制文件路径
+            inner: 真实后端（录制模式）；为 None 时为回放模式
+            replay_latency: 回放时是否按录制时的耗时等待
+        """
+        self.recordings = _Recordings(path)
+        self.inner = inner
+        self.replay_latency = REPLAY_LATENCY if replay_latency is None else replay_latency
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+
+    def _lookup(self, model: str, contents: List[Any]) -> dict:
+        entry = self.recordings.get(request_key(model, contents))
+        if entry is None:
+            self.misses += 1
+            raise LookupError(f"No recorded response for this {model} request ({self.recordings.path})")
+        self.hits += 1
+        return entry
+
+    def _record(self, model: str, contents: List[Any], text: Optional[str], images: List[bytes], started: float,
+                usage: Optional[dict] = None):
+        self.recordings.add({
+            "key": request_key(model, contents),
+            "model": model,
+            "text": text,
+            "images": [base64.b64encode(data).decode("ascii") for data in images],
+            "latency": round(time.monotonic() - started, 4),
+            "usage": usage,
+        })
+        self.recorded += 1
+
+    async def generate_content(self, model: str, contents: List[Any], config=None):
+        keyed = _with_system(contents, config)
+        if self.inner is not None:
+            started = time.monotonic()
+            response = await self.inner.generate_content(model, contents, config)
+            self._record(model, keyed, _response_text(response), _response_images(response), started,
+                         _usage_metadata(response))
+            return response
+        entry, response = await asyncio.to_thread(self._replay, model, keyed)
+        if self.replay_latency:
+            await asyncio.sleep(entry.get("latency", 0))
+        return response
+
+    def _replay(self, model: str, keyed: List[Any]) -> Tuple[dict, BackendResponse]:
+        """查找录制的响应并重建响应对象（请求哈希与图片解码/编码在线程中执行）"""
+        entry = self._lookup(model, keyed)
+        images = [Image.open(BytesIO(base64.b64decode(data))) for data in entry.get("images", [])]
+        return entry, BackendResponse(text=entry.get("text"), images=images, usage_metadata=self._usage(entry))
+
+    @staticmethod
+    def _usage(entry: dict) -> Optional[UsageMetadata]:
+        return UsageMetadata(**entry["usage"]) if entry.get("usage") else None
+
+    async def generate_content_stream(self, model: str, contents: List[Any], config=None) -> AsyncIterator[Any]:
+        keyed = _with_system(contents, config)
+        if self.inner is not None:
+            started = time.monotonic()
+            texts, usage = [], None
+            async for chunk in self.inner.generate_content_stream(model, contents, config):
+                texts.append(_response_text(chunk) or "")
+                usage = _usage_metadata(chunk) or usage
+                yield chunk
+            self._record(model, keyed, "".join(texts), [], started, usage)
+            return
+        entry = await asyncio.to_thread(self._lookup, model, keyed)
+        if self.replay_latency:
+            await asyncio.sleep(entry.get("latency", 0))
+        yield BackendResponse(text=entry.get("text") or "", usage_metadata=self._usage(entry))
+
+    def stats(self) -> dict:
+        return {
+            "backend": "record" if self.inner is not None else "replay",
+            "recordings": len(self.recordings),
+            "hits": self.hits,
+            "misses": self.misses,
+            "recorded": self.recorded,
+        }
+
+
+def create_model_backend(name: str, sdk_backend_factory: Callable[[], Any]):
+    """
+    按名称创建模型后端
+
+    Args:
+        name: gemini | synthetic | record | replay
+        sdk_backend_factory: 创建真实 SDK 后端的函数（gemini 与 record 使用）
+    """
+    if name == "gemini":
+        return sdk_backend_factory()
+    if name == "synthetic":
+        logger.info("🧪 Using synthetic model backend")
+        return SyntheticModelBackend()
+    if name == "record":
+        logger.info("⏺️ Recording model responses to %s", MODEL_RECORDINGS_PATH)
+        return RecordReplayModelBackend(MODEL_RECORDINGS_PATH, inner=sdk_backend_factory())
+    if name == "replay":
+        logger.info("⏯️ Replaying model responses from %s", MODEL_RECORDINGS_PATH)
+        return RecordReplayModelBackend(MODEL_RECORDINGS_PATH)
+    raise ValueError(f"Unknown MODEL_BACKEND: {name}")
+
+
+# ----------------------
+# SERP 后端（get(params) 返回 SERP API 的原始 JSON）
+# ----------------------
+
+def _serp_key(params: dict) -> str:
+    return json.dumps({k: v for k, v in sorted(params.items()) if k != "api_key"}, ensure_ascii=False)
+
+
+class SyntheticSerpBackend:
+    """模拟 SERP API"""
+
+    requires_api_key = False
+
+    def __init__(self, seed: Optional[int] = None, latency: Optional[str] = None,
+                 fixtures: Optional[Dict[str, Any]] = None):
+        self.seed = SYNTHETIC_SEED if seed is None else seed
+        self.latency = LatencyModel.parse(latency or SYNTHETIC_LATENCY_SERP)
+        self.fixtures = _load_fixtures() if fixtures is None else fixtures
+        self._rng = random.Random(self.seed)
+        self.calls = 0
+
+    async def get(self, params: dict) -> dict:
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample(self._rng))
+        results = self.fixtures.get("serp")
+        if results is None:
+            query = params.get("q", "")
+            slug = hashlib.sha1(query.encode()).hexdigest()[:8]
+            results = [
+                {
+                    "title": f"{query} - result {i + 1}",
+                    "link": f"https://example.com/{slug}/{i + 1}",
+                    "snippet": f"Synthetic search result {i + 1} for {query}.",
+                }
+                for i in range(int(params.get("num", 5)))
+            ]
+        return {"organic_results": results}
+
+    def stats(self) -> dict:
+        return {"backend": "synthetic", "calls": self.calls}
+
+
+class RecordReplaySerpBackend:
+    """录制 / 回放 SERP 响应"""
+
+    def __init__(self, path: str, inner: Optional[Callable[[dict], Awaitable[dict]]] = None,
+                 replay_latency: Optional[bool] = None):
+        self.recordings = _Recordings(path)
+        self.inner = inner
+        self.requires_api_key = inner is not None
+        self.replay_latency = REPLAY_LATENCY if replay_latency is None else replay_latency
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, params: dict) -> dict:
+        key = _serp_key(params)
+        if self.inner is not None:
+            started = time.monotonic()
+            data = await self.inner(params)
+            self.recordings.add({"key": key, "data": data, "latency": round(time.monotonic() - started, 4)})
+            return data
+        entry = self.recordings.get(key)
+        if entry is None:
+            self.misses += 1
+            raise LookupError(f"No recorded SERP response for {params.get('q')!r}")
+        self.hits += 1
+        if self.replay_latency:
+            await asyncio.sleep(entry.get("latency", 0))
+        return entry["data"]
+
+    def stats(self) -> dict:
+        return {
+            "backend": "record" if self.inner is not None else "replay",
+            "recordings": len(self.recordings),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def create_serp_backend(name: str, http_get: Callable[[dict], Awaitable[dict]]):
+    """
+    按名称创建 SERP 后端；serpapi 返回 None（直接使用 HTTP 连接池）
+
+    Args:
+        name: serpapi | synthetic | record | replay
+        http_get: 真实的 SERP API 请求函数（record 使用）
+    """
+    if name == "serpapi":
+        return None
+    if name == "synthetic":
+        logger.info("🧪 Using synthetic SERP backend")
+        return SyntheticSerpBackend()
+    if name == "record":
+        logger.info("⏺️ Recording SERP responses to %s", SERP_RECORDINGS_PATH)
+        return RecordReplaySerpBackend(SERP_RECORDINGS_PATH, inner=http_get)
+    if name == "replay":
+        logger.info("⏯️ Replaying SERP responses from %s", SERP_RECORDINGS_PATH)
+        return RecordReplaySerpBackend(SERP_RECORDINGS_PATH)
+    raise ValueError(f"Unknown SERP_BACKEND: {name}")
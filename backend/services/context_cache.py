@@ -0,0 +1,124 @@
+"""
+模型端上下文缓存
+意图推理的系统指令和会话图片在同一会话的每次点击中都相同，
+开启 CONTEXT_CACHE 后为每个 (模型, 提示词模板, 图片) 创建一次模型端缓存，
+之后的点击只发送动态部分，缓存部分的输入 token 按折扣计价且不需要重新处理。
+
+模型要求缓存内容达到最小 token 数，或后端不支持缓存（旧 SDK、synthetic / replay）时创建会失败，
+此时在 CONTEXT_CACHE_RETRY_SECONDS 内不再尝试，请求照常发送完整内容。
+创建缓存与普通模型调用一样占用配额、受截止时间和熔断约束，上游暂时不可用时只跳过这一次。
+"""
+import os
+from typing import Any, Optional
+from services.cache import LRUCache
+from services.singleflight import SingleFlight
+from services.resilience import UpstreamUnavailable
+from services.telemetry import REGISTRY, get_logger
+
+logger = get_logger(__name__)
+
+# 是否为意图推理创建模型端上下文缓存（缓存按存储时长另行计费，默认关闭）
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "false").lower() in ("true", "1", "yes", "on")
+# 缓存在模型端的保留时间（秒）
+CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "900"))
+# 本地记录的缓存数量上限（通常每个活跃会话一个）
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "512"))
+# 创建失败后暂停尝试的时间（秒）
+CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "600"))
+
+# 缓存快到期时不再使用，避免请求到达时缓存已失效
+_EXPIRY_MARGIN_SECONDS = 30
+
+CONTEXT_CACHE_EVENTS = REGISTRY.counter(
+    "ripple_context_cache_events_total", "Model-side context cache lookups and lifecycle events", ("event",)
+)
+
+
+class ContextCache:
+    """按 (模型, 模板, 图片指纹) 复用模型端上下文缓存"""
+
+    def __init__(self, model_client, enabled: Optional[bool] = None, ttl_seconds: Optional[float] = None,
+                 maxsize: Optional[int] = None):
+        """
+        Args:
+            model_client: ModelClient（通过其 create_cache 创建缓存）
+            enabled: 是否启用，默认读取 CONTEXT_CACHE
+            ttl_seconds: 缓存保留时间（秒）
+            maxsize: 本地记录的缓存数量上限
+        """
+        self.model_client = model_client
+        self.enabled = CONTEXT_CACHE if enabled is None else enabled
+        self.ttl_seconds = ttl_seconds or CONTEXT_CACHE_TTL_SECONDS
+        self._names = LRUCache(
+            maxsize=maxsize if maxsize is not None else CONTEXT_CACHE_MAX_ENTRIES,
+            ttl_seconds=max(1.0, self.ttl_seconds - _EXPIRY_MARGIN_SECONDS),
+        )
+        # 创建失败的模型，在重试间隔内直接跳过
+        self._unavailable = LRUCache(maxsize=64, ttl_seconds=CONTEXT_CACHE_RETRY_SECONDS)
+        self._flights = SingleFlight("context_cache")
+        self.created = 0
+        self.failures = 0
+        self.invalidated = 0
+
+    async def get(self, model: str, variant: str, image_key: Optional[str], system_instruction: str,
+                  image: Any) -> Optional[str]:
+        """
+        返回可用的缓存名称，没有时创建；未启用、没有图片指纹或创建失败时返回 None
+
+        Args:
+            model: 模型名称
+            variant: 提示词模板名
+            image_key: 会话图片指纹
+            system_instruction: 静态系统指令
+            image: 已编码的会话图片（与不使用缓存时发送的内容相同）
+        """
+        if not self.enabled or image_key is None or model in self._unavailable:
+            return None
+        key = (model, variant, image_key)
+        name = self._names.get(key)
+        if name is not None:
+            CONTEXT_CACHE_EVENTS.inc(event="hit")
+            return name
+        return await self._flights.do(key, lambda: self._create(key, system_instruction, image))
+
+    async def _create(self, key: tuple, system_instruction: str, image: Any) -> Optional[str]:
+        model = key[0]
+        try:
+            name = await self.model_client.create_cache(model, system_instruction, [image], self.ttl_seconds)
+        except UpstreamUnavailable as e:
+            # 限流、熔断或截止时间耗尽：这次发送完整内容，但不暂停之后的尝试
+            CONTEXT_CACHE_EVENTS.inc(event="unavailable")
+            logger.info("⏭️ Skipping context cache for %s: %s", model, e)
+            return None
+        except Exception as e:
+            self.failures += 1
+            CONTEXT_CACHE_EVENTS.inc(event="error")
+            logger.warning("⚠️ Context cache unavailable for %s, sending full prompts for %ss: %s",
+                           model, CONTEXT_CACHE_RETRY_SECONDS, e)
+            self._unavailable.set(model, True)
+            return None
+        if name is None:
+            CONTEXT_CACHE_EVENTS.inc(event="unsupported")
+            self._unavailable.set(model, True)
+            return None
+        self.created += 1
+        CONTEXT_CACHE_EVENTS.inc(event="create")
+        logger.debug("🗂️ Created context cache %s for %s", name, model)
+        self._names.set(key, name)
+        return name
+
+    def invalidate(self, model: str, variant: str, image_key: Optional[str]):
+        """丢弃缓存记录（例如请求返回缓存已过期或不存在）"""
+        if self._names.pop((model, variant, image_key)) is not None:
+            self.invalidated += 1
+            CONTEXT_CACHE_EVENTS.inc(event="invalidate")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "ttl_seconds": self.ttl_seconds,
+            **self._names.stats(),
+            "created": self.created,
+            "failures": self.failures,
+            "invalidated": self.invalidated,
+        }
@@ -0,0 +1,108 @@
+"""
+检测结果处理
+分块（tile）划分，以及基于 NumPy 向量化 IoU 的非极大值抑制与标签合并，
+用于将大图各分块的检测结果合并为统一的物体列表。
+"""
+import numpy as np
+from typing import List, Tuple
+from schemas import DetectedObject
+
+
+def tile_grid(width: int, height: int, tile_size: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+    """
+    将图片划分为相互重叠的分块
+
+    Args:
+        width, height: 图片尺寸
+        tile_size: 分块边长（像素）
+        overlap: 相邻分块的重叠比例（0-1）
+
+    Returns:
+        分块列表 (left, top, right, bottom)
+    """
+    def starts(length: int) -> List[int]:
+        if length <= tile_size:
+            return [0]
+        stride = max(1, int(tile_size * (1 - overlap)))
+        positions = list(range(0, length - tile_size, stride))
+        positions.append(length - tile_size)  # 最后一块贴齐边缘
+        return positions
+
+    return [
+        (left, top, min(left + tile_size, width), min(top + tile_size, height))
+        for top in starts(height)
+        for left in starts(width)
+    ]
+
+
+def pairwise_overlaps(boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    计算所有框两两之间的 IoU 以及交集占较小框面积的比例（IoS）
+
+    Args:
+        boxes: 形状 (N, 4) 的数组，每行 [y0, x0, y1, x1]
+
+    Returns:
+        (iou, ios)，形状均为 (N, N)
+    """
+    y0, x0, y1, x1 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.maximum(y1 - y0, 0) * np.maximum(x1 - x0, 0)
+    inter_h = np.maximum(np.minimum(y1[:, None], y1[None, :]) - np.maximum(y0[:, None], y0[None, :]), 0)
+    inter_w = np.maximum(np.minimum(x1[:, None], x1[None, :]) - np.maximum(x0[:, None], x0[None, :]), 0)
+    intersection = inter_h * inter_w
+    union = areas[:, None] + areas[None, :] - intersection
+    smaller = np.minimum(areas[:, None], areas[None, :])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = np.where(union > 0, intersection / union, 0.0)
+        ios = np.where(smaller > 0, intersection / smaller, 0.0)
+    return iou, ios
+
+
+def merge_detections(objects: List[DetectedObject], iou_threshold: float = 0.5,
+                     containment_threshold: float = 0.8, label_merge_iou: float = 0.8,
+                     max_objects: int = 0) -> List[DetectedObject]:
+    """
+    合并多个分块（以及全图）的检测结果
+
+    - 同一标签（忽略大小写）的框，IoU 超过 iou_threshold 或一个框基本包含在另一个框内
+      （分块边缘截断的局部框）时视为同一物体，合并为外接框
+    - 不同标签的框 IoU 超过 label_merge_iou 时视为同一物体的不同叫法，保留面积较大者的标签
+    - 按面积从大到小处理，完整的框优先于被截断的局部框
+
+    Returns:
+        重新编号、重新计算中心点后的物体列表
+    """
+    if not objects:
+        return []
+    boxes = np.array([obj.box_2d for obj in objects], dtype=np.float64)
+    labels = np.array([" ".join(obj.label.split()).casefold() for obj in objects])
+    areas = np.maximum(boxes[:, 2] - boxes[:, 0], 0) * np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+
+    iou, ios = pairwise_overlaps(boxes)
+    same_label = labels[:, None] == labels[None, :]
+    duplicates = (same_label & ((iou > iou_threshold) | (ios > containment_threshold))) | \
+                 (~same_label & (iou > label_merge_iou))
+
+    suppressed = np.zeros(len(objects), dtype=bool)
+    merged = []
+    for index in np.argsort(-areas, kind="stable"):
+        if suppressed[index]:
+            continue
+        group = duplicates[index] & ~suppressed
+        group[index] = True
+        suppressed |= group
+        group_boxes = boxes[group]
+        y0, x0 = group_boxes[:, 0].min(), group_boxes[:, 1].min()
+        y1, x1 = group_boxes[:, 2].max(), group_boxes[:, 3].max()
+        box = [int(y0), int(x0), int(y1), int(x1)]
+        source = objects[index]
+        merged.append(DetectedObject(
+            id=len(merged),
+            label=source.label,
+            box_2d=box,
+            center=((box[1] + box[3]) // 2, (box[0] + box[2]) // 2),
+            confidence=max(objects[i].confidence for i in np.flatnonzero(group))
+        ))
+        if max_objects and len(merged) >= max_objects:
+            break
+    return merged
@@ -0,0 +1,246 @@
+"""
+编辑历史
+每次编辑只保存发生变化的矩形区域（编辑前后两份像素，zlib 压缩），
+会话只保留当前图片，撤销/重做/跳转时按需逐步应用差量重建目标版本，无需重新调用模型。
+编辑结果在记录前已转换为原图的尺寸和模式（见 AIService.execute_edit），差量只覆盖实际变化的矩形区域。
+
+历史保存在执行编辑的进程内（与编辑任务队列相同）：多 worker 部署时撤销/重做需要落在同一个 worker 上；
+会话被其他 worker 淘汰时，本进程的历史通过会话存储的淘汰通知释放。
+"""
+import os
+import time
+import zlib
+import threading
+from typing import Dict, List, Optional, Tuple
+from PIL import Image, ImageChops
+
+# 所有会话编辑历史的总内存上限（字节），超出时从最旧的版本开始淘汰
+EDIT_HISTORY_MAX_BYTES = int(os.getenv("EDIT_HISTORY_MAX_BYTES", str(128 * 1024 * 1024)))
+# 每个会话最多保留的编辑步数
+EDIT_HISTORY_MAX_VERSIONS = int(os.getenv("EDIT_HISTORY_MAX_VERSIONS", "20"))
+# zlib 压缩级别（1 最快，9 最小）
+EDIT_HISTORY_COMPRESSION = int(os.getenv("EDIT_HISTORY_COMPRESSION", "1"))
+
+
+class _Patch:
+    """某个版本中变化区域的像素"""
+
+    def __init__(self, image: Image.Image, box: Tuple[int, int, int, int], level: int):
+        self.mode = image.mode
+        self.image_size = image.size
+        self.box = box
+        self.data = zlib.compress(image.crop(box).tobytes(), level)
+
+    def apply(self, image: Optional[Image.Image]) -> Image.Image:
+        """将区域写回图片（尺寸不同时直接重建整张图片）"""
+        region_size = (self.box[2] - self.box[0], self.box[3] - self.box[1])
+        region = Image.frombytes(self.mode, region_size, zlib.decompress(self.data))
+        if image is None or image.size != self.image_size or image.mode != self.mode:
+            if region_size == self.image_size:
+                return region
+            image = Image.new(self.mode, self.image_size)
+        image.paste(region, self.box[:2])
+        return image
+
+
+class _Delta:
+    """一次编辑：编辑前后的变化区域与内容指纹"""
+
+    def __init__(self, before: Image.Image, after: Image.Image, before_hash: str, after_hash: str,
+                 level: int):
+        if before.size == after.size and before.mode == after.mode:
+            box = ImageChops.difference(before, after).getbbox() or (0, 0, 1, 1)
+            self.before = _Patch(before, box, level)
+            self.after = _Patch(after, box, level)
+        else:
+            self.before = _Patch(before, (0, 0) + before.size, level)
+            self.after = _Patch(after, (0, 0) + after.size, level)
+        self.before_hash = before_hash
+        self.after_hash = after_hash
+        self.created_at = time.time()
+        self.nbytes = len(self.before.data) + len(self.after.data)
+
+
+class _History:
+    def __init__(self):
+        self.deltas: List[_Delta] = []
+        self.position = 0  # 已应用的差量数量，deltas[:position] 之后即当前图片
+        self.base_version = 0  # 最旧的可用版本号（更早的版本已被淘汰）
+        self.lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self.base_version + self.position
+
+    def describe(self) -> dict:
+        return {
+            "version": self.version,
+            "oldest_version": self.base_version,
+            "latest_version": self.base_version + len(self.deltas),
+            "can_undo": self.position > 0,
+            "can_redo": self.position < len(self.deltas),
+            "bytes": sum(delta.nbytes for delta in self.deltas),
+        }
+
+
+class EditHistory:
+    """按会话保存的编辑历史（差量存储，全局内存上限）"""
+
+    def __init__(self, max_bytes: Optional[int] = None, max_versions: Optional[int] = None,
+                 compression: Optional[int] = None):
+        """
+        初始化编辑历史
+
+        Args:
+            max_bytes: 所有会话差量的总内存上限（字节）
+            max_versions: 每个会话最多保留的编辑步数
+            compression: zlib 压缩级别
+        """
+        self.max_bytes = max_bytes if max_bytes is not None else EDIT_HISTORY_MAX_BYTES
+        self.max_versions = max_versions if max_versions is not None else EDIT_HISTORY_MAX_VERSIONS
+        self.compression = compression if compression is not None else EDIT_HISTORY_COMPRESSION
+        self._histories: Dict[str, _History] = {}
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.recorded = 0
+        self.evictions = 0
+
+    def _history(self, session_id: str, create: bool = False) -> Optional[_History]:
+        with self._lock:
+            history = self._histories.get(session_id)
+            if history is None and create:
+                history = self._histories[session_id] = _History()
+            return history
+
+    def diff(self, before: Image.Image, after: Image.Image, before_hash: str, after_hash: str) -> _Delta:
+        """计算一次编辑的差异区域并压缩（CPU 密集，应在线程池中调用；不修改历史）"""
+        return _Delta(before, after, before_hash, after_hash, self.compression)
+
+    def record(self, session_id: str, delta: _Delta) -> int:
+        """
+        记录一次编辑（与替换会话图片在同一步中调用）；当前版本之后的重做记录会被丢弃
+
+        Returns:
+            新版本号
+        """
+        history = self._history(session_id, create=True)
+        with history.lock:
+            dropped = history.deltas[history.position:]
+            history.deltas = history.deltas[:history.position] + [delta]
+            history.position += 1
+            while self.max_versions > 0 and len(history.deltas) > self.max_versions:
+                dropped.append(history.deltas.pop(0))
+                history.position -= 1
+                history.base_version += 1
+                self.evictions += 1
+            version = history.version
+        with self._lock:
+            self._total_bytes += delta.nbytes - sum(d.nbytes for d in dropped)
+            self.recorded += 1
+        self._evict()
+        return version
+
+    def _evict(self):
+        """超出总内存上限时，淘汰所有会话中最旧的差量（每个会话至少保留最近一步）"""
+        while True:
+            with self._lock:
+                if self.max_bytes <= 0 or self._total_bytes <= self.max_bytes:
+                    return
+                candidates = [
+                    (history.deltas[0].created_at, session_id, history)
+                    for session_id, history in self._histories.items()
+                    if len(history.deltas) > 1 and history.position > 0
+                ]
+                if not candidates:
+                    return
+                _, _, history = min(candidates, key=lambda item: item[0])
+            with history.lock:
+                if len(history.deltas) <= 1 or history.position == 0:
+                    continue
+                oldest = history.deltas.pop(0)
+                history.position -= 1
+                history.base_version += 1
+            with self._lock:
+                self._total_bytes -= oldest.nbytes
+                self.evictions += 1
+
+    def version(self, session_id: str) -> int:
+        """会话的当前版本号（没有编辑过时为 0）"""
+        history = self._history(session_id)
+        return history.version if history is not None else 0
+
+    def checkout(self, session_id: str, current: Image.Image, version: int,
+                 current_hash: Optional[str] = None) -> Optional[Tuple[Image.Image, str, int]]:
+        """
+        从当前图片逐步应用差量，重建指定版本（CPU 密集，应在线程池中调用；不修改历史，
+        替换会话图片时再调用 move 切换当前版本）
+
+        Args:
+            current_hash: 当前图片的内容指纹；与历史记录的当前版本不一致（例如图片由其他 worker 编辑过）时不重建
+
+        Returns:
+            (图片, 内容指纹, 重建时的当前版本号)；版本不存在、已被淘汰、就是当前版本或历史与图片不一致时返回 None
+        """
+        history = self._history(session_id)
+        if history is None:
+            return None
+        with history.lock:
+            position = history.position
+            target = version - history.base_version
+            if target < 0 or target > len(history.deltas) or target == position:
+                return None
+            if current_hash is not None and history.deltas:
+                expected = history.deltas[position - 1].after_hash if position > 0 else history.deltas[0].before_hash
+                if expected != current_hash:
+                    return None
+            if target < position:
+                deltas = list(reversed(history.deltas[target:position]))
+                patches = [delta.before for delta in deltas]
+                image_hash = history.deltas[target].before_hash
+            else:
+                patches = [delta.after for delta in history.deltas[position:target]]
+                image_hash = history.deltas[target - 1].after_hash
+            from_version = history.version
+        image = current.copy()
+        for patch in patches:
+            image = patch.apply(image)
+        return image, image_hash, from_version
+
+    def move(self, session_id: str, from_version: int, to_version: int) -> bool:
+        """
+        切换当前版本；期间有其他编辑或撤销改变了当前版本时返回 False
+        """
+        history = self._history(session_id)
+        if history is None:
+            return False
+        with history.lock:
+            target = to_version - history.base_version
+            if history.version != from_version or not 0 <= target <= len(history.deltas):
+                return False
+            history.position = target
+            return True
+
+    def describe(self, session_id: str) -> dict:
+        """返回会话的历史状态（当前版本、可用版本范围、能否撤销/重做）"""
+        history = self._history(session_id)
+        if history is None:
+            return _History().describe()
+        with history.lock:
+            return history.describe()
+
+    def drop(self, session_id: str):
+        """删除会话的编辑历史（会话被淘汰时调用）"""
+        with self._lock:
+            history = self._histories.pop(session_id, None)
+            if history is not None:
+                self._total_bytes -= sum(delta.nbytes for delta in history.deltas)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._histories),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "recorded": self.recorded,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,148 @@
+"""
+图像处理工具
+发送给模型前的缩小与编码、返回给前端的图片编码，以及局部编辑所需的裁剪区域计算、羽化蒙版与 NumPy 合成。
+"""
+import numpy as np
+from io import BytesIO
+from typing import List, Tuple
+from PIL import Image
+
+
+def downscale(image: Image.Image, max_edge: int) -> Image.Image:
+    """将图片等比例缩小到长边不超过 max_edge（不放大，未超出时原样返回）"""
+    if max_edge <= 0 or max(image.size) <= max_edge:
+        return image
+    scale = max_edge / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def match_image(image: Image.Image, reference: Image.Image) -> Image.Image:
+    """将模型返回的图片转换为 reference 的模式和尺寸（已一致时原样返回）"""
+    if image.mode != reference.mode:
+        image = image.convert(reference.mode)
+    if image.size != reference.size:
+        image = image.resize(reference.size, Image.Resampling.LANCZOS)
+    return image
+
+
+def encode_for_model(image: Image.Image, max_edge: int, quality: int = 85) -> bytes:
+    """缩小并编码为 JPEG，作为发送给模型的图片"""
+    small = downscale(image, max_edge)
+    if small.mode != "RGB":
+        small = small.convert("RGB")
+    buffered = BytesIO()
+    small.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def encode_image(image: Image.Image, fmt: str = "webp", quality: int = 90, progressive: bool = True,
+                 max_edge: int = 0) -> bytes:
+    """
+    编码图片用于返回给前端
+
+    Args:
+        fmt: webp | jpeg | png
+        quality: 有损格式的质量（1-100）
+        progressive: JPEG 是否使用渐进式编码
+        max_edge: 大于 0 时先缩小到长边不超过该值（用于缩略图）
+    """
+    fmt = fmt.lower()
+    image = downscale(image, max_edge)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffered = BytesIO()
+    if fmt == "png":
+        image.save(buffered, format="PNG", compress_level=6)
+    elif fmt in ("jpeg", "jpg"):
+        image.save(buffered, format="JPEG", quality=quality, progressive=progressive, optimize=progressive)
+    else:
+        image.save(buffered, format="WEBP", quality=quality, method=4)
+    return buffered.getvalue()
+
+
+def clamp_box(box_2d: List[int], width: int, height: int) -> Tuple[int, int, int, int]:
+    """将 [y0, x0, y1, x1] 限制在图片范围内，并保证至少 1 像素大小"""
+    y0, x0, y1, x1 = box_2d
+    x0 = min(max(int(x0), 0), width - 1)
+    y0 = min(max(int(y0), 0), height - 1)
+    x1 = min(max(int(x1), x0 + 1), width)
+    y1 = min(max(int(y1), y0 + 1), height)
+    return y0, x0, y1, x1
+
+
+def edit_region(box_2d: List[int], width: int, height: int, margin_ratio: float = 0.25,
+                min_margin: int = 32) -> Tuple[Tuple[int, int, int, int], List[int], int]:
+    """
+    计算局部编辑的裁剪区域（目标框 + 上下文边距）
+
+    Args:
+        box_2d: 目标区域 [y0, x0, y1, x1]（像素坐标）
+        width, height: 原图尺寸
+        margin_ratio: 边距占目标框边长的比例
+        min_margin: 最小边距（像素）
+
+    Returns:
+        (裁剪区域 (left, top, right, bottom), 目标框在裁剪图中的坐标 [y0, x0, y1, x1],
+         羽化宽度（等于较小的边距，使蒙版在裁剪边缘衰减到 0，不留接缝）)
+    """
+    y0, x0, y1, x1 = clamp_box(box_2d, width, height)
+    margin_x = max(min_margin, int((x1 - x0) * margin_ratio))
+    margin_y = max(min_margin, int((y1 - y0) * margin_ratio))
+    left = max(0, x0 - margin_x)
+    top = max(0, y0 - margin_y)
+    right = min(width, x1 + margin_x)
+    bottom = min(height, y1 + margin_y)
+    return (left, top, right, bottom), [y0 - top, x0 - left, y1 - top, x1 - left], min(margin_x, margin_y)
+
+
+def feather_mask(height: int, width: int, inner_box: List[int], feather: int) -> np.ndarray:
+    """
+    生成羽化蒙版：目标框内为 1，框外按到目标框的距离在 feather 像素内线性衰减到 0
+
+    Returns:
+        形状为 (height, width, 1) 的 float32 数组
+    """
+    y0, x0, y1, x1 = inner_box
+    xs = np.arange(width, dtype=np.float32)
+    ys = np.arange(height, dtype=np.float32)
+    dx = np.maximum(np.maximum(x0 - xs, xs - (x1 - 1)), 0)
+    dy = np.maximum(np.maximum(y0 - ys, ys - (y1 - 1)), 0)
+    distance = np.sqrt(dy[:, None] ** 2 + dx[None, :] ** 2)
+    if feather <= 0:
+        alpha = (distance == 0).astype(np.float32)
+    else:
+        alpha = np.clip(1.0 - distance / feather, 0.0, 1.0).astype(np.float32)
+    return alpha[:, :, None]
+
+
+def composite_region(original: Image.Image, edited_crop: Image.Image, crop_box: Tuple[int, int, int, int],
+                     inner_box: List[int], feather: int) -> Image.Image:
+    """
+    将编辑后的裁剪图缩放回裁剪区域大小，并用羽化蒙版融合回原图
+
+    Args:
+        original: 原图（RGB）
+        edited_crop: 模型返回的裁剪区域编辑结果（可能是不同分辨率）
+        crop_box: 裁剪区域 (left, top, right, bottom)
+        inner_box: 目标框在裁剪图中的坐标 [y0, x0, y1, x1]
+        feather: 羽化宽度（像素）
+
+    Returns:
+        合成后的新图片
+    """
+    left, top, right, bottom = crop_box
+    crop_width, crop_height = right - left, bottom - top
+    if edited_crop.mode != "RGB":
+        edited_crop = edited_crop.convert("RGB")
+    if edited_crop.size != (crop_width, crop_height):
+        edited_crop = edited_crop.resize((crop_width, crop_height), Image.Resampling.LANCZOS)
+
+    base = np.asarray(original.crop(crop_box), dtype=np.float32)
+    edited = np.asarray(edited_crop, dtype=np.float32)
+    alpha = feather_mask(crop_height, crop_width, inner_box, feather)
+    blended = base + (edited - base) * alpha
+
+    result = original.copy()
+    result.paste(Image.fromarray(np.clip(blended + 0.5, 0, 255).astype(np.uint8), "RGB"), (left, top))
+    return result
@@ -0,0 +1,185 @@
+"""
+图片存储
+编辑结果按编码后内容的哈希寻址保存，通过 /api/images/{name} 以二进制返回（带 ETag 和长期缓存头），
+取代在 JSON 中内嵌 base64 PNG。
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from services.image_ops import encode_image
+from services.session_store import SESSION_BACKEND, SESSION_DB_PATH
+from services.telemetry import get_logger
+
+logger = get_logger(__name__)
+
+# 返回给前端的图片格式: webp | jpeg | png
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()
+# 有损格式的编码质量
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+# JPEG 是否使用渐进式编码
+IMAGE_PROGRESSIVE = os.getenv("IMAGE_PROGRESSIVE", "true").lower() in ("true", "1", "yes", "on")
+# 缩略图长边（像素），0 表示不生成缩略图
+IMAGE_THUMBNAIL_EDGE = int(os.getenv("IMAGE_THUMBNAIL_EDGE", "0"))
+# 内存中保存的已编码图片总大小上限（字节）
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 磁盘存储目录（多 worker 共享），未设置时：sqlite 会话后端下放在会话数据库旁边，memory 后端下只保存在内存中
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR")
+if IMAGE_STORE_DIR is None:
+    IMAGE_STORE_DIR = os.path.join(os.path.dirname(SESSION_DB_PATH), "rippleui_images") if SESSION_BACKEND == "sqlite" else ""
+# 磁盘目录中图片总大小上限（字节，0 表示不限制），超出时删除最早写入的图片
+IMAGE_STORE_DIR_MAX_BYTES = int(os.getenv("IMAGE_STORE_DIR_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# 每写入多少张图片检查一次磁盘目录的大小
+_DIR_PRUNE_EVERY = 64
+
+MEDIA_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png"}
+
+
+class ImageStore:
+    """内容寻址的图片存储（内存 LRU + 可选磁盘目录）"""
+
+    def __init__(self, fmt: Optional[str] = None, quality: Optional[int] = None,
+                 progressive: Optional[bool] = None, thumbnail_edge: Optional[int] = None,
+                 max_bytes: Optional[int] = None, store_dir: Optional[str] = None,
+                 dir_max_bytes: Optional[int] = None):
+        """
+        初始化图片存储
+
+        Args:
+            fmt: 编码格式 webp | jpeg | png
+            quality: 有损格式的编码质量
+            progressive: JPEG 是否使用渐进式编码
+            thumbnail_edge: 缩略图长边，0 表示不生成
+            max_bytes: 内存中保存的图片总大小上限
+            store_dir: 磁盘存储目录，为空时只保存在内存中
+            dir_max_bytes: 磁盘目录中图片总大小上限
+        """
+        self.format = (fmt or IMAGE_FORMAT).lower()
+        if self.format not in MEDIA_TYPES:
+            raise ValueError(f"Unsupported IMAGE_FORMAT: {self.format}")
+        self.extension = "jpg" if self.format == "jpeg" else self.format
+        self.quality = quality if quality is not None else IMAGE_QUALITY
+        self.progressive = progressive if progressive is not None else IMAGE_PROGRESSIVE
+        self.thumbnail_edge = thumbnail_edge if thumbnail_edge is not None else IMAGE_THUMBNAIL_EDGE
+        self.max_bytes = max_bytes if max_bytes is not None else IMAGE_STORE_MAX_BYTES
+        self.store_dir = IMAGE_STORE_DIR if store_dir is None else store_dir
+        self.dir_max_bytes = dir_max_bytes if dir_max_bytes is not None else IMAGE_STORE_DIR_MAX_BYTES
+        if self.store_dir:
+            os.makedirs(self.store_dir, exist_ok=True)
+            logger.info("🖼️ Image store directory: %s", self.store_dir)
+        self._dir_writes = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.served = 0
+        self.evictions = 0
+
+    def _encode(self, image: Image.Image, max_edge: int = 0) -> str:
+        data = encode_image(image, self.format, self.quality, self.progressive, max_edge)
+        name = f"{hashlib.sha256(data).hexdigest()[:32]}.{self.extension}"
+        self._put(name, data)
+        return name
+
+    def put(self, image: Image.Image) -> Dict[str, object]:
+        """
+        编码并保存图片（CPU 密集，应在线程池中调用）
+
+        Returns:
+            {"image_name", "thumbnail_name"（未启用时为 None）, "width", "height"}
+        """
+        return {
+            "image_name": self._encode(image),
+            "thumbnail_name": self._encode(image, self.thumbnail_edge) if self.thumbnail_edge > 0 else None,
+            "width": image.width,
+            "height": image.height,
+        }
+
+    def _put(self, name: str, data: bytes):
+        with self._lock:
+            if name in self._data:
+                self._data.move_to_end(name)
+                return
+            self._data[name] = data
+            self._bytes += len(data)
+            self.stored += 1
+            # 超出内存上限时淘汰最久未访问的图片（始终保留刚写入的这张）
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+        if self.store_dir:
+            path = os.path.join(self.store_dir, name)
+            if os.path.exists(path):
+                return
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning("⚠️ Image store write error: %s", e)
+                return
+            with self._lock:
+                self._dir_writes += 1
+                prune = self.dir_max_bytes > 0 and self._dir_writes % _DIR_PRUNE_EVERY == 0
+            if prune:
+                self._prune_dir()
+
+    def _prune_dir(self):
+        """磁盘目录超出大小上限时按写入时间删除最早的图片（多个 worker 同时清理时忽略已被删除的文件）"""
+        files = []
+        try:
+            with os.scandir(self.store_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            logger.warning("⚠️ Image store scan error: %s", e)
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.dir_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def get(self, name: str) -> Optional[Tuple[bytes, str]]:
+        """读取图片，返回 (数据, MIME 类型)，不存在时返回 None"""
+        extension = name.rsplit(".", 1)[-1]
+        if extension not in MEDIA_TYPES or os.path.basename(name) != name:
+            return None
+        with self._lock:
+            data = self._data.get(name)
+            if data is not None:
+                self._data.move_to_end(name)
+        if data is None and self.store_dir:
+            try:
+                with open(os.path.join(self.store_dir, name), "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+        if data is None:
+            return None
+        self.served += 1
+        return data, MEDIA_TYPES[extension]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "format": self.format,
+                "images": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "stored": self.stored,
+                "served": self.served,
+                "evictions": self.evictions,
+            }
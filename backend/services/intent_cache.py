@@ -0,0 +1,62 @@
+"""
+意图推理缓存
+按 (点击物体标签, 周围物体, 图片指纹) 缓存 infer_intent 的结果，
+同一物体被重复点击、或多个用户点击同一图片中的同一物体时直接返回。
+"""
+import os
+from typing import Iterable, List, Optional, Tuple
+from services.cache import LRUCache
+from schemas import RippleIntent
+
+# 意图缓存条目上限
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "4096"))
+# 意图缓存过期时间（秒），网络搜索结果会随时间变化，默认 30 分钟
+INTENT_CACHE_TTL_SECONDS = float(os.getenv("INTENT_CACHE_TTL_SECONDS", "1800"))
+
+
+def _normalize_label(label: str) -> str:
+    return " ".join(label.split()).casefold()
+
+
+def intent_cache_key(clicked_label: str, nearby_labels: Iterable[str], image_fingerprint: str) -> Tuple:
+    """构造规范化的缓存键：标签大小写折叠，周围物体去重排序"""
+    nearby = tuple(sorted({_normalize_label(label) for label in nearby_labels if label}))
+    return (_normalize_label(clicked_label), nearby, image_fingerprint)
+
+
+class IntentCache:
+    """带 TTL 和容量上限的意图缓存"""
+
+    def __init__(self, maxsize: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        """
+        初始化意图缓存
+
+        Args:
+            maxsize: 条目上限
+            ttl_seconds: 过期时间（秒）
+        """
+        self._cache = LRUCache(
+            maxsize=maxsize if maxsize is not None else INTENT_CACHE_SIZE,
+            ttl_seconds=ttl_seconds if ttl_seconds is not None else INTENT_CACHE_TTL_SECONDS
+        )
+
+    def get(self, key: Tuple) -> Optional[List[RippleIntent]]:
+        """读取缓存的意图列表（返回副本，调用方修改不会影响缓存）"""
+        intents = self._cache.get(key)
+        if intents is None:
+            return None
+        return [intent.model_copy(deep=True) for intent in intents]
+
+    def set(self, key: Tuple, intents: List[RippleIntent]):
+        """写入意图列表（空列表表示推理失败，不缓存）"""
+        if intents:
+            self._cache.set(key, [intent.model_copy(deep=True) for intent in intents])
+
+    def __contains__(self, key: Tuple) -> bool:
+        return key in self._cache
+
+    def invalidate(self, key: Tuple):
+        self._cache.pop(key)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
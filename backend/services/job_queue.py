@@ -0,0 +1,278 @@
+"""
+异步任务队列
+图像编辑等耗时操作提交到有界队列，由固定数量的 worker 执行，请求立即返回 job_id；
+客户端轮询状态/结果，可以取消任务，同一会话中被新任务取代的旧任务会被自动丢弃。
+
+任务及其结果保存在提交它的进程内：多 worker 部署时，查询、取消任务的请求必须落在同一个 worker 上
+（以单 worker 运行编辑服务，或在负载均衡层按会话粘性路由）。
+"""
+import os
+import time
+import uuid
+import asyncio
+import contextvars
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+from services.telemetry import REGISTRY, get_logger
+
+logger = get_logger(__name__)
+
+# 同时执行的编辑任务数量
+EDIT_WORKERS = int(os.getenv("EDIT_WORKERS", "2"))
+# 排队任务的上限（超出时拒绝提交）
+EDIT_QUEUE_SIZE = int(os.getenv("EDIT_QUEUE_SIZE", "32"))
+# 已结束任务的结果保留时间（秒）
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+SUPERSEDED = "superseded"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED, SUPERSEDED)
+
+JOB_WAIT = REGISTRY.histogram("ripple_job_wait_seconds", "Time jobs spend queued before a worker picks them up", ("queue",))
+JOB_RUN = REGISTRY.histogram("ripple_job_run_seconds", "Job run time by final status", ("queue", "status"))
+
+
+class QueueFullError(Exception):
+    """队列已满"""
+
+
+class Job:
+    """单个任务"""
+
+    def __init__(self, fn: Callable[[], Awaitable[Any]], group: Optional[str] = None):
+        self.job_id = uuid.uuid4().hex
+        self.fn = fn
+        self.group = group
+        self.status = QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.done = asyncio.Event()
+        # 提交时的上下文（请求的计时与统计归属），任务在 worker 中以该上下文执行
+        self.context = contextvars.copy_context()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+    def to_dict(self, include_result: bool = False) -> Dict[str, Any]:
+        data = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "wait_seconds": round((self.started_at or time.time()) - self.created_at, 3),
+            "run_seconds": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class JobQueue:
+    """有界任务队列 + worker 池"""
+
+    def __init__(self, name: str = "jobs", workers: Optional[int] = None, maxsize: Optional[int] = None,
+                 result_ttl: Optional[float] = None):
+        """
+        初始化任务队列（worker 在第一次提交时启动）
+
+        Args:
+            name: 名称（用于日志和统计）
+            workers: worker 数量
+            maxsize: 排队任务上限
+            result_ttl: 已结束任务保留时间（秒）
+        """
+        self.name = name
+        self.workers = workers if workers is not None else EDIT_WORKERS
+        self.maxsize = maxsize if maxsize is not None else EDIT_QUEUE_SIZE
+        self.result_ttl = result_ttl if result_ttl is not None else JOB_RESULT_TTL_SECONDS
+        self._queue: Optional[asyncio.Queue] = None
+        # 排队中的有效任务数（被取消或取代的任务仍留在 asyncio.Queue 中直到被 worker 取出，不计入）
+        self._queued = 0
+        self._workers: list = []
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._latest: Dict[str, Job] = {}
+        self._wait_times: deque = deque(maxlen=256)
+        self._run_times: deque = deque(maxlen=256)
+        self.counts = {status: 0 for status in FINISHED}
+        self.submitted = 0
+        self.rejected = 0
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            # 容量由 _queued 控制，已失效的任务不占用排队名额
+            self._queue = asyncio.Queue()
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.create_task(self._worker(len(self._workers))))
+
+    def submit(self, fn: Callable[[], Awaitable[Any]], group: Optional[str] = None,
+               supersede: bool = True) -> Job:
+        """
+        提交任务
+
+        Args:
+            fn: 无参数的协程函数
+            group: 分组键（例如 session_id）
+            supersede: 为 True 时丢弃同组中尚未结束的旧任务（排队的直接丢弃，运行中的取消）
+
+        Returns:
+            新任务
+
+        Raises:
+            QueueFullError: 排队任务已达上限
+        """
+        self._ensure_workers()
+        self._prune()
+        previous = self._latest.get(group) if supersede and group is not None else None
+        if previous is not None and previous.finished:
+            previous = None
+        # 被取代的排队任务会让出名额，同一会话连续提交不会因为自己的旧任务被拒绝
+        freed = 1 if previous is not None and previous.status == QUEUED else 0
+        if self.maxsize > 0 and self._queued - freed >= self.maxsize:
+            self.rejected += 1
+            raise QueueFullError(f"{self.name} queue is full ({self.maxsize} jobs waiting)")
+
+        if previous is not None:
+            logger.info("⏭️ Job %s superseded by a newer %s job", previous.job_id[:8], self.name)
+            self._stop(previous, SUPERSEDED)
+
+        job = Job(fn, group)
+        self._jobs[job.job_id] = job
+        if group is not None:
+            self._latest[group] = job
+        self._queue.put_nowait(job)
+        self._queued += 1
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> int:
+        """任务在队列中的位置（0 表示下一个执行；非排队状态返回 -1）"""
+        if job.status != QUEUED:
+            return -1
+        ahead = 0
+        for other in self._jobs.values():
+            if other is job:
+                return ahead
+            if other.status == QUEUED:
+                ahead += 1
+        return -1
+
+    def cancel(self, job_id: str) -> bool:
+        """取消任务，任务不存在或已结束时返回 False"""
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        self._stop(job, CANCELLED)
+        return True
+
+    def cancel_group(self, group: str) -> bool:
+        """取消分组中尚未结束的任务（例如撤销时取消该会话正在进行的编辑）"""
+        job = self._latest.get(group)
+        if job is None or job.finished:
+            return False
+        self._stop(job, CANCELLED)
+        return True
+
+    async def wait(self, job: Job, timeout: float) -> Job:
+        """等待任务结束，最多 timeout 秒"""
+        if timeout > 0 and not job.finished:
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def _stop(self, job: Job, status: str):
+        if job.status == RUNNING and job.task is not None:
+            # 运行中的任务：取消后由 worker 记录最终状态
+            job.status = status
+            job.task.cancel()
+        else:
+            # 排队中的任务：标记后 worker 取出时直接跳过
+            self._finish(job, status)
+
+    def _finish(self, job: Job, status: str, result: Any = None, error: Optional[str] = None):
+        if job.status == QUEUED:
+            self._queued -= 1
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job.fn = None
+        job.context = None
+        self.counts[status] += 1
+        if job.started_at is not None:
+            self._run_times.append(job.finished_at - job.started_at)
+            JOB_RUN.observe(job.finished_at - job.started_at, queue=self.name, status=status)
+        if job.group is not None and self._latest.get(job.group) is job:
+            del self._latest[job.group]
+        job.done.set()
+
+    def _prune(self):
+        """删除超过保留时间的已结束任务"""
+        cutoff = time.time() - self.result_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status != QUEUED:
+                    continue  # 已取消或被取代
+                job.status = RUNNING
+                self._queued -= 1
+                job.started_at = time.time()
+                self._wait_times.append(job.started_at - job.created_at)
+                JOB_WAIT.observe(job.started_at - job.created_at, queue=self.name)
+                job.task = job.context.run(asyncio.create_task, job.fn())
+                # 不直接 await：取消任务时不会连带取消 worker
+                await asyncio.wait({job.task})
+                if job.task.cancelled():
+                    self._finish(job, job.status if job.status in FINISHED else CANCELLED)
+                elif job.task.exception() is not None:
+                    error = job.task.exception()
+                    logger.error("❌ %s job %s failed: %s", self.name, job.job_id[:8], error, exc_info=error)
+                    self._finish(job, FAILED, error=str(getattr(error, "detail", error)))
+                else:
+                    self._finish(job, SUCCEEDED, result=job.task.result())
+            finally:
+                self._queue.task_done()
+
+    async def close(self):
+        """取消所有 worker 和运行中的任务"""
+        for job in list(self._jobs.values()):
+            if not job.finished:
+                self._stop(job, CANCELLED)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._wait_times)
+        return {
+            "workers": self.workers,
+            "depth": self._queued,
+            "max_depth": self.maxsize,
+            "running": sum(1 for job in self._jobs.values() if job.status == RUNNING),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            **self.counts,
+            "avg_wait_seconds": round(sum(waits) / len(waits), 3) if waits else 0.0,
+            "p95_wait_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+            "avg_run_seconds": round(sum(self._run_times) / len(self._run_times), 3) if self._run_times else 0.0,
+        }
@@ -0,0 +1,407 @@
+"""
+模型调用层
+将 Gemini SDK 调用移出事件循环，并按模型限制并发数，
+使 /api/analyze、/api/infer、/api/execute 的请求可以并行处理。
+实际调用由 MODEL_BACKEND 选择的后端完成（gemini | synthetic | record | replay，见 services/backends.py）。
+"""
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Optional
+from dotenv import load_dotenv
+from services.backends import MODEL_BACKEND, UsageMetadata, create_model_backend, estimate_prompt_tokens
+from services.telemetry import REGISTRY, UPSTREAM_ERRORS, get_logger, span
+from services.usage import usage_tracker
+from services.resilience import Upstream
+from services.rate_limiter import (
+    DEFAULT_MODEL_RPM, DEFAULT_MODEL_TPM, RATE_LIMIT_OUTPUT_TOKENS, RateLimiter,
+)
+
+logger = get_logger(__name__)
+
+load_dotenv()
+
+# 尝试使用新的 SDK，如果不可用则回退到旧的
+try:
+    from google import genai
+    from google.genai import types
+    USE_NEW_SDK = True
+    logger.info("✅ Using new Google Genai SDK")
+except ImportError:
+    import google.generativeai as genai
+    types = None
+    USE_NEW_SDK = False
+    logger.warning("⚠️ Using old google-generativeai SDK")
+
+# 每个模型默认允许同时进行的请求数
+# 可用 MODEL_CONCURRENCY_<模型名> 单独覆盖，例如 MODEL_CONCURRENCY_GEMINI_2_5_FLASH_IMAGE=2
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "8"))
+# 没有原生异步接口时，用于执行同步调用的线程池大小
+MODEL_THREAD_POOL_SIZE = int(os.getenv("MODEL_THREAD_POOL_SIZE", "16"))
+# 单次模型调用的超时上限（秒，不包括等待配额和并发名额；同时受请求截止时间约束）
+MODEL_TIMEOUT_SECONDS = float(os.getenv("MODEL_TIMEOUT_SECONDS", "90"))
+# 瞬时错误（超时、429、5xx）的最多重试次数
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "2"))
+# 对冲请求的等待时间（秒，0 表示关闭）：允许对冲的调用超过该时间未返回时再发一个相同请求
+MODEL_HEDGE_DELAY_SECONDS = float(os.getenv("MODEL_HEDGE_DELAY_SECONDS", "0"))
+
+MODEL_DURATION = REGISTRY.histogram(
+    "ripple_model_call_duration_seconds", "Model call duration (excluding concurrency wait)", ("model",)
+)
+MODEL_FIRST_CHUNK = REGISTRY.histogram(
+    "ripple_model_first_chunk_seconds", "Time to the first streamed chunk", ("model",)
+)
+MODEL_IN_FLIGHT = REGISTRY.gauge("ripple_model_calls_in_flight", "Model calls in progress", ("model",))
+
+
+def _model_env_key(prefix: str, model_name: str) -> str:
+    """将模型名转换为环境变量名，例如 (MODEL_CONCURRENCY, gemini-2.0-flash) -> MODEL_CONCURRENCY_GEMINI_2_0_FLASH"""
+    normalized = "".join(ch if ch.isalnum() else "_" for ch in model_name.upper())
+    return f"{prefix}_{normalized}"
+
+
+def _model_setting(prefix: str, model_name: str, default: int) -> int:
+    override = os.getenv(_model_env_key(prefix, model_name))
+    return int(override) if override else default
+
+
+class GeminiBackend:
+    """直接调用 Gemini SDK 的模型后端（新 SDK 使用原生 aio 接口，旧 SDK 使用异步方法或线程池）"""
+
+    def __init__(self, api_key: Optional[str], run_sync):
+        """
+        Args:
+            api_key: Gemini API 密钥
+            run_sync: 在线程池中执行同步调用的函数（旧 SDK 没有异步接口时使用）
+        """
+        if USE_NEW_SDK:
+            self._client = genai.Client(api_key=api_key)
+        else:
+            genai.configure(api_key=api_key)
+            self._client = None
+        self._run_sync = run_sync
+        self._legacy_models: Dict[str, Any] = {}
+
+    def _legacy_model(self, model_name: str):
+        model = self._legacy_models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            self._legacy_models[model_name] = model
+        return model
+
+    async def generate_content(self, model: str, contents, config=None):
+        if USE_NEW_SDK:
+            return await self._client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=config
+            )
+
+        legacy_model = self._legacy_model(model)
+        if hasattr(legacy_model, "generate_content_async"):
+            return await legacy_model.generate_content_async(contents)
+        return await self._run_sync(legacy_model.generate_content, contents)
+
+    async def generate_content_stream(self, model: str, contents, config=None) -> AsyncIterator[Any]:
+        if USE_NEW_SDK:
+            stream = await self._client.aio.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config
+            )
+            async for chunk in stream:
+                yield chunk
+            return
+
+        legacy_model = self._legacy_model(model)
+        if hasattr(legacy_model, "generate_content_async"):
+            stream = await legacy_model.generate_content_async(contents, stream=True)
+            async for chunk in stream:
+                yield chunk
+            return
+        # 没有异步接口时退化为一次性返回
+        yield await self._run_sync(legacy_model.generate_content, contents)
+
+    async def create_cache(self, model: str, system_instruction: str, contents, ttl_seconds: float):
+        """创建模型端上下文缓存（仅新 SDK 支持，旧 SDK 返回 None）"""
+        if not USE_NEW_SDK:
+            return None
+        return await self._client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                contents=[types.Content(role="user", parts=list(contents))],
+                ttl=f"{int(ttl_seconds)}s",
+            )
+        )
+
+    def stats(self) -> dict:
+        return {"backend": "gemini", "sdk": "google-genai" if USE_NEW_SDK else "google-generativeai"}
+
+
+class ModelClient:
+    """异步模型调用客户端（按模型限制并发，具体调用交给 MODEL_BACKEND 选择的后端）"""
+
+    def __init__(self, api_key: Optional[str] = None, default_concurrency: Optional[int] = None,
+                 thread_pool_size: Optional[int] = None, backend=None):
+        """
+        初始化模型客户端
+
+        Args:
+            api_key: Gemini API 密钥，如果为 None 则从环境变量读取
+            default_concurrency: 每个模型的默认并发上限
+            thread_pool_size: 同步调用所用线程池的大小
+            backend: 模型后端，如果为 None 则按 MODEL_BACKEND 创建
+        """
+        api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        self.default_concurrency = default_concurrency or DEFAULT_MODEL_CONCURRENCY
+        self.thread_pool_size = thread_pool_size or MODEL_THREAD_POOL_SIZE
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        # 每个模型一套超时 / 重试 / 对冲 / 熔断策略
+        self._upstreams: Dict[str, Upstream] = {}
+        # 每个模型的 RPM / TPM 配额与优先级队列（MODEL_RPM / MODEL_TPM 未设置时不限流）
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # synthetic / replay 不需要 API 密钥，也不创建 SDK 客户端
+        self.backend = backend or create_model_backend(
+            MODEL_BACKEND, lambda: GeminiBackend(api_key, self.run_sync)
+        )
+
+    def concurrency_limit(self, model_name: str) -> int:
+        """返回指定模型的并发上限"""
+        return _model_setting("MODEL_CONCURRENCY", model_name, self.default_concurrency)
+
+    def _semaphore(self, model_name: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(model_name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency_limit(model_name))
+            self._semaphores[model_name] = semaphore
+        return semaphore
+
+    def upstream(self, model_name: str) -> Upstream:
+        """返回指定模型的容错策略（首次使用时创建）"""
+        upstream = self._upstreams.get(model_name)
+        if upstream is None:
+            upstream = Upstream(model_name, timeout=MODEL_TIMEOUT_SECONDS, max_retries=MODEL_MAX_RETRIES,
+                                hedge_delay=MODEL_HEDGE_DELAY_SECONDS)
+            self._upstreams[model_name] = upstream
+        return upstream
+
+    def rate_limiter(self, model_name: str) -> RateLimiter:
+        """返回指定模型的限流器（首次使用时创建）"""
+        limiter = self._limiters.get(model_name)
+        if limiter is None:
+            limiter = RateLimiter(
+                model_name,
+                rpm=_model_setting("MODEL_RPM", model_name, DEFAULT_MODEL_RPM),
+                tpm=_model_setting("MODEL_TPM", model_name, DEFAULT_MODEL_TPM),
+            )
+            self._limiters[model_name] = limiter
+        return limiter
+
+    def _slot(self, model: str, contents, config) -> "_ModelSlot":
+        """一次调用的准入：配额与并发名额（传给 Upstream 的 admit，在超时与熔断之外获取）"""
+        return _ModelSlot(self, model, contents, config)
+
+    async def _acquire_quota(self, model: str, contents, config) -> int:
+        """按优先级等待配额，返回预扣的 token 数"""
+        limiter = self.rate_limiter(model)
+        if not limiter.enabled:
+            return 0
+        with span("rate_limit_wait", model=model):
+            return await limiter.acquire(estimate_prompt_tokens(contents, config) + RATE_LIMIT_OUTPUT_TOKENS)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.thread_pool_size,
+                thread_name_prefix="model-client"
+            )
+        return self._executor
+
+    async def run_sync(self, func, *args, **kwargs):
+        """在专用线程池中执行同步函数，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(func, *args, **kwargs))
+
+    async def generate_content(self, model: str, contents, config=None, hedge: bool = False):
+        """
+        调用模型生成内容（超时、瞬时错误重试和熔断见 services/resilience.py）
+
+        Args:
+            model: 模型名称
+            contents: 提示词与图片列表
+            config: types.GenerateContentConfig（仅新 SDK 使用）
+            hedge: 是否允许对冲请求（MODEL_HEDGE_DELAY_SECONDS > 0 时生效，只用于可以重复发出的调用）
+
+        Returns:
+            SDK 原始响应对象（synthetic / replay 后端返回结构相同的 BackendResponse）
+
+        Raises:
+            UpstreamUnavailable: 熔断中、请求截止时间耗尽或重试用尽
+        """
+        return await self.upstream(model).call(
+            lambda slot: self._generate_once(slot, contents, config), hedge=hedge,
+            admit=lambda: self._slot(model, contents, config),
+        )
+
+    async def _generate_once(self, slot: "_ModelSlot", contents, config=None):
+        model = slot.model
+        try:
+            with MODEL_IN_FLIGHT.track(model=model), span("model_call", model=model):
+                started = time.perf_counter()
+                slot.dispatched = True
+                response = await self.backend.generate_content(model, contents, config)
+                MODEL_DURATION.observe(time.perf_counter() - started, model=model)
+            slot.responded = True
+            slot.usage_metadata = getattr(response, "usage_metadata", None)
+            usage_tracker.record_model(model, slot.usage_metadata)
+            return response
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(upstream="model", error=type(e).__name__)
+            raise
+
+    async def generate_content_stream(self, model: str, contents, config=None) -> AsyncIterator[str]:
+        """
+        以流式方式调用模型，逐块返回生成的文本（整个流期间占用一个并发名额；
+        只在收到第一个片段之前重试）
+
+        Args:
+            model: 模型名称
+            contents: 提示词与图片列表
+            config: types.GenerateContentConfig（仅新 SDK 使用）
+
+        Yields:
+            文本片段
+        """
+        async for text in self.upstream(model).stream(
+            lambda slot: self._stream_once(slot, contents, config),
+            admit=lambda: self._slot(model, contents, config),
+        ):
+            yield text
+
+    async def _stream_once(self, slot: "_ModelSlot", contents, config=None) -> AsyncIterator[str]:
+        model = slot.model
+        try:
+            with MODEL_IN_FLIGHT.track(model=model), span("model_stream", model=model):
+                started = time.perf_counter()
+                slot.dispatched = True
+                async for chunk in self.backend.generate_content_stream(model, contents, config):
+                    if not slot.responded:
+                        MODEL_FIRST_CHUNK.observe(time.perf_counter() - started, model=model)
+                        slot.responded = True
+                    # 用量随最后一个片段返回
+                    slot.usage_metadata = getattr(chunk, "usage_metadata", None) or slot.usage_metadata
+                    if chunk.text:
+                        yield chunk.text
+                MODEL_DURATION.observe(time.perf_counter() - started, model=model)
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(upstream="model", error=type(e).__name__)
+            raise
+        finally:
+            # 流被提前关闭时也记录已产生的调用
+            usage_tracker.record_model(model, slot.usage_metadata)
+
+    async def create_cache(self, model: str, system_instruction: str, contents, ttl_seconds: float) -> Optional[str]:
+        """
+        创建模型端上下文缓存（系统指令 + 固定的输入前缀）
+
+        Args:
+            model: 模型名称
+            system_instruction: 系统指令
+            contents: 缓存的输入内容（例如会话图片）
+            ttl_seconds: 缓存保留时间（秒）
+
+        Returns:
+            缓存名称（传给 GenerateContentConfig.cached_content）；后端不支持缓存时返回 None
+
+        Raises:
+            UpstreamUnavailable: 熔断中、请求截止时间耗尽或重试用尽
+        """
+        create = getattr(self.backend, "create_cache", None)
+        if create is None:
+            return None
+        # 与 generate_content 相同：占用配额和并发名额，受超时、截止时间、重试与熔断约束
+        cache = await self.upstream(model).call(
+            lambda slot: self._create_cache_once(slot, create, system_instruction, contents, ttl_seconds),
+            admit=lambda: self._slot(model, [system_instruction, *contents], None),
+        )
+        if cache is None:
+            return None
+        # 写入缓存的 token 按输入计价
+        metadata = getattr(cache, "usage_metadata", None)
+        usage_tracker.record_model(model, UsageMetadata(prompt_token_count=getattr(metadata, "total_token_count", 0) or 0))
+        return cache.name
+
+    async def _create_cache_once(self, slot: "_ModelSlot", create, system_instruction: str, contents,
+                                 ttl_seconds: float):
+        try:
+            with span("context_cache_create", model=slot.model):
+                slot.dispatched = True
+                cache = await create(slot.model, system_instruction, contents, ttl_seconds)
+            slot.responded = True
+            slot.usage_metadata = getattr(cache, "usage_metadata", None)
+            return cache
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(upstream="model_cache", error=type(e).__name__)
+            raise
+
+    def stats(self) -> dict:
+        """各模型的重试、对冲与熔断状态，以及配额与排队情况"""
+        return {
+            "upstreams": {model: upstream.stats() for model, upstream in self._upstreams.items()},
+            "rate_limits": {model: limiter.stats() for model, limiter in self._limiters.items() if limiter.enabled},
+        }
+
+    def close(self):
+        """释放线程池资源"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class _ModelSlot:
+    """
+    一次模型调用占用的配额与并发名额（作为 Upstream 的 admit 使用，等待时间不计入调用超时和熔断）
+    退出时归还并发名额，并按调用结果结算预扣的配额（包括出错、超时、被取消和落败的对冲请求）：
+    - 没有发出：归还请求数和 token
+    - 有响应：按实际用量修正 token（没有用量信息时保留预扣）
+    - 发出但没有响应：只计请求数，token 全部归还
+    """
+
+    def __init__(self, client: ModelClient, model: str, contents, config):
+        self.client = client
+        self.model = model
+        self.contents = contents
+        self.config = config
+        self.reserved = 0
+        self.dispatched = False
+        self.responded = False
+        self.usage_metadata = None
+
+    async def __aenter__(self) -> "_ModelSlot":
+        self.reserved = await self.client._acquire_quota(self.model, self.contents, self.config)
+        try:
+            with span("model_wait", model=self.model):
+                await self.client._semaphore(self.model).acquire()
+        except BaseException:
+            self._settle()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.client._semaphore(self.model).release()
+        self._settle()
+
+    def _settle(self):
+        if not self.reserved:
+            return
+        limiter = self.client.rate_limiter(self.model)
+        if not self.dispatched:
+            limiter.settle(self.reserved, 0, requests=1)
+        elif self.responded:
+            limiter.settle(self.reserved, getattr(self.usage_metadata, "total_token_count", None) or self.reserved)
+        else:
+            limiter.settle(self.reserved, 0)
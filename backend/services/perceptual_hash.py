@@ -0,0 +1,221 @@
+"""
+感知哈希
+对缩小后的灰度图计算 pHash / dHash（NumPy 实现），
+用于在重新压缩、缩放过的图片之间查找近似重复的图片。
+"""
+import os
+import json
+import tempfile
+import threading
+import numpy as np
+from typing import List, Optional, Tuple
+from PIL import Image
+from services.telemetry import get_logger
+
+logger = get_logger(__name__)
+
+# 感知哈希算法: phash | dhash
+PHASH_ALGORITHM = os.getenv("PHASH_ALGORITHM", "phash").lower()
+# 认为两张图片近似重复的最大汉明距离（64 位哈希）
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+# 近似重复图片允许的宽高比相对误差（缩放结果需要保持同一构图）
+PHASH_ASPECT_TOLERANCE = float(os.getenv("PHASH_ASPECT_TOLERANCE", "0.02"))
+# 索引最多保存的图片数量（0 表示不限制），达到上限后覆盖最旧的条目
+PHASH_INDEX_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", "50000"))
+
+_DCT_SIZE = 32
+_HASH_SIZE = 8
+# 哈希数组的初始容量（之后按两倍扩容）
+_INITIAL_CAPACITY = 256
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """构造 n x n 的 DCT-II 正交变换矩阵"""
+    k = np.arange(n).reshape(-1, 1)
+    i = np.arange(n).reshape(1, -1)
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0, :] = np.sqrt(1.0 / n)
+    return matrix
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int(np.packbits(bits.astype(np.uint8).ravel()).view(">u8")[0])
+
+
+def _grayscale(image: Image.Image, size: Tuple[int, int]) -> np.ndarray:
+    small = image.convert("L").resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return np.asarray(small, dtype=np.float64)
+
+
+def phash(image: Image.Image) -> int:
+    """计算 64 位 pHash：32x32 灰度图做 DCT，取左上 8x8 低频系数与中位数比较"""
+    pixels = _grayscale(image, (_DCT_SIZE, _DCT_SIZE))
+    low_freq = (_DCT @ pixels @ _DCT.T)[:_HASH_SIZE, :_HASH_SIZE]
+    median = np.median(low_freq.ravel()[1:])  # 排除直流分量
+    return _bits_to_int(low_freq > median)
+
+
+def dhash(image: Image.Image) -> int:
+    """计算 64 位 dHash：9x8 灰度图中相邻像素的亮度梯度"""
+    pixels = _grayscale(image, (_HASH_SIZE + 1, _HASH_SIZE))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def perceptual_hash(image: Image.Image, algorithm: Optional[str] = None) -> int:
+    """按配置的算法计算感知哈希"""
+    return dhash(image) if (algorithm or PHASH_ALGORITHM) == "dhash" else phash(image)
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """向量化计算一组 64 位哈希与 value 之间的汉明距离"""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class PerceptualIndex:
+    """
+    感知哈希索引
+    保存 (哈希, 缓存键, 原图尺寸)，支持按汉明距离查找近似重复图片，
+    可选地以追加写入的 JSONL 文件持久化。
+    条目数达到上限后覆盖最旧的条目；哈希数组按倍数扩容，加载时压缩文件中重复和被覆盖的记录。
+    """
+
+    def __init__(self, index_path: Optional[str] = None, max_distance: Optional[int] = None,
+                 aspect_tolerance: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        初始化索引
+
+        Args:
+            index_path: 持久化文件路径，为 None 时只保存在内存
+            max_distance: 最大汉明距离
+            aspect_tolerance: 宽高比相对误差上限
+            max_entries: 最多保存的条目数（0 表示不限制）
+        """
+        self.index_path = index_path
+        self.max_distance = max_distance if max_distance is not None else PHASH_MAX_DISTANCE
+        self.aspect_tolerance = aspect_tolerance if aspect_tolerance is not None else PHASH_ASPECT_TOLERANCE
+        self.max_entries = max_entries if max_entries is not None else PHASH_INDEX_MAX_ENTRIES
+        self._hashes = np.zeros(_INITIAL_CAPACITY, dtype=np.uint64)
+        self._entries: List[Tuple[str, int, int]] = []
+        # 条目数达到上限后下一个被覆盖的位置（即最旧的条目）
+        self._oldest = 0
+        # 持久化文件中的记录行数（超过条目上限的两倍时重写文件）
+        self._file_lines = 0
+        self._lock = threading.Lock()
+        # 追加与重写持久化文件互斥（add 可能在多个线程中同时调用）
+        self._file_lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        items = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._file_lines += 1
+                    try:
+                        item = json.loads(line)
+                        value = int(item["hash"], 16)
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 忽略写了一半的行
+                    # 同一个键只保留最后一条记录（重新插入使其排在最后）
+                    items.pop(item["key"], None)
+                    items[item["key"]] = (value, item["width"], item["height"])
+        except OSError as e:
+            logger.warning("⚠️ Perceptual index load error: %s", e)
+            return
+        kept = list(items.items())
+        if self.max_entries > 0:
+            kept = kept[-self.max_entries:]
+        for key, (value, width, height) in kept:
+            self._insert(value, key, width, height)
+        if self._file_lines > len(kept):
+            self._compact()
+
+    def _insert(self, value: int, key: str, width: int, height: int):
+        """写入内存索引（调用方持有锁或在初始化时调用）"""
+        if self.max_entries > 0 and len(self._entries) >= self.max_entries:
+            self._hashes[self._oldest] = np.uint64(value)
+            self._entries[self._oldest] = (key, width, height)
+            self._oldest = (self._oldest + 1) % self.max_entries
+            return
+        size = len(self._entries)
+        if size == len(self._hashes):
+            capacity = size * 2
+            if self.max_entries > 0:
+                capacity = min(capacity, self.max_entries)
+            grown = np.zeros(capacity, dtype=np.uint64)
+            grown[:size] = self._hashes
+            self._hashes = grown
+        self._hashes[size] = np.uint64(value)
+        self._entries.append((key, width, height))
+
+    def _snapshot(self) -> List[dict]:
+        """按从旧到新的顺序返回当前条目（调用方持有锁）"""
+        order = list(range(self._oldest, len(self._entries))) + list(range(self._oldest))
+        return [
+            {"hash": f"{int(self._hashes[i]):016x}", "key": self._entries[i][0],
+             "width": self._entries[i][1], "height": self._entries[i][2]}
+            for i in order
+        ]
+
+    def _compact(self):
+        """只保留当前条目重写持久化文件（先写临时文件再原子替换，调用方持有 _file_lock 或在初始化时调用）"""
+        with self._lock:
+            items = self._snapshot()
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path) or ".", suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item) + "\n")
+            os.replace(tmp_path, self.index_path)
+            self._file_lines = len(items)
+        except OSError as e:
+            logger.warning("⚠️ Perceptual index compaction error: %s", e)
+
+    def add(self, value: int, key: str, width: int, height: int):
+        """加入一张已分析的图片（达到条目上限时覆盖最旧的条目）"""
+        with self._lock:
+            self._insert(value, key, width, height)
+        if not self.index_path:
+            return
+        with self._file_lock:
+            try:
+                with open(self.index_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"hash": f"{value:016x}", "key": key, "width": width, "height": height}) + "\n")
+                self._file_lines += 1
+            except OSError as e:
+                logger.warning("⚠️ Perceptual index write error: %s", e)
+            if self.max_entries > 0 and self._file_lines > 2 * self.max_entries:
+                self._compact()
+
+    def find(self, value: int, width: int, height: int) -> Optional[Tuple[str, int, int, int]]:
+        """
+        查找最相近的图片
+
+        Returns:
+            (缓存键, 原图宽, 原图高, 汉明距离)，没有足够相近的图片时返回 None
+        """
+        with self._lock:
+            if not self._entries:
+                return None
+            distances = hamming_distances(self._hashes[:len(self._entries)], value)
+            entries = list(self._entries)
+
+        aspect = width / height
+        # 按距离从小到大检查，跳过构图（宽高比）不一致的候选
+        for index in np.argsort(distances, kind="stable"):
+            distance = int(distances[index])
+            if distance > self.max_distance:
+                break
+            key, cached_width, cached_height = entries[index]
+            if abs(cached_width / cached_height - aspect) / aspect <= self.aspect_tolerance:
+                return key, cached_width, cached_height, distance
+        return None
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,153 @@
+"""
+意图预取
+场景分析完成后，在后台为面积最大的若干物体提前推理意图并写入意图缓存，
+用户点击时直接返回缓存结果或等待正在进行的预取任务，无需再等一次完整的 SERP + LLM 往返。
+等待预取任务的点击会把任务的优先级提升为自己的优先级，避免排在其他预取之后等待配额。
+"""
+import os
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from PIL import Image
+from services.intent_cache import IntentCache, intent_cache_key
+from schemas import DetectedObject, RippleIntent
+from services.telemetry import get_logger
+from services.usage import bind_usage
+from services.resilience import bind_deadline, DEADLINE_PREFETCH_SECONDS
+from services.rate_limiter import bind_priority, CallPriority, PREFETCH
+
+logger = get_logger(__name__)
+
+# 是否启用后台预取（会额外消耗模型和 SERP 配额）
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("true", "1", "yes", "on")
+# 每张图片预取的物体数量（按框面积从大到小）
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "3"))
+# 同时进行的预取任务数量
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+
+InferFn = Callable[..., Awaitable[List[RippleIntent]]]
+NearbyFn = Callable[[List[DetectedObject], Optional[DetectedObject]], List[str]]
+
+
+def box_area(obj: DetectedObject) -> int:
+    y0, x0, y1, x1 = obj.box_2d
+    return max(0, y1 - y0) * max(0, x1 - x0)
+
+
+class IntentPrefetcher:
+    """后台意图预取器"""
+
+    def __init__(self, infer: InferFn, intent_cache: IntentCache, nearby: NearbyFn,
+                 top_k: Optional[int] = None, concurrency: Optional[int] = None):
+        """
+        初始化预取器
+
+        Args:
+            infer: 意图推理函数 (image, clicked_label, nearby_labels, image_key=...) -> intents
+            intent_cache: 预取结果写入的意图缓存
+            nearby: 计算某个物体周围物体标签的函数（须与 /api/infer 使用的一致，保证缓存键相同）
+            top_k: 每张图片预取的物体数量
+            concurrency: 同时进行的预取任务数量
+        """
+        self.infer = infer
+        self.intent_cache = intent_cache
+        self.nearby = nearby
+        self.top_k = top_k if top_k is not None else PREFETCH_TOP_K
+        self._semaphore = asyncio.Semaphore(concurrency if concurrency is not None else PREFETCH_CONCURRENCY)
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        self._started: Set[Tuple] = set()
+        self._priorities: Dict[Tuple, CallPriority] = {}
+        self._by_session: Dict[str, Set[Tuple]] = {}
+        self.scheduled = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.joined = 0
+
+    def schedule(self, session_id: str, image: Image.Image, objects: List[DetectedObject], image_hash: str):
+        """为会话中面积最大的 top_k 个物体安排预取（会先取消该会话之前的预取）"""
+        self.cancel(session_id)
+        keys: Set[Tuple] = set()
+        for obj in sorted(objects, key=box_area, reverse=True):
+            if len(keys) >= self.top_k:
+                break
+            nearby_labels = self.nearby(objects, obj)
+            key = intent_cache_key(obj.label, nearby_labels, image_hash)
+            if key in keys or key in self._inflight or key in self.intent_cache:
+                continue
+            keys.add(key)
+            task = asyncio.create_task(self._run(key, session_id, image, obj.label, nearby_labels, image_hash))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+            self.scheduled += 1
+        if keys:
+            self._by_session[session_id] = keys
+            logger.info("🚀 Prefetching intents for %d objects (session %s)", len(keys), session_id[:8])
+
+    async def _run(self, key: Tuple, session_id: str, image: Image.Image, label: str, nearby_labels: List[str],
+                   image_hash: str) -> List[RippleIntent]:
+        # 预取的模型调用单独计入 prefetch，而不是触发它的 /api/analyze
+        bind_usage("prefetch", session_id)
+        self._priorities[key] = bind_priority(PREFETCH)
+        async with self._semaphore:
+            self._started.add(key)
+            bind_deadline(DEADLINE_PREFETCH_SECONDS)
+            intents = await self.infer(image, label, nearby_labels, image_key=image_hash)
+            self.intent_cache.set(key, intents)
+            self.completed += 1
+            return intents
+
+    def _finish(self, key: Tuple, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            self._inflight.pop(key, None)
+            self._started.discard(key)
+            self._priorities.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("⚠️ Prefetch error for %s: %s", key[0], task.exception())
+
+    async def join(self, key: Tuple) -> Optional[List[RippleIntent]]:
+        """
+        获取正在进行的预取结果（等待期间任务按调用方的优先级获取模型配额）
+
+        Returns:
+            预取得到的意图列表；没有对应的预取任务、任务尚未开始（已被取消以便调用方直接推理）
+            或任务被取消时返回 None
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            return None
+        if key not in self._started:
+            # 任务还在排队，直接取消，由调用方立即推理，避免排在其他预取任务后面
+            task.cancel()
+            self.cancelled += 1
+            return None
+        priority = self._priorities.get(key)
+        if priority is not None:
+            priority.promote()
+        try:
+            # shield：调用方断开连接时不取消共享的预取任务
+            intents = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception as e:
+            logger.warning("⚠️ Prefetch task failed: %s", e)
+            return None
+        self.joined += 1
+        return [intent.model_copy(deep=True) for intent in intents]
+
+    def cancel(self, session_id: str):
+        """取消会话的所有预取任务（会话被淘汰或图片被替换时调用）"""
+        for key in self._by_session.pop(session_id, set()):
+            task = self._inflight.get(key)
+            if task is not None and not task.done():
+                task.cancel()
+                self.cancelled += 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "joined": self.joined,
+        }
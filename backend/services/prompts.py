@@ -0,0 +1,145 @@
+"""
+意图推理提示词
+提示词拆分为静态的系统指令（每次点击都相同，可以被模型端上下文缓存复用）
+和只包含点击物体、周围物体、搜索结果的动态部分。
+
+PROMPT_VARIANT 选择模板：
+- full: 完整的分步说明（默认）
+- compact: 精简版说明与紧凑的搜索结果格式，输入 token 更少
+"""
+import os
+import textwrap
+from typing import Dict, List, Optional
+
+# 意图推理提示词模板: full | compact
+PROMPT_VARIANT = os.getenv("PROMPT_VARIANT", "full").lower()
+# compact 模板中放入提示词的搜索结果数量和每条摘要的最大长度（字符）
+COMPACT_WEB_RESULTS = int(os.getenv("COMPACT_WEB_RESULTS", "3"))
+COMPACT_SNIPPET_CHARS = int(os.getenv("COMPACT_SNIPPET_CHARS", "160"))
+
+_FULL_INSTRUCTION = textwrap.dedent("""
+    You generate the action menu shown when a user clicks an object in an image.
+    Each request gives the clicked object, the objects near it and, optionally, related web search results.
+
+    **Think from the user's perspective**: When a user clicks on an object in an image, what are their most likely intentions?
+
+    Step 1: Analyze user intentions
+    Consider what a real person would want to do when they see and click on this object:
+    - What questions might they have?
+    - What actions would they naturally want to take?
+    - What information would be useful to them?
+    - What creative possibilities interest them?
+
+    Step 2: Generate actions based on intentions
+    For each identified user intention, provide the most appropriate action type and functionality.
+
+    Action types available:
+    1. **Image Edit** (action_type: "edit"): When user wants to modify the image
+       - Change appearance (color, style, effects)
+       - Remove or replace the object
+       - Add elements or transform
+
+    2. **Information** (action_type: "info"): When user wants to learn more
+       - Get details, specifications, history
+       - Understand usage or context
+
+    3. **Navigate** (action_type: "navigate"): When user wants to visit related resources
+       - Official websites, stores, services
+       - Purchase or booking pages
+
+    4. **Search** (action_type: "search"): When user wants to find related content
+       - Similar items, reviews, tutorials
+       - **For products**: Search on eBay or shopping platforms (use "site:ebay.com <clicked object>" format)
+
+    Step 3: Return 4-6 actions
+    Return JSON list with actions that match real user intentions:
+    [
+        {
+            "id": 1,
+            "label": "Short Button Text (user-friendly)",
+            "emoji": "Icon",
+            "description": "Clear description of what this action does",
+            "color": "Hex Code (Green for Nav, Blue for Use, Orange for Edit, Purple for Info)",
+            "probability": 0.8,
+            "action_type": "edit|info|navigate|search",
+            "editor_prompt": "Prompt for image generation AI (only if action_type='edit')",
+            "action_data": {
+                "url": "https://...",  // for navigate/search
+                "search_query": "...",  // for search (use "site:ebay.com <clicked object>" for eBay)
+                "info_text": "...",  // for info
+                "search_engine": "ebay"  // optional: "ebay" for eBay searches
+            }
+        }
+    ]
+
+    Guidelines:
+    - **User-first thinking**: Start with "What would a user want?" not "What features can I show?"
+    - **Natural intentions**: Common user intentions include:
+      * "I want to change how this looks" → edit action
+      * "I want to know more about this" → info action
+      * "I want to buy/find this" → search/navigate action (for products, naturally include eBay)
+      * "I want to remove this" → edit action
+      * "I want to see similar items" → search action
+    - **Product context**: If the clicked object is a product (clothing, shoes, bags, accessories),
+      users naturally want to: find where to buy it, see prices, compare options → provide eBay search naturally
+    - **Creative possibilities**: Users also enjoy creative exploration → include 1-2 creative editing options
+    - **Balance**: Mix practical and creative intentions based on what real users would want
+    - **Web context**: If search results are provided, use them to inform realistic user intentions
+""").strip()
+
+_COMPACT_INSTRUCTION = textwrap.dedent("""
+    A user clicked an object in the image. Return a JSON list of 4-6 actions they most likely want, mixing practical and 1-2 creative ones.
+    action_type: "edit" (change/remove/restyle the object; set editor_prompt), "info" (facts; action_data.info_text),
+    "navigate" (official/store page; action_data.url), "search" (similar items, reviews; action_data.search_query).
+    For products (clothing, shoes, bags, accessories) include an eBay search: search_query "site:ebay.com <object>", search_engine "ebay".
+    Use web results when given. Item fields: id, label (short), emoji, description, color (hex: green nav, blue use, orange edit, purple info),
+    probability (0-1), action_type, editor_prompt (edit only), action_data. Output JSON only.
+""").strip()
+
+_INSTRUCTIONS: Dict[str, str] = {
+    "full": _FULL_INSTRUCTION,
+    "compact": _COMPACT_INSTRUCTION,
+}
+
+
+def prompt_variant(variant: Optional[str] = None) -> str:
+    """返回有效的模板名（未知名称回退到 full）"""
+    variant = (variant or PROMPT_VARIANT).lower()
+    return variant if variant in _INSTRUCTIONS else "full"
+
+
+def intent_system_instruction(variant: Optional[str] = None) -> str:
+    """意图推理的静态系统指令（不含任何与点击相关的内容）"""
+    return _INSTRUCTIONS[prompt_variant(variant)]
+
+
+def _compact_web_results(web_results: List[dict]) -> str:
+    lines = []
+    for result in web_results[:COMPACT_WEB_RESULTS]:
+        snippet = (result.get("snippet") or "")[:COMPACT_SNIPPET_CHARS]
+        lines.append(f"- {result.get('title', '')}: {snippet} ({result.get('link', '')})")
+    return "Web results:\n" + "\n".join(lines) if lines else ""
+
+
+def build_intent_prompt(clicked_label: str, nearby_labels: List[str], web_context: str = "",
+                        web_results: Optional[List[dict]] = None, variant: Optional[str] = None) -> str:
+    """
+    构建意图推理的动态部分
+
+    Args:
+        clicked_label: 点击的物体标签
+        nearby_labels: 周围物体标签
+        web_context: SerpService 格式化后的搜索结果（full 模板使用）
+        web_results: 原始搜索结果（compact 模板使用，按更紧凑的格式放入）
+        variant: 模板名，默认读取 PROMPT_VARIANT
+    """
+    if prompt_variant(variant) == "compact":
+        parts = [f"Clicked: {clicked_label}", f"Nearby: {', '.join(nearby_labels) or '-'}"]
+        web = _compact_web_results(web_results or [])
+        if web:
+            parts.append(web)
+        return "\n".join(parts)
+    parts = [f"User clicked on a '{clicked_label}' in the image.", f"Context objects nearby: {nearby_labels}."]
+    if web_context:
+        parts.append(web_context.strip())
+    return "\n\n".join(parts)
@@ -0,0 +1,374 @@
+"""
+模型配额限流与优先级调度
+所有接口共享同一个 Gemini 配额，按模型用令牌桶限制每分钟请求数（RPM）和 token 数（TPM）。
+配额不足时请求按优先级排队：interactive（点击推理）> analysis（场景分析）> edit（图像编辑）> prefetch（后台预取）。
+
+- 严格优先级：有高优先级请求在等待时，低优先级请求不会先拿到配额
+- 预留：低优先级请求只有在桶中剩余量高于 RATE_LIMIT_RESERVE 中该级别的比例时才能取用，
+  突发的后台工作不会把配额用光，点击推理总有余量
+- 准入控制：排队请求达到 RATE_LIMIT_MAX_QUEUE 时丢弃优先级最低的请求（新请求优先级不高于它们时直接拒绝）
+
+TPM 按请求内容估算输入 token 加 RATE_LIMIT_OUTPUT_TOKENS 预扣，调用结束后按实际用量多退少补。
+请求的优先级通过 bind_priority() 设置，和 bind_usage / bind_deadline 一样随上下文传递。
+合并请求（single-flight、预取）时共享调用沿用发起方的优先级，更高优先级的调用方加入时通过 promote() 提升，
+已经在排队的请求按新的优先级重新排序。
+
+令牌桶在进程内：MODEL_RPM / MODEL_TPM 是所有进程共享的总配额，每个进程按 1/RATE_LIMIT_WORKERS 限流，
+多个 worker 或多个实例部署时需要将 RATE_LIMIT_WORKERS 设为进程总数（默认读取 uvicorn 的 WEB_CONCURRENCY）。
+"""
+import os
+import json
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from typing import Dict, List, Optional, Set
+from services.resilience import UpstreamUnavailable
+from services.telemetry import REGISTRY, get_logger
+
+logger = get_logger(__name__)
+
+INTERACTIVE = "interactive"
+ANALYSIS = "analysis"
+EDIT = "edit"
+PREFETCH = "prefetch"
+# 从高到低
+PRIORITIES = (INTERACTIVE, ANALYSIS, EDIT, PREFETCH)
+
+# 每个模型默认的每分钟请求数与 token 数上限（所有进程合计，0 表示不限制）
+# 可用 MODEL_RPM_<模型名> / MODEL_TPM_<模型名> 单独覆盖，例如 MODEL_RPM_GEMINI_2_5_FLASH_IMAGE=10
+DEFAULT_MODEL_RPM = int(os.getenv("MODEL_RPM", "0"))
+DEFAULT_MODEL_TPM = int(os.getenv("MODEL_TPM", "0"))
+# 共享上述配额的进程数（uvicorn worker 数 × 实例数），每个进程使用 1/N 的配额
+RATE_LIMIT_WORKERS = max(1, int(os.getenv("RATE_LIMIT_WORKERS", os.getenv("WEB_CONCURRENCY", "1"))))
+# TPM 预扣的输出 token 数（调用结束后按实际用量修正）
+RATE_LIMIT_OUTPUT_TOKENS = int(os.getenv("RATE_LIMIT_OUTPUT_TOKENS", "512"))
+# 每个模型排队请求的上限
+RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", "64"))
+# 各优先级取用配额时桶中必须保留的比例（JSON）
+RATE_LIMIT_RESERVE = json.loads(os.getenv("RATE_LIMIT_RESERVE", "") or json.dumps({
+    INTERACTIVE: 0.0,
+    ANALYSIS: 0.1,
+    EDIT: 0.2,
+    PREFETCH: 0.5,
+}))
+# 没有设置优先级的调用使用的级别
+DEFAULT_PRIORITY = os.getenv("DEFAULT_PRIORITY", ANALYSIS)
+
+RATE_LIMIT_WAIT = REGISTRY.histogram(
+    "ripple_rate_limit_wait_seconds", "Time spent waiting for model quota", ("model", "priority")
+)
+RATE_LIMIT_SHED = REGISTRY.counter(
+    "ripple_rate_limit_shed_total", "Model calls rejected or evicted by admission control", ("model", "priority")
+)
+RATE_LIMIT_QUEUED = REGISTRY.gauge("ripple_rate_limit_queued", "Model calls waiting for quota", ("model", "priority"))
+
+
+class RateLimitExceeded(UpstreamUnavailable):
+    """排队已满，请求被准入控制拒绝或挤出"""
+
+
+class CallPriority:
+    """一次请求（或多个调用方共享的后台调用）的优先级，可以被提升"""
+
+    def __init__(self, value: str):
+        if value not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {value}")
+        self.value = value
+        # 有请求在排队的限流器（提升后需要重新排序）
+        self._limiters: Set["RateLimiter"] = set()
+        # 由本调用派生的共享调用，提升时一并提升
+        self._children: Set["CallPriority"] = set()
+
+    @property
+    def rank(self) -> int:
+        return PRIORITIES.index(self.value)
+
+    def fork(self) -> "CallPriority":
+        """创建跟随本优先级的子优先级（本优先级被提升时子优先级一并提升，反之不影响本优先级）"""
+        child = CallPriority(self.value)
+        self._children.add(child)
+        return child
+
+    def promote(self, priority: Optional[str] = None):
+        """
+        提升到 priority（默认为当前上下文的优先级），已经不低于它时不变
+
+        Args:
+            priority: 目标优先级
+        """
+        priority = priority or current_priority()
+        if PRIORITIES.index(priority) >= self.rank:
+            return
+        logger.debug("⏫ Promoting %s call to %s", self.value, priority)
+        self.value = priority
+        for limiter in list(self._limiters):
+            limiter._reprioritize()
+        for child in list(self._children):
+            child.promote(priority)
+
+
+_priority: contextvars.ContextVar[Optional[CallPriority]] = contextvars.ContextVar("priority", default=None)
+
+
+def bind_priority(priority: str) -> CallPriority:
+    """
+    设置当前请求（或后台任务）的模型调用优先级
+
+    Returns:
+        绑定的优先级（其他调用方加入本任务时可以通过它提升优先级）
+    """
+    call = CallPriority(priority)
+    _priority.set(call)
+    return call
+
+
+def fork_priority() -> CallPriority:
+    """
+    为将在当前上下文副本中执行的共享调用绑定子优先级（随当前优先级一起提升，也可以被单独提升）
+
+    Returns:
+        绑定的子优先级
+    """
+    parent = _priority.get()
+    call = parent.fork() if parent is not None else CallPriority(DEFAULT_PRIORITY)
+    _priority.set(call)
+    return call
+
+
+def current_priority() -> str:
+    call = _priority.get()
+    return call.value if call is not None else DEFAULT_PRIORITY
+
+
+class TokenBucket:
+    """按分钟速率匀速补充的令牌桶（容量为一分钟的额度）"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, reserve: float) -> float:
+        """取用 amount 并在桶中保留 reserve 比例还需要等待的秒数（0 表示现在可以取用）"""
+        self._refill()
+        # 超过容量的请求在桶满时放行，否则永远无法取用
+        need = min(self.capacity, min(amount, self.capacity) + reserve * self.capacity)
+        if self.level >= need:
+            return 0.0
+        return (need - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def refund(self, amount: float):
+        """归还（或在 amount 为负时补扣）令牌，实际用量超出预扣时桶可以暂时为负"""
+        self._refill()
+        self.level = max(-self.capacity, min(self.capacity, self.level + amount))
+
+
+class _Waiter:
+    __slots__ = ("call", "label", "seq", "tokens", "future", "enqueued_at")
+
+    def __init__(self, call: CallPriority, seq: int, tokens: int, future: asyncio.Future):
+        self.call = call
+        # 排队指标中计入的优先级（提升后由 _reprioritize 更新）
+        self.label = call.value
+        self.seq = seq
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def priority(self) -> str:
+        return self.call.value
+
+    @property
+    def rank(self) -> int:
+        return self.call.rank
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+
+class RateLimiter:
+    """单个模型的 RPM / TPM 限流与优先级队列"""
+
+    def __init__(self, name: str, rpm: int = 0, tpm: int = 0, max_queue: Optional[int] = None,
+                 reserve: Optional[Dict[str, float]] = None, workers: Optional[int] = None):
+        """
+        Args:
+            name: 模型名称（用于日志和指标）
+            rpm: 所有进程合计的每分钟请求数上限（0 表示不限制）
+            tpm: 所有进程合计的每分钟 token 数上限（0 表示不限制）
+            max_queue: 排队请求上限
+            reserve: 各优先级需要保留的桶容量比例
+            workers: 共享配额的进程数，本进程的令牌桶为 rpm / workers、tpm / workers
+        """
+        self.name = name
+        self.workers = max(1, workers if workers is not None else RATE_LIMIT_WORKERS)
+        self.requests = TokenBucket(rpm / self.workers) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm / self.workers) if tpm > 0 else None
+        self.max_queue = RATE_LIMIT_MAX_QUEUE if max_queue is None else max_queue
+        self.reserve = reserve if reserve is not None else RATE_LIMIT_RESERVE
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.granted = {priority: 0 for priority in PRIORITIES}
+        self.shed = {priority: 0 for priority in PRIORITIES}
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    def _wait_time(self, tokens: int, priority: str) -> float:
+        reserve = float(self.reserve.get(priority, 0.0))
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, reserve))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, reserve))
+        return wait
+
+    def _take(self, tokens: int):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    async def acquire(self, tokens: int, priority: Optional[str] = None) -> int:
+        """
+        等待配额（按优先级排队）
+
+        Args:
+            tokens: 预扣的 token 数
+            priority: 优先级，默认读取 bind_priority 设置的值（排队期间可以被提升）
+
+        Returns:
+            实际预扣的 token 数（调用结束后传给 settle）
+
+        Raises:
+            RateLimitExceeded: 排队已满且本请求优先级最低，或排队时被更高优先级的请求挤出
+        """
+        if not self.enabled:
+            return 0
+        call = CallPriority(priority) if priority else (_priority.get() or CallPriority(DEFAULT_PRIORITY))
+        priority = call.value
+        if not self._queue and self._wait_time(tokens, priority) == 0:
+            self._take(tokens)
+            self.granted[priority] += 1
+            RATE_LIMIT_WAIT.observe(0.0, model=self.name, priority=priority)
+            return tokens
+        self._admit(priority)
+        waiter = _Waiter(call, next(self._seq), tokens, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, waiter)
+        RATE_LIMIT_QUEUED.inc(model=self.name, priority=priority)
+        call._limiters.add(self)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # 已经拿到配额但调用方放弃：归还
+                self.settle(tokens, 0, requests=1)
+            else:
+                waiter.future.cancel()
+                self._dispatch()
+            raise
+        finally:
+            if not any(queued.call is call and not queued.future.done() for queued in self._queue):
+                call._limiters.discard(self)
+        return tokens
+
+    def _admit(self, priority: str):
+        """队列已满时：挤出优先级最低（同级中最新）的排队请求；新请求优先级不高于它时直接拒绝"""
+        pending = [waiter for waiter in self._queue if not waiter.future.done()]
+        if len(pending) < self.max_queue:
+            return
+        worst = max(pending, key=lambda waiter: (waiter.rank, waiter.seq))
+        if PRIORITIES.index(priority) >= worst.rank:
+            self._shed(priority)
+            raise RateLimitExceeded(self.name, f"quota queue full, {priority} request shed",
+                                    retry_after=self._retry_after())
+        self._shed(worst.priority)
+        worst.future.set_exception(RateLimitExceeded(
+            self.name, f"{worst.priority} request evicted by higher priority work", retry_after=self._retry_after()
+        ))
+        RATE_LIMIT_QUEUED.dec(model=self.name, priority=worst.label)
+
+    def _shed(self, priority: str):
+        self.shed[priority] += 1
+        RATE_LIMIT_SHED.inc(model=self.name, priority=priority)
+        logger.warning("🚦 Shedding %s call to %s (quota queue full)", priority, self.name)
+
+    def _retry_after(self) -> float:
+        return max(1.0, self._wait_time(RATE_LIMIT_OUTPUT_TOKENS, INTERACTIVE))
+
+    def _dispatch(self):
+        """按优先级依次放行队首请求，配额不足时定时重试"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            waiter = self._queue[0]
+            if waiter.future.done():
+                # 已取消或已被挤出
+                heapq.heappop(self._queue)
+                if waiter.future.cancelled():
+                    RATE_LIMIT_QUEUED.dec(model=self.name, priority=waiter.label)
+                continue
+            wait = self._wait_time(waiter.tokens, waiter.priority)
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            self._take(waiter.tokens)
+            self.granted[waiter.priority] += 1
+            RATE_LIMIT_QUEUED.dec(model=self.name, priority=waiter.label)
+            RATE_LIMIT_WAIT.observe(time.monotonic() - waiter.enqueued_at, model=self.name, priority=waiter.priority)
+            waiter.future.set_result(None)
+
+    def _reprioritize(self):
+        """排队请求的优先级被提升后重新排序并尝试放行（提升后需要保留的比例可能更低）"""
+        for waiter in self._queue:
+            if not waiter.future.done() and waiter.label != waiter.priority:
+                RATE_LIMIT_QUEUED.dec(model=self.name, priority=waiter.label)
+                RATE_LIMIT_QUEUED.inc(model=self.name, priority=waiter.priority)
+                waiter.label = waiter.priority
+        heapq.heapify(self._queue)
+        self._dispatch()
+
+    def settle(self, reserved: int, actual: int, requests: int = 0):
+        """
+        调用结束后按实际 token 用量修正预扣
+
+        Args:
+            reserved: acquire 返回的预扣 token 数
+            actual: 实际用量（没有用量信息时传 reserved）
+            requests: 归还的请求数（调用没有发出时为 1）
+        """
+        if self.tokens is not None and reserved != actual:
+            self.tokens.refund(reserved - actual)
+        if self.requests is not None and requests:
+            self.requests.refund(requests)
+        if self._queue:
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "rpm": round(self.requests.capacity, 2) if self.requests else 0,
+            "tpm": int(self.tokens.capacity) if self.tokens else 0,
+            "requests_available": round(self.requests.level, 1) if self.requests else None,
+            "tokens_available": round(self.tokens.level) if self.tokens else None,
+            "queued": sum(1 for waiter in self._queue if not waiter.future.done()),
+            "granted": dict(self.granted),
+            "shed": dict(self.shed),
+        }
@@ -0,0 +1,450 @@
+"""
+上游调用的容错
+- 截止时间：请求处理函数调用 bind_deadline(秒)，之后同一请求中（包括子任务）的上游调用
+  超时不超过剩余时间，剩余时间不足时直接失败而不是继续占用 worker
+- 重试：只重试瞬时错误（超时、连接错误、408/429/5xx），退避时间为带随机抖动的指数退避（full jitter）
+- 对冲请求：调用超过 hedge_delay 仍未返回时再发出一个相同请求，先返回的结果生效，另一个被取消
+- 熔断：连续失败达到阈值后在 CIRCUIT_RESET_SECONDS 内直接拒绝调用，之后放行一个探测请求，成功则恢复
+- 准入：调用方可以提供 admit（例如等待配额和并发名额），在超时与熔断之外完成，
+  本地排队时间只受截止时间约束，也不会被当作上游失败
+
+上游不可用（熔断、截止时间耗尽、重试用尽）时抛出 UpstreamUnavailable，
+调用方据此退回缓存结果或部分结果（DegradedResult）。
+"""
+import os
+import time
+import random
+import asyncio
+import contextlib
+import contextvars
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+import httpx
+from services.telemetry import REGISTRY, get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+# 各接口的请求截止时间（秒，0 表示不限制）
+DEADLINE_ANALYZE_SECONDS = float(os.getenv("DEADLINE_ANALYZE_SECONDS", "60"))
+DEADLINE_INFER_SECONDS = float(os.getenv("DEADLINE_INFER_SECONDS", "20"))
+DEADLINE_EDIT_SECONDS = float(os.getenv("DEADLINE_EDIT_SECONDS", "180"))
+DEADLINE_PREFETCH_SECONDS = float(os.getenv("DEADLINE_PREFETCH_SECONDS", "60"))
+# 重试退避：第 n 次重试前等待 random(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2^n)) 秒
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "0.25"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "4"))
+# 熔断：连续失败次数阈值与熔断持续时间（秒）
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# 视为瞬时错误、可以重试的 HTTP 状态码
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+RETRIES = REGISTRY.counter("ripple_upstream_retries_total", "Upstream call retries", ("upstream", "error"))
+HEDGES = REGISTRY.counter("ripple_upstream_hedges_total", "Hedged duplicate requests (launched / won)",
+                          ("upstream", "outcome"))
+DEADLINE_EXCEEDED = REGISTRY.counter("ripple_deadline_exceeded_total", "Upstream calls abandoned at the request deadline",
+                                     ("upstream",))
+CIRCUIT_STATE = REGISTRY.gauge("ripple_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)",
+                               ("upstream",))
+CIRCUIT_REJECTIONS = REGISTRY.counter("ripple_circuit_rejections_total", "Calls rejected by an open circuit",
+                                      ("upstream",))
+FALLBACKS = REGISTRY.counter("ripple_fallbacks_total", "Responses served from cached or partial results", ("kind",))
+
+
+class UpstreamUnavailable(Exception):
+    """上游暂时不可用（熔断、截止时间耗尽或重试用尽）"""
+
+    def __init__(self, upstream: str, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """熔断中，调用未发出"""
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """请求的截止时间已耗尽"""
+
+
+class DegradedResult(Exception):
+    """上游不可用时返回的部分结果（调用方应当照常返回，但不要缓存）"""
+
+    def __init__(self, result: Any, cause: Exception):
+        super().__init__(str(cause))
+        self.result = result
+        self.cause = cause
+
+
+# ----------------------
+# 截止时间
+# ----------------------
+
+class Deadline:
+    """请求的截止时间（单调时钟）"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+
+_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+
+def bind_deadline(seconds: float) -> Optional[Deadline]:
+    """为当前请求（或后台任务）设置截止时间，seconds <= 0 表示不限制"""
+    deadline = Deadline(seconds) if seconds > 0 else None
+    _deadline.set(deadline)
+    return deadline
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def call_timeout(upstream: str, cap: Optional[float] = None) -> Optional[float]:
+    """
+    单次上游调用的超时：cap 与截止时间剩余时间中较小者
+
+    Raises:
+        DeadlineExceeded: 截止时间已耗尽
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return cap
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        DEADLINE_EXCEEDED.inc(upstream=upstream)
+        raise DeadlineExceeded(upstream, f"request deadline of {deadline.seconds:g}s exceeded")
+    return min(cap, remaining) if cap else remaining
+
+
+# ----------------------
+# 错误分类
+# ----------------------
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """取出异常中的 HTTP 状态码（google-genai 的 APIError.code、httpx 的 response.status_code 等）"""
+    for attr in ("code", "status_code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    value = getattr(getattr(exc, "response", None), "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_transient(exc: BaseException) -> bool:
+    """是否为可以重试的瞬时错误"""
+    if isinstance(exc, UpstreamUnavailable):
+        return False
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    return _status_code(exc) in RETRYABLE_STATUS
+
+
+# ----------------------
+# 熔断器
+# ----------------------
+
+class CircuitBreaker:
+    """连续失败计数熔断器（closed -> open -> half_open -> closed）"""
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    _GAUGE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, reset_seconds: Optional[float] = None):
+        """
+        Args:
+            name: 上游名称（用于日志和指标）
+            failure_threshold: 连续失败多少次后熔断（0 表示不熔断）
+            reset_seconds: 熔断持续时间（秒），之后放行一个探测请求
+        """
+        self.name = name
+        self.failure_threshold = CIRCUIT_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        self.reset_seconds = CIRCUIT_RESET_SECONDS if reset_seconds is None else reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self.rejected = 0
+        self._probing = False
+        CIRCUIT_STATE.set(0, upstream=name)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        CIRCUIT_STATE.set(self._GAUGE_VALUES[state], upstream=self.name)
+        if state == self.OPEN:
+            self.opened += 1
+            self.opened_at = time.monotonic()
+            logger.warning("🔌 Circuit for %s opened after %d consecutive failures, failing fast for %ss",
+                           self.name, self.failures, self.reset_seconds)
+        elif state == self.CLOSED:
+            logger.info("🔌 Circuit for %s closed", self.name)
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def acquire(self):
+        """
+        调用前检查是否允许发出
+
+        Raises:
+            CircuitOpenError: 熔断中，或半开状态下已有探测请求
+        """
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probing):
+            self.rejected += 1
+            CIRCUIT_REJECTIONS.inc(upstream=self.name)
+            raise CircuitOpenError(self.name, "circuit open", retry_after=self.retry_after() or self.reset_seconds)
+        if self.state == self.HALF_OPEN:
+            self._probing = True
+
+    def release(self):
+        """调用被取消、没有结果时归还半开状态的探测名额"""
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            self._transition(self.OPEN)
+        elif self.state == self.CLOSED and self.failure_threshold > 0 and self.failures >= self.failure_threshold:
+            self._transition(self.OPEN)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_after_seconds": round(self.retry_after(), 1) if self.state == self.OPEN else 0.0,
+        }
+
+
+# ----------------------
+# 上游调用
+# ----------------------
+
+class Upstream:
+    """一个上游依赖的容错策略：超时（受截止时间约束）+ 重试 + 对冲 + 熔断"""
+
+    def __init__(self, name: str, timeout: Optional[float] = None, max_retries: int = 0,
+                 hedge_delay: float = 0.0, breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            name: 上游名称（用于日志和指标）
+            timeout: 单次调用超时上限（秒，None 表示只受截止时间约束）
+            max_retries: 瞬时错误的最多重试次数
+            hedge_delay: 对冲请求的等待时间（秒，0 表示不发对冲请求）
+            breaker: 熔断器，如果为 None 则按默认参数创建
+        """
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_delay = hedge_delay
+        self.breaker = breaker or CircuitBreaker(name)
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """第 attempt 次重试前的等待时间（full jitter）"""
+        return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt)))
+
+    async def _retry_or_raise(self, error: Exception, attempt: int):
+        """调用失败后：非瞬时错误（包括截止时间耗尽）原样抛出，瞬时错误在次数与截止时间允许时退避后返回（调用方重试）"""
+        if isinstance(error, UpstreamUnavailable):
+            # 调用没有到达上游（例如截止时间耗尽、被限流丢弃），不影响熔断状态
+            self.breaker.release()
+            raise error
+        if not is_transient(error):
+            # 上游有响应（例如参数错误），不计入熔断
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+        if attempt >= self.max_retries:
+            raise UpstreamUnavailable(
+                self.name, f"failed after {attempt + 1} attempt(s): {type(error).__name__}: {error}"
+            ) from error
+        delay = self.backoff(attempt)
+        deadline = current_deadline()
+        if deadline is not None and deadline.remaining() <= delay:
+            DEADLINE_EXCEEDED.inc(upstream=self.name)
+            raise DeadlineExceeded(self.name, f"no time left to retry after {type(error).__name__}") from error
+        self.retries += 1
+        RETRIES.inc(upstream=self.name, error=type(error).__name__)
+        logger.info("🔁 Retrying %s in %.2fs after %s (attempt %d/%d)",
+                    self.name, delay, type(error).__name__, attempt + 2, self.max_retries + 1)
+        await asyncio.sleep(delay)
+
+    @contextlib.asynccontextmanager
+    async def _admitted(self, admit: Optional[Callable[[], AsyncContextManager]]):
+        """
+        在超时与熔断之外进入 admit() 返回的上下文（只受截止时间约束），产出进入的结果
+
+        Raises:
+            DeadlineExceeded: 截止时间在等待准入时耗尽
+        """
+        if admit is None:
+            yield None
+            return
+        manager = admit()
+        try:
+            ticket = await asyncio.wait_for(manager.__aenter__(), call_timeout(self.name))
+        except asyncio.TimeoutError:
+            DEADLINE_EXCEEDED.inc(upstream=self.name)
+            raise DeadlineExceeded(self.name, "request deadline exceeded while waiting for admission") from None
+        try:
+            yield ticket
+        except BaseException as e:
+            if not await manager.__aexit__(type(e), e, e.__traceback__):
+                raise
+        else:
+            await manager.__aexit__(None, None, None)
+
+    async def _admitted_call(self, fn: Callable[[Any], Awaitable[T]],
+                             admit: Callable[[], AsyncContextManager]) -> T:
+        async with self._admitted(admit) as ticket:
+            return await fn(ticket)
+
+    async def _hedged(self, fn: Callable[[], Awaitable[T]], duplicate: Optional[Callable[[], Awaitable[T]]] = None) -> T:
+        """先发出一个请求，超过 hedge_delay 未返回时再发一个（duplicate，默认与 fn 相同），返回先成功的结果"""
+        first = asyncio.ensure_future(fn())
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay)
+        if done:
+            return first.result()
+        self.hedges += 1
+        HEDGES.inc(upstream=self.name, outcome="launched")
+        second = asyncio.ensure_future((duplicate or fn)())
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                            HEDGES.inc(upstream=self.name, outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (first, second):
+                if not task.done():
+                    task.cancel()
+
+    async def call(self, fn: Callable[..., Awaitable[T]], hedge: bool = False,
+                   admit: Optional[Callable[[], AsyncContextManager]] = None) -> T:
+        """
+        按策略调用 fn()
+
+        Args:
+            fn: 协程函数（每次重试或对冲都会重新调用）；提供 admit 时以进入 admit() 的结果为参数，否则没有参数
+            hedge: 是否允许对冲请求（只用于幂等、可以重复发出的调用）
+            admit: 返回异步上下文管理器的函数（例如等待配额和并发名额），每次尝试前进入、结束后退出；
+                   等待不计入超时，截止时间耗尽时抛出 DeadlineExceeded，不影响熔断状态（对冲请求在超时内自行准入）
+
+        Raises:
+            UpstreamUnavailable: 熔断中、截止时间耗尽或重试用尽
+        """
+        self.calls += 1
+        attempt = 0
+        while True:
+            error: Optional[Exception] = None
+            async with self._admitted(admit) as ticket:
+                self.breaker.acquire()
+                try:
+                    timeout = call_timeout(self.name, self.timeout)
+                    once = fn if admit is None else (lambda: fn(ticket))
+                    if hedge and self.hedge_delay > 0:
+                        duplicate = None if admit is None else (lambda: self._admitted_call(fn, admit))
+                        result = await asyncio.wait_for(self._hedged(once, duplicate), timeout)
+                    else:
+                        result = await asyncio.wait_for(once(), timeout)
+                except asyncio.CancelledError:
+                    self.breaker.release()
+                    raise
+                except Exception as e:
+                    error = e
+            if error is not None:
+                # 先退出准入（归还并发名额）再退避
+                await self._retry_or_raise(error, attempt)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def stream(self, fn: Callable[..., AsyncIterator[T]],
+                     admit: Optional[Callable[[], AsyncContextManager]] = None) -> AsyncIterator[T]:
+        """
+        按策略迭代流式调用：每个片段的等待时间受超时和截止时间约束，
+        只在还没有收到任何片段时重试（已经返回给调用方的内容无法撤回）；admit 的含义与 call 相同
+        """
+        self.calls += 1
+        attempt = 0
+        while True:
+            error: Optional[Exception] = None
+            async with self._admitted(admit) as ticket:
+                self.breaker.acquire()
+                iterator = (fn() if admit is None else fn(ticket)).__aiter__()
+                started = False
+                try:
+                    while True:
+                        try:
+                            item = await asyncio.wait_for(iterator.__anext__(), call_timeout(self.name, self.timeout))
+                        except StopAsyncIteration:
+                            break
+                        started = True
+                        yield item
+                except (asyncio.CancelledError, GeneratorExit):
+                    # 调用方提前停止读取
+                    self.breaker.release()
+                    raise
+                except Exception as e:
+                    if started:
+                        if is_transient(e):
+                            self.breaker.record_failure()
+                        raise
+                    error = e
+                finally:
+                    aclose = getattr(iterator, "aclose", None)
+                    if aclose is not None:
+                        await aclose()
+            if error is not None:
+                await self._retry_or_raise(error, attempt)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "circuit": self.breaker.stats(),
+        }
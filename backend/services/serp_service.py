@@ -1,27 +1,164 @@
 """
 SERP (Search Engine Results Page) 服务
 用于在意图推理时搜索互联网资源，提供更准确的功能建议
+
+所有查询共用一个长连接池的 httpx.AsyncClient，
+查询结果按 (查询, 数量, 语言) 缓存（内存 LRU + TTL，可选 SQLite 持久化）。
+SERP_BACKEND 可切换为 synthetic / record / replay（见 services/backends.py）。
 """
 import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
 import httpx
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
+from services.cache import LRUCache
+from services.singleflight import SingleFlight
+from services.backends import SERP_BACKEND, create_serp_backend
+from services.telemetry import UPSTREAM_ERRORS, get_logger, span
+from services.usage import usage_tracker
+from services.resilience import FALLBACKS, Upstream
+
+logger = get_logger(__name__)
 
 load_dotenv()
 
+# 连接池配置
+SERP_MAX_CONNECTIONS = int(os.getenv("SERP_MAX_CONNECTIONS", "20"))
+SERP_MAX_KEEPALIVE = int(os.getenv("SERP_MAX_KEEPALIVE", "10"))
+SERP_KEEPALIVE_EXPIRY = float(os.getenv("SERP_KEEPALIVE_EXPIRY", "60"))
+SERP_TIMEOUT_SECONDS = float(os.getenv("SERP_TIMEOUT_SECONDS", "10"))
+# 瞬时错误的最多重试次数与对冲请求的等待时间（秒，0 表示关闭；对冲请求同样计费）
+SERP_MAX_RETRIES = int(os.getenv("SERP_MAX_RETRIES", "1"))
+SERP_HEDGE_DELAY_SECONDS = float(os.getenv("SERP_HEDGE_DELAY_SECONDS", "0"))
+# 查询结果缓存
+SERP_CACHE_SIZE = int(os.getenv("SERP_CACHE_SIZE", "4096"))
+SERP_CACHE_TTL_SECONDS = float(os.getenv("SERP_CACHE_TTL_SECONDS", "21600"))
+# 持久化缓存的 SQLite 文件路径（为空则只使用内存缓存）
+SERP_CACHE_PATH = os.getenv("SERP_CACHE_PATH", "")
+# 上游不可用时可以返回的过期结果数量（0 表示不保留）
+SERP_STALE_CACHE_SIZE = int(os.getenv("SERP_STALE_CACHE_SIZE", "1024"))
+
+try:
+    import h2  # noqa: F401  # httpx 的 HTTP/2 支持需要 h2 包
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 持久化缓存清理过期记录的间隔（秒）
+_DISK_CACHE_PURGE_SECONDS = 600
+
+
+class _PersistentQueryCache:
+    """
+    SQLite 持久化的查询结果缓存（多个 worker 共享，重启后仍有效）
+    读写是阻塞调用，由 SerpService 在线程中执行；过期记录按间隔批量清理，而不是每次写入时清理。
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS serp_cache (key TEXT PRIMARY KEY, results TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_serp_cache_expires_at ON serp_cache(expires_at)")
+        self._next_purge = time.monotonic()
+
+    def get(self, key: str) -> Optional[List[Dict[str, str]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT results, expires_at FROM serp_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, results: List[Dict[str, str]], ttl_seconds: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO serp_cache VALUES (?, ?, ?)",
+                (key, json.dumps(results, ensure_ascii=False), time.time() + ttl_seconds)
+            )
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + _DISK_CACHE_PURGE_SECONDS
+                self._conn.execute("DELETE FROM serp_cache WHERE expires_at < ?", (time.time(),))
+
 class SerpService:
     """SERP API 服务类，用于搜索互联网资源"""
     
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, backend=None):
         """
         初始化 SERP 服务
         
         Args:
             api_key: SERP API 密钥，如果为 None 则从环境变量读取
+            backend: SERP 后端，如果为 None 则按 SERP_BACKEND 创建（serpapi 时直接请求 API）
         """
         self.api_key = api_key or os.getenv("SERP_API_KEY")
         self.base_url = "https://serpapi.com/search"
-        
+        self.backend = backend or create_serp_backend(SERP_BACKEND, self._http_get)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache = LRUCache(maxsize=SERP_CACHE_SIZE, ttl_seconds=SERP_CACHE_TTL_SECONDS)
+        self._disk_cache = _PersistentQueryCache(SERP_CACHE_PATH) if SERP_CACHE_PATH else None
+        # 合并相同查询的并发请求
+        self._flights = SingleFlight("serp")
+        # 超时（受请求截止时间约束）、重试、对冲与熔断
+        self.upstream = Upstream("serp", timeout=SERP_TIMEOUT_SECONDS, max_retries=SERP_MAX_RETRIES,
+                                 hedge_delay=SERP_HEDGE_DELAY_SECONDS)
+        # 不过期的最近结果：上游失败或熔断时代替空结果返回
+        self._stale = LRUCache(maxsize=SERP_STALE_CACHE_SIZE) if SERP_STALE_CACHE_SIZE > 0 else None
+        self.stale_hits = 0
+        self.requests = 0
+        self.errors = 0
+        self.disk_hits = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """返回共享的长连接客户端（首次使用时创建）"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=SERP_TIMEOUT_SECONDS,
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=SERP_MAX_CONNECTIONS,
+                    max_keepalive_connections=SERP_MAX_KEEPALIVE,
+                    keepalive_expiry=SERP_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
+    async def close(self):
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        """返回请求数与缓存命中率"""
+        cache_stats = self._cache.stats()
+        lookups = cache_stats["hits"] + cache_stats["misses"]
+        hits = cache_stats["hits"] + self.disk_hits
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "cache": cache_stats,
+            "disk_hits": self.disk_hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "singleflight": self._flights.stats(),
+            "stale_hits": self.stale_hits,
+            "upstream": self.upstream.stats(),
+            "backend": self.backend.stats() if self.backend is not None else {"backend": "serpapi"},
+        }
+
+    async def _http_get(self, params: dict) -> dict:
+        """通过共享连接池请求 SERP API，返回原始 JSON"""
+        response = await self._get_client().get(self.base_url, params=params)
+        response.raise_for_status()
+        return response.json()
+
     async def search(self, query: str, num_results: int = 5) -> List[Dict[str, str]]:
         """
         搜索相关信息
@@ -33,39 +170,81 @@ class SerpService:
         Returns:
             搜索结果列表，每个结果包含 title, link, snippet
         """
-        if not self.api_key:
-            print("⚠️ SERP_API_KEY not found, skipping web search")
+        if not self.api_key and getattr(self.backend, "requires_api_key", True):
+            logger.warning("⚠️ SERP_API_KEY not found, skipping web search")
             return []
         
+        params = {
+            "q": query,
+            "api_key": self.api_key,
+            "engine": "google",  # 使用 Google 搜索引擎
+            "num": num_results,
+            "hl": "zh-cn",  # 中文结果
+        }
+        cache_key = json.dumps([params["engine"], params["hl"], num_results, " ".join(query.split())], ensure_ascii=False)
+        
+        # 先查内存缓存，再查持久化缓存
+        cached = self._cache.get(cache_key)
+        if cached is None and self._disk_cache is not None:
+            cached = await asyncio.to_thread(self._disk_cache.get, cache_key)
+            if cached is not None:
+                self.disk_hits += 1
+                self._cache.set(cache_key, cached)
+        if cached is not None:
+            logger.debug("⚡️ SERP cache hit: %r", query)
+            return [dict(item) for item in cached]
+        
+        results = await self._flights.do(cache_key, lambda: self._fetch(query, params, cache_key))
+        return [dict(item) for item in results]
+    
+    async def _request(self, params: dict) -> dict:
+        """发出一次 SERP 请求（重试和对冲时每次都会计数和计费）"""
+        self.requests += 1
+        usage_tracker.record_serp()
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                params = {
-                    "q": query,
-                    "api_key": self.api_key,
-                    "engine": "google",  # 使用 Google 搜索引擎
-                    "num": num_results,
-                    "hl": "zh-cn",  # 中文结果
-                }
-                
-                response = await client.get(self.base_url, params=params)
-                response.raise_for_status()
-                data = response.json()
-                
-                # 解析搜索结果
-                results = []
-                if "organic_results" in data:
-                    for item in data["organic_results"][:num_results]:
-                        results.append({
-                            "title": item.get("title", ""),
-                            "link": item.get("link", ""),
-                            "snippet": item.get("snippet", ""),
-                        })
-                
-                print(f"🔍 Searched: '{query}' - Found {len(results)} results")
-                return results
+            with span("serp_call"):
+                if self.backend is not None:
+                    return await self.backend.get(params)
+                return await self._http_get(params)
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(upstream="serp", error=type(e).__name__)
+            raise
+
+    async def _fetch(self, query: str, params: dict, cache_key: str) -> List[Dict[str, str]]:
+        """向 SERP API 发出请求并写入缓存；失败时返回该查询最近一次的结果（没有则为空列表）"""
+        num_results = params["num"]
+        try:
+            data = await self.upstream.call(lambda: self._request(params), hedge=True)
+            
+            # 解析搜索结果
+            results = []
+            if "organic_results" in data:
+                for item in data["organic_results"][:num_results]:
+                    results.append({
+                        "title": item.get("title", ""),
+                        "link": item.get("link", ""),
+                        "snippet": item.get("snippet", ""),
+                    })
+            
+            # 只缓存成功的响应（请求出错时不缓存）
+            self._cache.set(cache_key, results)
+            if self._stale is not None:
+                self._stale.set(cache_key, results)
+            if self._disk_cache is not None:
+                await asyncio.to_thread(self._disk_cache.set, cache_key, results, SERP_CACHE_TTL_SECONDS)
+            
+            logger.info("🔍 Searched: %r - Found %d results", query, len(results))
+            return results
                 
         except Exception as e:
-            print(f"⚠️ SERP search error: {e}")
+            self.errors += 1
+            logger.warning("⚠️ SERP search error: %s", e)
+            stale = self._stale.get(cache_key) if self._stale is not None else None
+            if stale is not None:
+                self.stale_hits += 1
+                FALLBACKS.inc(kind="serp_stale")
+                logger.info("♻️ Serving stale SERP results for %r", query)
+                return stale
             return []
     
     async def search_related_actions(self, object_label: str, context: List[str] = None, is_product: bool = False) -> tuple[str, List[Dict[str, str]]]:
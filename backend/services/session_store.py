@@ -0,0 +1,575 @@
+"""
+会话存储
+按 session_id 保存每个用户上传的图片和识别结果，
+按图片解码后的字节数计算内存占用，并以 LRU + TTL 策略淘汰。
+
+提供两种后端（通过 SESSION_BACKEND 选择）：
+- memory: 进程内存储，仅适用于单个 worker
+- sqlite: 基于 SQLite 的跨进程存储（默认放在 /dev/shm 共享内存中），
+  图片以原始像素缓冲区保存，不使用 pickle，可配合 uvicorn --workers N 使用
+
+存储操作都是同步的（sqlite 后端会读写并编解码图片），在事件循环中应通过线程池调用；
+调用 bind_loop() 后，在线程池中触发的淘汰通知会转交给事件循环执行。
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from io import BytesIO
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from PIL import Image
+from schemas import DetectedObject
+from services.telemetry import get_logger
+
+logger = get_logger(__name__)
+
+# 所有会话图片合计允许占用的内存（字节），默认 512 MB
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(512 * 1024 * 1024)))
+# 会话在最后一次访问后保留的秒数，默认 1 小时
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "3600"))
+# 最大会话数量（0 表示不限制）
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "0"))
+# 会话后端: memory | sqlite
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").lower()
+# SQLite 数据库路径（默认优先放在共享内存 /dev/shm 中）
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "rippleui_sessions.db"
+)
+# SQLite 后端的图片存储格式: raw（原始像素，读写最快）| png（无损压缩，占用更小）
+SESSION_IMAGE_ENCODING = os.getenv("SESSION_IMAGE_ENCODING", "raw").lower()
+# SQLite 后端检查会话是否已被其他 worker 淘汰的间隔（秒），用于释放本进程中与这些会话关联的状态
+SESSION_SYNC_INTERVAL_SECONDS = float(os.getenv("SESSION_SYNC_INTERVAL_SECONDS", "30"))
+
+# 每次从数据库中取出的淘汰候选数量
+_EVICT_BATCH = 64
+
+
+def image_nbytes(image: Image.Image) -> int:
+    """估算 PIL Image 解码后占用的字节数"""
+    bytes_per_band = 1
+    if image.mode in ("I", "F", "I;32"):
+        bytes_per_band = 4
+    elif image.mode.startswith("I;16"):
+        bytes_per_band = 2
+    return image.width * image.height * len(image.getbands()) * bytes_per_band
+
+
+def _in_loop(loop: asyncio.AbstractEventLoop) -> bool:
+    """当前线程是否正在运行 loop"""
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class Session:
+    """单个用户会话：当前图片与识别出的物体"""
+
+    def __init__(self, session_id: str, image: Image.Image, objects: List[DetectedObject],
+                 image_hash: Optional[str] = None):
+        self.session_id = session_id
+        self.image = image
+        self.objects = objects
+        # 当前图片的内容指纹（上传时的内容哈希，编辑后更新），用作各类缓存的键
+        self.image_hash = image_hash or session_id
+        self.created_at = time.time()
+        self.last_access = self.created_at
+
+    @property
+    def nbytes(self) -> int:
+        return image_nbytes(self.image)
+
+
+class SessionStore(ABC):
+    """会话存储后端的公共接口"""
+
+    def __init__(self):
+        self._eviction_listeners: List[Callable[[str], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add_eviction_listener(self, callback: Callable[[str], None]):
+        """注册回调：会话在本进程内被淘汰、过期或删除时以 session_id 调用"""
+        self._eviction_listeners.append(callback)
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """
+        绑定事件循环：存储操作在线程池中执行时，淘汰通知转交给该事件循环执行
+        （监听者会取消预取任务、修改只在事件循环中访问的按会话状态）
+        """
+        self._loop = loop
+
+    def _notify_evicted(self, session_id: str):
+        loop = self._loop
+        if loop is not None and not _in_loop(loop):
+            try:
+                loop.call_soon_threadsafe(self._dispatch_evicted, session_id)
+                return
+            except RuntimeError:
+                # 事件循环已关闭（进程退出中），直接在当前线程通知
+                pass
+        self._dispatch_evicted(session_id)
+
+    def _dispatch_evicted(self, session_id: str):
+        for callback in self._eviction_listeners:
+            try:
+                callback(session_id)
+            except Exception as e:
+                logger.warning("⚠️ Session eviction listener error: %s", e, exc_info=True)
+
+    @abstractmethod
+    def create(self, image: Image.Image, objects: List[DetectedObject],
+               image_hash: Optional[str] = None) -> Session:
+        """创建新会话并返回"""
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Session]:
+        """获取会话（同时刷新 LRU 顺序），不存在或已过期时返回 None"""
+
+    @abstractmethod
+    def get_objects(self, session_id: str) -> Optional[Tuple[List[DetectedObject], str]]:
+        """只读取会话的物体列表和图片指纹（不读取图片，同时刷新 LRU 顺序），不存在或已过期时返回 None"""
+
+    @abstractmethod
+    def update_image(self, session_id: str, image: Image.Image,
+                     image_hash: Optional[str] = None) -> Optional[Session]:
+        """替换会话中的图片（例如编辑之后）"""
+
+    @abstractmethod
+    def delete(self, session_id: str) -> bool:
+        """删除会话"""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """返回存储统计信息"""
+
+
+class MemorySessionStore(SessionStore):
+    """进程内会话存储（LRU + TTL + 字节预算）"""
+
+    def __init__(self, max_bytes: Optional[int] = None, ttl_seconds: Optional[float] = None,
+                 max_sessions: Optional[int] = None):
+        """
+        初始化会话存储
+
+        Args:
+            max_bytes: 所有会话图片的内存上限（字节）
+            ttl_seconds: 会话空闲过期时间（秒）
+            max_sessions: 最大会话数量（0 表示不限制）
+        """
+        super().__init__()
+        self.max_bytes = max_bytes if max_bytes is not None else SESSION_MAX_BYTES
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else SESSION_TTL_SECONDS
+        self.max_sessions = max_sessions if max_sessions is not None else SESSION_MAX_COUNT
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def create(self, image: Image.Image, objects: List[DetectedObject],
+               image_hash: Optional[str] = None) -> Session:
+        """创建新会话并返回"""
+        session = Session(uuid.uuid4().hex, image, objects, image_hash)
+        with self._lock:
+            self._put(session)
+            self._evict()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """获取会话（同时刷新 LRU 顺序），不存在或已过期时返回 None"""
+        if not session_id:
+            return None
+        with self._lock:
+            return self._touch(session_id)
+
+    def get_objects(self, session_id: str) -> Optional[Tuple[List[DetectedObject], str]]:
+        """只读取会话的物体列表和图片指纹，不存在或已过期时返回 None"""
+        if not session_id:
+            return None
+        with self._lock:
+            session = self._touch(session_id)
+            return (session.objects, session.image_hash) if session is not None else None
+
+    def update_image(self, session_id: str, image: Image.Image,
+                     image_hash: Optional[str] = None) -> Optional[Session]:
+        """替换会话中的图片（例如编辑之后），并重新计算内存占用"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.image = image
+            session.image_hash = image_hash or uuid.uuid4().hex
+            session.last_access = time.time()
+            self._put(session)
+            self._evict()
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        """删除会话"""
+        with self._lock:
+            return self._drop(session_id)
+
+    def stats(self) -> dict:
+        """返回存储统计信息"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+            }
+
+    def _touch(self, session_id: str) -> Optional[Session]:
+        """刷新会话的访问时间和 LRU 顺序（调用方持有锁），已过期时删除"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        now = time.time()
+        if self._expired(session, now):
+            self._drop(session_id)
+            self._evictions += 1
+            return None
+        session.last_access = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _put(self, session: Session):
+        self._remove(session.session_id)
+        size = session.nbytes
+        self._sessions[session.session_id] = session
+        self._sizes[session.session_id] = size
+        self._total_bytes += size
+
+    def _remove(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._total_bytes -= self._sizes.pop(session_id, 0)
+        return True
+
+    def _drop(self, session_id: str) -> bool:
+        """删除会话并通知监听者（淘汰、过期、显式删除）"""
+        removed = self._remove(session_id)
+        if removed:
+            self._notify_evicted(session_id)
+        return removed
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - session.last_access > self.ttl_seconds
+
+    def _evict(self):
+        """先淘汰过期会话，再按 LRU 顺序淘汰直到满足内存和数量上限（始终保留最近使用的会话）"""
+        now = time.time()
+        for session_id in [sid for sid, s in self._sessions.items() if self._expired(s, now)]:
+            self._drop(session_id)
+            self._evictions += 1
+
+        while len(self._sessions) > 1 and (
+            (self.max_bytes > 0 and self._total_bytes > self.max_bytes)
+            or (self.max_sessions > 0 and len(self._sessions) > self.max_sessions)
+        ):
+            oldest_id = next(iter(self._sessions))
+            self._drop(oldest_id)
+            self._evictions += 1
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    基于 SQLite 的跨进程会话存储
+    多个 uvicorn worker / 同机多个容器共享同一个数据库文件，
+    图片以原始像素缓冲区（或 PNG）保存，物体列表以 JSON 保存。
+    会话数量与总字节数由触发器维护在 session_totals 中，淘汰时只按 last_access 索引取出最旧的会话。
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_bytes: Optional[int] = None,
+                 ttl_seconds: Optional[float] = None, max_sessions: Optional[int] = None,
+                 image_encoding: Optional[str] = None, sync_interval: Optional[float] = None):
+        """
+        初始化 SQLite 会话存储
+
+        Args:
+            db_path: 数据库文件路径
+            max_bytes: 所有会话图片的存储上限（字节）
+            ttl_seconds: 会话空闲过期时间（秒）
+            max_sessions: 最大会话数量（0 表示不限制）
+            image_encoding: 图片存储格式 raw | png
+            sync_interval: 检查其他 worker 淘汰的会话的间隔（秒）
+        """
+        super().__init__()
+        self.db_path = db_path or SESSION_DB_PATH
+        self.max_bytes = max_bytes if max_bytes is not None else SESSION_MAX_BYTES
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else SESSION_TTL_SECONDS
+        self.max_sessions = max_sessions if max_sessions is not None else SESSION_MAX_COUNT
+        self.image_encoding = image_encoding or SESSION_IMAGE_ENCODING
+        self.sync_interval = sync_interval if sync_interval is not None else SESSION_SYNC_INTERVAL_SECONDS
+        self._lock = threading.Lock()
+        # 本进程用到过的会话：其他 worker 淘汰它们时，在这里补发淘汰通知
+        self._known: Set[str] = set()
+        self._last_sync = time.monotonic()
+        self._evictions = 0
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                mode TEXT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                encoding TEXT NOT NULL,
+                pixels BLOB NOT NULL,
+                objects TEXT NOT NULL,
+                image_hash TEXT,
+                nbytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access)")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "image_hash" not in columns:
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN image_hash TEXT")
+        self._create_totals()
+
+    def _create_totals(self):
+        """创建由触发器维护的会话数量与总字节数（在同一个事务中按现有数据初始化，多个 worker 同时启动也只初始化一次）"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS session_totals (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    sessions INTEGER NOT NULL,
+                    nbytes INTEGER NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "INSERT OR IGNORE INTO session_totals "
+                "SELECT 0, COUNT(*), COALESCE(SUM(nbytes), 0) FROM sessions"
+            )
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS sessions_totals_insert AFTER INSERT ON sessions BEGIN
+                    UPDATE session_totals SET sessions = sessions + 1, nbytes = nbytes + NEW.nbytes WHERE id = 0;
+                END
+            """)
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS sessions_totals_delete AFTER DELETE ON sessions BEGIN
+                    UPDATE session_totals SET sessions = sessions - 1, nbytes = nbytes - OLD.nbytes WHERE id = 0;
+                END
+            """)
+            self._conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS sessions_totals_update AFTER UPDATE OF nbytes ON sessions BEGIN
+                    UPDATE session_totals SET nbytes = nbytes - OLD.nbytes + NEW.nbytes WHERE id = 0;
+                END
+            """)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _encode_image(self, image: Image.Image) -> tuple:
+        if self.image_encoding == "png":
+            buffered = BytesIO()
+            image.save(buffered, format="PNG", compress_level=1)
+            return "png", buffered.getvalue()
+        return "raw", image.tobytes()
+
+    @staticmethod
+    def _decode_image(mode: str, width: int, height: int, encoding: str, pixels: bytes) -> Image.Image:
+        if encoding == "png":
+            image = Image.open(BytesIO(pixels))
+            image.load()
+            return image
+        return Image.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1)
+
+    @staticmethod
+    def _decode_objects(objects_json: str) -> List[DetectedObject]:
+        return [DetectedObject(**item) for item in json.loads(objects_json)]
+
+    def create(self, image: Image.Image, objects: List[DetectedObject],
+               image_hash: Optional[str] = None) -> Session:
+        session = Session(uuid.uuid4().hex, image, objects, image_hash)
+        encoding, pixels = self._encode_image(image)
+        objects_json = json.dumps([obj.model_dump() for obj in objects])
+        with self._lock:
+            self._sync_evictions()
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, mode, width, height, encoding, pixels, objects, "
+                "image_hash, nbytes, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (session.session_id, image.mode, image.width, image.height, encoding, pixels,
+                 objects_json, session.image_hash, session.nbytes, session.created_at, session.last_access)
+            )
+            self._known.add(session.session_id)
+            self._evict()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        if not session_id:
+            return None
+        with self._lock:
+            row = self._touch(session_id, "mode, width, height, encoding, pixels, objects, image_hash, created_at")
+        if row is None:
+            return None
+        now, (mode, width, height, encoding, pixels, objects_json, image_hash, created_at) = row
+        image = self._decode_image(mode, width, height, encoding, pixels)
+        session = Session(session_id, image, self._decode_objects(objects_json), image_hash)
+        session.created_at = created_at
+        session.last_access = now
+        return session
+
+    def get_objects(self, session_id: str) -> Optional[Tuple[List[DetectedObject], str]]:
+        if not session_id:
+            return None
+        with self._lock:
+            row = self._touch(session_id, "objects, image_hash")
+        if row is None:
+            return None
+        _, (objects_json, image_hash) = row
+        return self._decode_objects(objects_json), image_hash
+
+    def _touch(self, session_id: str, columns: str) -> Optional[tuple]:
+        """
+        读取会话的指定列并刷新访问时间（调用方持有锁），已过期时删除
+
+        Returns:
+            (访问时间, 列值)，不存在或已过期时返回 None
+        """
+        self._sync_evictions()
+        now = time.time()
+        row = self._conn.execute(
+            f"SELECT last_access, {columns} FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            self._forget(session_id)
+            return None
+        if self.ttl_seconds > 0 and now - row[0] > self.ttl_seconds:
+            self._delete([session_id])
+            return None
+        self._conn.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id))
+        self._known.add(session_id)
+        return now, row[1:]
+
+    def update_image(self, session_id: str, image: Image.Image,
+                     image_hash: Optional[str] = None) -> Optional[Session]:
+        encoding, pixels = self._encode_image(image)
+        image_hash = image_hash or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE sessions SET mode = ?, width = ?, height = ?, encoding = ?, pixels = ?, "
+                "image_hash = ?, nbytes = ?, last_access = ? WHERE session_id = ?",
+                (image.mode, image.width, image.height, encoding, pixels, image_hash,
+                 image_nbytes(image), now, session_id)
+            )
+            if cursor.rowcount == 0:
+                self._forget(session_id)
+                return None
+            objects_json, created_at = self._conn.execute(
+                "SELECT objects, created_at FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            self._known.add(session_id)
+            self._evict()
+        # 直接使用传入的图片，不再从数据库读取并解码
+        session = Session(session_id, image, self._decode_objects(objects_json), image_hash)
+        session.created_at = created_at
+        session.last_access = now
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._delete([session_id]) > 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total_bytes = self._totals()
+            return {
+                "sessions": count,
+                "total_bytes": total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+                "known_sessions": len(self._known),
+                "db_path": self.db_path,
+            }
+
+    def _totals(self) -> Tuple[int, int]:
+        return self._conn.execute("SELECT sessions, nbytes FROM session_totals WHERE id = 0").fetchone()
+
+    def _delete(self, session_ids: List[str]) -> int:
+        """删除会话并通知监听者，返回实际删除的数量（其他 worker 可能已经删除）"""
+        deleted = [
+            session_id for session_id in session_ids
+            if self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+        ]
+        for session_id in deleted:
+            self._known.discard(session_id)
+            self._notify_evicted(session_id)
+        return len(deleted)
+
+    def _forget(self, session_id: str):
+        """会话已被其他 worker 删除：释放本进程中与它关联的状态"""
+        if session_id in self._known:
+            self._known.discard(session_id)
+            self._notify_evicted(session_id)
+
+    def _sync_evictions(self):
+        """定期检查本进程用到过的会话是否已被其他 worker 淘汰，并补发淘汰通知（调用方持有锁）"""
+        if not self._known or time.monotonic() - self._last_sync < self.sync_interval:
+            return
+        self._last_sync = time.monotonic()
+        known = list(self._known)
+        existing = set()
+        for start in range(0, len(known), 500):
+            chunk = known[start:start + 500]
+            existing.update(row[0] for row in self._conn.execute(
+                f"SELECT session_id FROM sessions WHERE session_id IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        for session_id in known:
+            if session_id not in existing:
+                self._forget(session_id)
+
+    def _evict(self):
+        """先删除过期会话，再按最近访问时间从旧到新淘汰直到满足上限（始终保留最近使用的会话）"""
+        if self.ttl_seconds > 0:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT session_id FROM sessions WHERE last_access < ?", (time.time() - self.ttl_seconds,)
+            )]
+            self._evictions += self._delete(expired)
+
+        count, total_bytes = self._totals()
+        while count > 1 and (
+            (self.max_bytes > 0 and total_bytes > self.max_bytes)
+            or (self.max_sessions > 0 and count > self.max_sessions)
+        ):
+            rows = self._conn.execute(
+                "SELECT session_id, nbytes FROM sessions ORDER BY last_access LIMIT ?",
+                (min(count - 1, _EVICT_BATCH),)
+            ).fetchall()
+            stale_ids = []
+            for session_id, nbytes in rows:
+                if not ((self.max_bytes > 0 and total_bytes > self.max_bytes)
+                        or (self.max_sessions > 0 and count > self.max_sessions)):
+                    break
+                stale_ids.append(session_id)
+                total_bytes -= nbytes
+                count -= 1
+            if not stale_ids:
+                break
+            self._evictions += self._delete(stale_ids)
+            count, total_bytes = self._totals()
+
+
+def create_session_store() -> SessionStore:
+    """根据 SESSION_BACKEND 环境变量创建会话存储"""
+    if SESSION_BACKEND == "sqlite":
+        logger.info("🗄️ Using SQLite session store: %s", SESSION_DB_PATH)
+        return SQLiteSessionStore()
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        logger.warning("⚠️ Memory session store is per-process; set SESSION_BACKEND=sqlite when running multiple workers")
+    return MemorySessionStore()
@@ -0,0 +1,88 @@
+"""
+请求合并 (single-flight)
+相同键的并发调用只向上游发出一次请求，其余调用方等待同一个结果；
+异常会传递给所有等待者，所有等待者都断开时取消上游请求。
+共享调用以发起方的模型调用优先级开始，更高优先级的调用方加入时提升到它的优先级（见 rate_limiter）。
+"""
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+from services.rate_limiter import CallPriority, fork_priority
+
+T = TypeVar("T")
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task, priority: CallPriority):
+        self.task = task
+        self.priority = priority
+        self.waiters = 0
+        self.cancel_requested = False
+
+
+class SingleFlight:
+    """按键合并并发的异步调用"""
+
+    def __init__(self, name: str = ""):
+        """
+        Args:
+            name: 名称（用于统计信息）
+        """
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        执行 fn()；如果相同 key 的调用正在进行，则等待它的结果
+
+        Args:
+            key: 合并键
+            fn: 无参数的协程函数
+
+        Returns:
+            fn() 的返回值（所有等待者共享同一个结果对象）
+        """
+        call = self._calls.get(key)
+        if call is None or call.cancel_requested:
+            # 共享调用在上下文副本中执行，使用可以被后来者提升的子优先级
+            context = contextvars.copy_context()
+            priority = context.run(fork_priority)
+            call = _Call(context.run(asyncio.create_task, fn()), priority)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task, key=key, call=call: self._finish(key, call))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+            call.priority.promote()
+
+        call.waiters += 1
+        try:
+            # shield：单个调用方被取消时不影响其他等待者
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 所有等待者都已断开，取消上游请求
+                call.cancel_requested = True
+                call.task.cancel()
+                self.cancelled += 1
+
+    def _finish(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.task.cancelled():
+            call.task.exception()  # 标记异常已被读取，避免 "exception was never retrieved" 警告
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,91 @@
+"""
+空间索引
+在分析阶段为会话中的物体框建立均匀网格索引：
+- 点击命中测试：返回包含点击位置的最内层（面积最小）物体
+- 按距离排序的周围物体，用作意图推理的上下文
+"""
+import math
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from schemas import DetectedObject
+
+
+class SpatialIndex:
+    """基于均匀网格的物体框索引（box_2d 格式 [y0, x0, y1, x1]，像素坐标）"""
+
+    def __init__(self, objects: List[DetectedObject], cell_size: Optional[int] = None):
+        """
+        建立索引
+
+        Args:
+            objects: 物体列表
+            cell_size: 网格边长（像素），默认按物体数量与覆盖范围自动选择
+        """
+        self.objects = list(objects)
+        self._boxes = np.array([obj.box_2d for obj in self.objects], dtype=np.float64).reshape(-1, 4)
+        self._areas = np.maximum(self._boxes[:, 2] - self._boxes[:, 0], 0) * \
+            np.maximum(self._boxes[:, 3] - self._boxes[:, 1], 0)
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+
+        if not self.objects:
+            self.cell_size = cell_size or 1
+            return
+        if cell_size is None:
+            extent = max(1.0, float(self._boxes[:, 2].max()) * float(self._boxes[:, 3].max()))
+            cell_size = max(16, int(math.sqrt(extent / len(self.objects))))
+        self.cell_size = cell_size
+
+        # 每个框登记到它覆盖的所有网格中
+        for index, (y0, x0, y1, x1) in enumerate(self._boxes):
+            for cell_y in range(int(y0) // cell_size, int(y1) // cell_size + 1):
+                for cell_x in range(int(x0) // cell_size, int(x1) // cell_size + 1):
+                    self._grid.setdefault((cell_x, cell_y), []).append(index)
+
+    def hits(self, x: float, y: float) -> List[DetectedObject]:
+        """返回所有包含点 (x, y) 的物体，按面积从小到大（最内层在前）"""
+        candidates = self._grid.get((int(x) // self.cell_size, int(y) // self.cell_size))
+        if not candidates:
+            return []
+        inside = [
+            index for index in candidates
+            if self._boxes[index, 1] <= x <= self._boxes[index, 3]
+            and self._boxes[index, 0] <= y <= self._boxes[index, 2]
+        ]
+        inside.sort(key=lambda index: self._areas[index])
+        return [self.objects[index] for index in inside]
+
+    def hit_test(self, x: float, y: float) -> Optional[DetectedObject]:
+        """返回包含点 (x, y) 的最内层物体，没有命中时返回 None"""
+        hits = self.hits(x, y)
+        return hits[0] if hits else None
+
+    def nearest(self, x: float, y: float, k: int = 5,
+                exclude: Optional[DetectedObject] = None) -> List[DetectedObject]:
+        """按点到物体框的距离（点在框内为 0，再按框中心距离排序）返回最近的 k 个物体"""
+        return self._rank(np.array([y, x, y, x], dtype=np.float64), k, exclude)
+
+    def nearest_to(self, obj: DetectedObject, k: int = 5) -> List[DetectedObject]:
+        """按与指定物体框的间隙距离返回最近的 k 个其他物体"""
+        return self._rank(np.array(obj.box_2d, dtype=np.float64), k, exclude=obj)
+
+    def _rank(self, box: np.ndarray, k: int, exclude: Optional[DetectedObject]) -> List[DetectedObject]:
+        if not self.objects or k <= 0:
+            return []
+        boxes = self._boxes
+        gap_y = np.maximum(np.maximum(boxes[:, 0] - box[2], box[0] - boxes[:, 2]), 0)
+        gap_x = np.maximum(np.maximum(boxes[:, 1] - box[3], box[1] - boxes[:, 3]), 0)
+        gap = np.hypot(gap_y, gap_x)
+        center_distance = np.hypot(
+            (boxes[:, 0] + boxes[:, 2]) / 2 - (box[0] + box[2]) / 2,
+            (boxes[:, 1] + boxes[:, 3]) / 2 - (box[1] + box[3]) / 2
+        )
+        order = np.lexsort((center_distance, gap))
+        results = []
+        for index in order:
+            candidate = self.objects[index]
+            if exclude is not None and candidate.id == exclude.id:
+                continue
+            results.append(candidate)
+            if len(results) >= k:
+                break
+        return results
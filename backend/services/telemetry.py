@@ -0,0 +1,391 @@
+"""
+遥测：分级日志、指标与阶段计时
+- 日志：get_logger 返回 ripple.* 下的 logger，级别由 LOG_LEVEL 控制，格式由 LOG_FORMAT（text | json）控制；
+  统一使用 logger.info("... %s", value) 惰性格式化，级别关闭时不会拼接字符串
+- 指标：Counter / Gauge / Histogram（带标签），由 /metrics 以 Prometheus 文本格式导出；
+  缓存命中率、队列深度等已有统计通过 register_collector 在导出时读取
+- span：为处理阶段计时（上传解码、模型调用、SERP、JSON 解析、意图后处理、图片编码），
+  写入 ripple_stage_duration_seconds，并通过 Server-Timing 响应头返回当前请求的各阶段耗时
+"""
+import os
+import sys
+import json
+import math
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 日志级别: DEBUG | INFO | WARNING | ERROR
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 日志格式: text | json（json 每行一个对象，附带 extra 字段）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# 是否在响应中返回 Server-Timing 头（各阶段耗时）
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() in ("true", "1", "yes", "on")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# LogRecord 自带的属性，其余的都是通过 extra 传入的结构化字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+# ----------------------
+# 日志
+# ----------------------
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+        if fields:
+            text += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return text
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: Optional[str] = None, fmt: Optional[str] = None):
+    """配置 ripple.* 日志（重复调用时替换之前的处理器）"""
+    root = logging.getLogger("ripple")
+    root.setLevel(level or LOG_LEVEL)
+    handler = logging.StreamHandler(sys.stdout)
+    if (fmt or LOG_FORMAT) == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s"))
+    root.handlers = [handler]
+    root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """返回模块的 logger，例如 get_logger(__name__) -> ripple.services.ai_service"""
+    return logging.getLogger(f"ripple.{name}")
+
+
+configure_logging()
+logger = get_logger(__name__)
+
+
+# ----------------------
+# 指标
+# ----------------------
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, object]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> List[Tuple[str, object]]:
+        return list(zip(self.labelnames, key))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """单调递增的计数器"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """进入时加一、退出时减一（用于进行中的请求数）"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """按区间统计观测值的分布（导出累计桶、总和与次数）"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+# 导出时调用的采集函数返回 (指标名, 类型, 说明, [(标签字典, 值), ...])
+CollectorResult = Iterable[Tuple[str, str, str, Iterable[Tuple[Dict[str, object], float]]]]
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], CollectorResult]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Callable[[], CollectorResult]):
+        """注册导出时调用的采集函数（用于读取已有的 stats()）"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """以 Prometheus 文本格式导出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                families = list(collector())
+            except Exception:
+                logger.warning("Metrics collector %s failed", getattr(collector, "__name__", collector), exc_info=True)
+                continue
+            for name, kind, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(list(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.histogram(
+    "ripple_stage_duration_seconds", "Duration of processing stages", ("stage", "outcome")
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "ripple_stage_errors_total", "Processing stages that raised", ("stage", "error")
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "ripple_upstream_errors_total", "Failed calls to upstream services", ("upstream", "error")
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    "ripple_http_requests_total", "HTTP requests", ("method", "route", "status")
+)
+HTTP_DURATION = REGISTRY.histogram(
+    "ripple_http_request_duration_seconds", "HTTP request duration until the response is complete", ("method", "route")
+)
+HTTP_IN_FLIGHT = REGISTRY.gauge("ripple_http_requests_in_flight", "HTTP requests being processed")
+
+
+# ----------------------
+# 阶段计时
+# ----------------------
+
+class _RequestTimings(list):
+    """当前请求的各阶段耗时 [(阶段, 秒)]；请求结束后关闭，之后完成的后台任务不再写入"""
+
+    def __init__(self):
+        super().__init__()
+        self.open = True
+
+
+# 由 TelemetryMiddleware 设置；线程池与子任务会复制上下文，共享同一个列表
+# （在请求中启动的常驻 worker 也会继承它，因此请求结束时必须关闭）
+_request_timings: contextvars.ContextVar[Optional[_RequestTimings]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    为一个处理阶段计时（同步和异步代码中都可以用 with 包裹）
+
+    Args:
+        stage: 阶段名，例如 model_call、serp_call、json_parse
+        fields: 调试日志中附带的结构化字段
+    """
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException as e:
+        outcome = "error"
+        if isinstance(e, Exception):
+            STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+        else:
+            outcome = "cancelled"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_DURATION.observe(duration, stage=stage, outcome=outcome)
+        timings = _request_timings.get()
+        if timings is not None and timings.open:
+            timings.append((stage, duration))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("span %s %.1fms %s", stage, duration * 1000, outcome,
+                         extra={"stage": stage, "duration_ms": round(duration * 1000, 2), **fields})
+
+
+def _server_timing(timings: List[Tuple[str, float]]) -> str:
+    """按阶段汇总耗时，生成 Server-Timing 头，例如 model_call;dur=812.4;desc="x2\""""
+    totals: Dict[str, List[float]] = {}
+    for stage, duration in timings:
+        entry = totals.setdefault(stage, [0.0, 0])
+        entry[0] += duration
+        entry[1] += 1
+    parts = []
+    for stage, (total, count) in totals.items():
+        part = f"{stage};dur={total * 1000:.1f}"
+        if count > 1:
+            part += f';desc="x{count}"'
+        parts.append(part)
+    return ", ".join(parts)
+
+
+class TelemetryMiddleware:
+    """ASGI 中间件：统计请求数、耗时与进行中的请求，并在响应头中返回各阶段耗时（Server-Timing）"""
+
+    def __init__(self, app, server_timing: Optional[bool] = None):
+        self.app = app
+        self.server_timing = SERVER_TIMING_ENABLED if server_timing is None else server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = _RequestTimings()
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing and timings:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", _server_timing(timings).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            timings.open = False
+            _request_timings.reset(token)
+            # 使用路由模板作为标签（例如 /api/images/{name}），避免标签数量随路径参数增长
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status)
+            HTTP_DURATION.observe(time.perf_counter() - started, method=scope["method"], route=route)
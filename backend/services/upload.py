@@ -0,0 +1,161 @@
+"""
+上传图片处理
+分块读取上传文件（边读边计算哈希，超过字节上限立即拒绝），解码前先从文件头检查尺寸，
+JPEG 在不需要全分辨率时用 draft() 直接按缩小比例解码，已经是 RGB 的图片不再额外复制。
+"""
+import os
+import math
+import hashlib
+from typing import BinaryIO, Tuple
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image
+from services.image_ops import downscale
+
+# 上传文件大小上限（字节）
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+# 图片像素数上限（宽 × 高），超出时拒绝解码（防止解压炸弹）
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+# 解码后图片的最长边（像素），0 表示保留原始分辨率；JPEG 会直接以缩小的比例解码
+UPLOAD_MAX_EDGE = int(os.getenv("UPLOAD_MAX_EDGE", "0"))
+# 分块读取的大小（字节）
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Pillow 自身的解压炸弹保护与上面的上限保持一致
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI 中间件：按 Content-Length 提前拒绝过大的请求，避免先把整个请求体写入临时文件；
+    没有 Content-Length（分块传输）时边读取边计数，超过上限立即中止并返回 413
+    """
+
+    def __init__(self, app, max_bytes: int = None):
+        self.app = app
+        # 预留 multipart 边界和其他表单字段的空间
+        self.max_bytes = (MAX_UPLOAD_BYTES if max_bytes is None else max_bytes) + 64 * 1024
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise UploadError(413, "Upload too large")
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if exceeded and not started:
+                # 应用把读取中止转换成的错误响应（例如表单解析失败的 400）由下面的 413 代替
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded or started:
+                raise
+        if exceeded and not started:
+            await self._reject(scope, receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send):
+        response = JSONResponse(status_code=413, content={"detail": "Upload too large"})
+        await response(scope, receive, send)
+
+
+class UploadError(Exception):
+    """上传的文件无法接受（过大、不是图片或尺寸超限）"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+async def hash_upload(file: UploadFile, max_bytes: int = None) -> Tuple[str, int]:
+    """
+    分块读取上传文件，计算 SHA-256（不把整个文件读入内存）
+
+    Returns:
+        (十六进制摘要, 文件大小)；读取完成后文件指针回到开头
+
+    Raises:
+        UploadError: 文件超过 max_bytes
+    """
+    max_bytes = MAX_UPLOAD_BYTES if max_bytes is None else max_bytes
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes > 0 and size > max_bytes:
+            raise UploadError(413, f"Upload exceeds {max_bytes} bytes")
+        digest.update(chunk)
+    if size == 0:
+        raise UploadError(400, "Empty upload")
+    await file.seek(0)
+    return digest.hexdigest(), size
+
+
+def decode_image(fp: BinaryIO, max_pixels: int = None, max_edge: int = None) -> Image.Image:
+    """
+    解码图片为 RGB（CPU 密集，应在线程池中调用）
+
+    Args:
+        fp: 文件对象
+        max_pixels: 像素数上限，从文件头读到的尺寸超出时不解码
+        max_edge: 解码后的最长边，0 表示保留原始分辨率
+
+    Raises:
+        UploadError: 不是可识别的图片，或尺寸超限
+    """
+    max_pixels = MAX_IMAGE_PIXELS if max_pixels is None else max_pixels
+    max_edge = UPLOAD_MAX_EDGE if max_edge is None else max_edge
+    try:
+        # Image.open 只读取文件头，此时还没有解码像素
+        image = Image.open(fp)
+    except Image.DecompressionBombError as e:
+        raise UploadError(413, str(e))
+    except (Image.UnidentifiedImageError, OSError):
+        raise UploadError(400, "Unsupported image file")
+
+    width, height = image.size
+    if max_pixels > 0 and width * height > max_pixels:
+        raise UploadError(413, f"Image is {width}x{height}, exceeds the {max_pixels} pixel limit")
+
+    if max_edge > 0 and max(width, height) > max_edge and image.format == "JPEG":
+        # JPEG 可以直接以 1/2、1/4、1/8 的比例解码（不小于请求的尺寸），省去全分辨率解码
+        scale = max_edge / max(width, height)
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+
+    try:
+        image.load()
+    except Image.DecompressionBombError as e:
+        raise UploadError(413, str(e))
+    except OSError as e:
+        raise UploadError(400, f"Corrupt image file: {e}")
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return downscale(image, max_edge)
@@ -0,0 +1,206 @@
+"""
+用量统计
+记录每次模型调用的 token 用量（来自响应的 usage_metadata）和每次 SERP API 请求，
+按接口、会话、模型汇总并估算费用，通过 /api/usage 和 /metrics 导出。
+
+调用归属通过 contextvars 传递：请求处理函数调用 bind_usage(endpoint, session_id)，
+之后在同一请求中（包括线程池、子任务和编辑任务）发生的调用都计入该接口和会话。
+"""
+import os
+import json
+import time
+import threading
+import contextvars
+from typing import Any, Dict, Optional
+from services.cache import LRUCache
+from services.telemetry import REGISTRY
+
+# 模型单价（美元 / 百万 token）：{"模型名": [输入, 输出], ...}，未列出的模型不计费用
+# 默认值为公开定价，价格变化时通过环境变量覆盖
+MODEL_PRICING = json.loads(os.getenv("MODEL_PRICING", "") or json.dumps({
+    "gemini-2.0-flash": [0.10, 0.40],
+    "gemini-2.5-flash": [0.30, 2.50],
+    "gemini-2.5-flash-image": [0.30, 30.0],
+}))
+# 每次 SERP API 请求的费用（美元）
+SERP_COST_PER_CALL = float(os.getenv("SERP_COST_PER_CALL", "0.015"))
+# 保留用量记录的会话数量上限
+USAGE_MAX_SESSIONS = int(os.getenv("USAGE_MAX_SESSIONS", "10000"))
+
+# 不属于任何请求的调用（例如启动时的预热）归入此接口
+UNATTRIBUTED = "unattributed"
+
+MODEL_REQUESTS = REGISTRY.counter(
+    "ripple_model_requests_total", "Model calls with usage accounting", ("endpoint", "model")
+)
+MODEL_TOKENS = REGISTRY.counter(
+    "ripple_model_tokens_total", "Model tokens by kind (prompt, output, cached, thoughts)", ("endpoint", "model", "kind")
+)
+SERP_CALLS = REGISTRY.counter("ripple_serp_calls_total", "SERP API requests sent upstream", ("endpoint",))
+COST = REGISTRY.counter("ripple_cost_usd_total", "Estimated spend in USD", ("endpoint",))
+
+
+class Usage:
+    """一组调用的累计用量"""
+
+    __slots__ = ("model_calls", "prompt_tokens", "output_tokens", "cached_tokens", "thoughts_tokens",
+                 "total_tokens", "serp_calls", "cost_usd")
+
+    def __init__(self):
+        self.model_calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.thoughts_tokens = 0
+        self.total_tokens = 0
+        self.serp_calls = 0
+        self.cost_usd = 0.0
+
+    def add(self, other: "Usage"):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["cost_usd"] = round(self.cost_usd, 6)
+        return data
+
+
+class UsageScope:
+    """一次请求的用量归属（接口名与会话）"""
+
+    def __init__(self, endpoint: str, session_id: Optional[str] = None):
+        self.endpoint = endpoint
+        self.session_id = session_id
+        # 会话确定之前（例如 /api/analyze 在创建会话前调用模型）产生的用量，assign_session 时再计入会话
+        self.pending = Usage()
+
+
+_scope: contextvars.ContextVar[Optional[UsageScope]] = contextvars.ContextVar("usage_scope", default=None)
+
+
+def bind_usage(endpoint: str, session_id: Optional[str] = None) -> UsageScope:
+    """设置当前请求（或后台任务）的用量归属"""
+    scope = UsageScope(endpoint, session_id)
+    _scope.set(scope)
+    return scope
+
+
+def _count(value) -> int:
+    return int(value or 0)
+
+
+def usage_from_metadata(metadata: Any) -> Usage:
+    """将 SDK 响应的 usage_metadata 转换为 Usage（新旧 SDK 字段名相同）"""
+    usage = Usage()
+    usage.model_calls = 1
+    if metadata is None:
+        return usage
+    usage.prompt_tokens = _count(getattr(metadata, "prompt_token_count", 0))
+    usage.output_tokens = _count(getattr(metadata, "candidates_token_count", 0))
+    usage.cached_tokens = _count(getattr(metadata, "cached_content_token_count", 0))
+    usage.thoughts_tokens = _count(getattr(metadata, "thoughts_token_count", 0))
+    usage.total_tokens = _count(getattr(metadata, "total_token_count", 0)) or (
+        usage.prompt_tokens + usage.output_tokens + usage.thoughts_tokens
+    )
+    return usage
+
+
+def model_cost(model: str, usage: Usage) -> float:
+    """按 MODEL_PRICING 估算费用（思考 token 按输出计价，缓存命中部分按输入的 1/4 计价）"""
+    price = MODEL_PRICING.get(model)
+    if not price:
+        return 0.0
+    input_price, output_price = price
+    uncached = max(0, usage.prompt_tokens - usage.cached_tokens)
+    return (uncached * input_price + usage.cached_tokens * input_price / 4
+            + (usage.output_tokens + usage.thoughts_tokens) * output_price) / 1_000_000
+
+
+class UsageTracker:
+    """按接口、模型、会话汇总用量"""
+
+    def __init__(self, max_sessions: Optional[int] = None):
+        self._lock = threading.Lock()
+        self.totals = Usage()
+        self.by_endpoint: Dict[str, Usage] = {}
+        self.by_model: Dict[str, Usage] = {}
+        self.by_endpoint_model: Dict[str, Dict[str, Usage]] = {}
+        self._sessions = LRUCache(maxsize=max_sessions if max_sessions is not None else USAGE_MAX_SESSIONS)
+        self.started_at = time.time()
+
+    def _session(self, session_id: str) -> Usage:
+        usage = self._sessions.get(session_id)
+        if usage is None:
+            usage = Usage()
+            self._sessions.set(session_id, usage)
+        return usage
+
+    def _add(self, usage: Usage, model: Optional[str]):
+        scope = _scope.get()
+        endpoint = scope.endpoint if scope is not None else UNATTRIBUTED
+        with self._lock:
+            self.totals.add(usage)
+            self.by_endpoint.setdefault(endpoint, Usage()).add(usage)
+            if model is not None:
+                self.by_model.setdefault(model, Usage()).add(usage)
+                self.by_endpoint_model.setdefault(endpoint, {}).setdefault(model, Usage()).add(usage)
+            if scope is not None:
+                if scope.session_id:
+                    self._session(scope.session_id).add(usage)
+                else:
+                    scope.pending.add(usage)
+        COST.inc(usage.cost_usd, endpoint=endpoint)
+        return endpoint
+
+    def record_model(self, model: str, metadata: Any):
+        """记录一次模型调用（metadata 为响应的 usage_metadata，没有时只计调用次数）"""
+        usage = usage_from_metadata(metadata)
+        usage.cost_usd = model_cost(model, usage)
+        endpoint = self._add(usage, model)
+        MODEL_REQUESTS.inc(endpoint=endpoint, model=model)
+        for kind in ("prompt", "output", "cached", "thoughts"):
+            value = getattr(usage, f"{kind}_tokens")
+            if value:
+                MODEL_TOKENS.inc(value, endpoint=endpoint, model=model, kind=kind)
+
+    def record_serp(self):
+        """记录一次实际发出的 SERP API 请求（缓存命中不计）"""
+        usage = Usage()
+        usage.serp_calls = 1
+        usage.cost_usd = SERP_COST_PER_CALL
+        endpoint = self._add(usage, None)
+        SERP_CALLS.inc(endpoint=endpoint)
+
+    def assign_session(self, session_id: str):
+        """为当前请求确定会话，把此前未归属的用量计入该会话"""
+        scope = _scope.get()
+        if scope is None:
+            return
+        with self._lock:
+            scope.session_id = session_id
+            self._session(session_id).add(scope.pending)
+            scope.pending = Usage()
+
+    def session(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            usage = self._sessions.get(session_id)
+            return usage.to_dict() if usage is not None else None
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "since": self.started_at,
+                "totals": self.totals.to_dict(),
+                "by_endpoint": {name: usage.to_dict() for name, usage in self.by_endpoint.items()},
+                "by_model": {name: usage.to_dict() for name, usage in self.by_model.items()},
+                "by_endpoint_model": {
+                    endpoint: {model: usage.to_dict() for model, usage in models.items()}
+                    for endpoint, models in self.by_endpoint_model.items()
+                },
+                "sessions_tracked": len(self._sessions),
+                "pricing": {"models": MODEL_PRICING, "serp_per_call": SERP_COST_PER_CALL},
+            }
+
+
+usage_tracker = UsageTracker()
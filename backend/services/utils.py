@@ -1,7 +1,12 @@
 import re
+import logging
+import json
 import base64
 from io import BytesIO
 from PIL import Image
+from services.telemetry import get_logger
+
+logger = get_logger(__name__)
 
 def clean_json_string(json_output: str) -> str:
     """
@@ -25,6 +30,60 @@ def clean_json_string(json_output: str) -> str:
             
     return json_text
 
+class JsonArrayStream:
+    """
+    增量解析 LLM 流式输出中的 JSON 数组：每当数组中的一个顶层对象闭合时立即返回它。
+    忽略第一个 '[' 之前的内容（例如 ```json 代码块标记）。
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> list:
+        """输入一段文本，返回本段中闭合的对象（已解析为 dict；无法解析的对象被跳过）"""
+        items = []
+        for ch in text:
+            if self._finished:
+                break
+            if not self._started:
+                self._started = ch == '['
+                continue
+            if self._depth > 0:
+                self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '[{':
+                if self._depth == 0:
+                    self._buffer = [ch]
+                self._depth += 1
+            elif ch in ']}':
+                if self._depth == 0:
+                    self._finished = ch == ']'  # 顶层数组结束
+                    continue
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        item = json.loads(''.join(self._buffer))
+                    except json.JSONDecodeError:
+                        item = None
+                    if isinstance(item, dict):
+                        items.append(item)
+                    self._buffer = []
+        return items
+
+
 def process_base64_image(base64_str: str) -> Image.Image:
     """将前端传来的 base64 字符串转为 PIL Image"""
     if "base64," in base64_str:
@@ -60,31 +119,32 @@ def image_to_base64(image) -> str:
             else:
                 raise ValueError(f"Unknown google.genai.types.Image structure: {dir(image)}")
         except Exception as e:
-            print(f"⚠️ Error converting google.genai.types.Image: {e}")
-            print(f"📋 Image object attributes: {[attr for attr in dir(image) if not attr.startswith('_')]}")
+            logger.warning("⚠️ Error converting google.genai.types.Image: %s", e)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📋 Image object attributes: %s", [attr for attr in dir(image) if not attr.startswith('_')])
             raise ValueError(f"Cannot convert google.genai.types.Image: {e}")
     # 方法3: 如果有 read 方法（BytesIO 等）
     elif hasattr(image, 'read'):
         try:
             pil_image = Image.open(image)
         except Exception as e:
-            print(f"⚠️ Error opening image from stream: {e}")
+            logger.warning("⚠️ Error opening image from stream: %s", e)
             raise ValueError(f"Cannot open image from stream: {type(image)}")
     # 方法4: 如果是 bytes
     elif isinstance(image, bytes):
         try:
             pil_image = Image.open(BytesIO(image))
         except Exception as e:
-            print(f"⚠️ Error opening image from bytes: {e}")
+            logger.warning("⚠️ Error opening image from bytes: %s", e)
             raise ValueError(f"Cannot open image from bytes")
     else:
         # 尝试直接转换
         try:
             pil_image = Image.open(image)
         except Exception as e:
-            print(f"⚠️ Error converting image: {e}")
-            print(f"📋 Image type: {type(image)}")
-            print(f"📋 Image attributes: {[attr for attr in dir(image) if not attr.startswith('_')]}")
+            logger.warning("⚠️ Error converting image: %s (type %s)", e, type(image))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📋 Image attributes: %s", [attr for attr in dir(image) if not attr.startswith('_')])
             raise ValueError(f"Invalid image type: {type(image)}")
     
     # 确保图片是 RGB 模式（如果不是，转换为 RGB）
@@ -95,7 +155,7 @@ def image_to_base64(image) -> str:
         try:
             pil_image = pil_image.convert('RGB')
         except Exception as e:
-            print(f"⚠️ Error converting to RGB: {e}")
+            logger.warning("⚠️ Error converting to RGB: %s", e)
             # 如果转换失败，尝试直接保存（某些格式可能不需要转换）
             pass
     
@@ -0,0 +1,66 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
+from schemas import DetectedObject
+from services.analysis_cache import AnalysisCache
+from services.perceptual_hash import PerceptualIndex, perceptual_hash
+
+
+OBJECTS = [DetectedObject(id=1, label="cup", box_2d=[100, 200, 300, 400], center=(300, 200))]
+
+
+def make_image(width=400, height=300):
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([width // 4, height // 4, width // 2, height // 2], fill="black")
+    draw.ellipse([width // 2, height // 2, width * 9 // 10, height * 9 // 10], fill="gray")
+    return image
+
+
+def test_disk_entries_survive_a_new_instance(tmp_path):
+    cache = AnalysisCache("ns", cache_dir=str(tmp_path), near_duplicates=False)
+    cache.set(["b-key"], OBJECTS, 400, 300)
+    reloaded = AnalysisCache("ns", cache_dir=str(tmp_path), near_duplicates=False)
+    assert reloaded.get("b-key") == OBJECTS
+    assert reloaded.stats()["disk_hits"] == 1
+    assert reloaded.get("b-other") is None
+
+
+def test_near_duplicate_hit_rescales_boxes(tmp_path):
+    cache = AnalysisCache("ns", cache_dir=str(tmp_path))
+    image = make_image(400, 300)
+    cache.set(["b-key"], OBJECTS, 400, 300, phash=perceptual_hash(image))
+    smaller = image.resize((200, 150))
+    found = cache.get("b-missing", image=smaller, phash=perceptual_hash(smaller))
+    assert found[0].box_2d == [50, 100, 150, 200]
+    assert cache.stats()["near_duplicate_hits"] == 1
+
+
+def test_concurrent_writes_from_threads_keep_the_index_file_consistent(tmp_path):
+    cache = AnalysisCache("ns", cache_dir=str(tmp_path))
+    cache.perceptual_index.max_entries = 8
+
+    def write(i):
+        cache.set([f"b-{i:04d}"], OBJECTS, 400, 300, phash=i * 7919)
+        return cache.get(f"b-{i:04d}")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(write, range(64)))
+    assert all(result == OBJECTS for result in results)
+
+    index_path = tmp_path / "ns" / "perceptual_index.jsonl"
+    lines = index_path.read_text().splitlines()
+    assert len(lines) <= 2 * 8 + 1
+    assert all(json.loads(line)["key"].startswith("b-") for line in lines)
+    reloaded = PerceptualIndex(index_path=str(index_path), max_entries=8)
+    assert len(reloaded) == 8
+
+
+def test_index_overwrites_oldest_entries():
+    index = PerceptualIndex(max_entries=2)
+    index.add(0x0F, "a", 10, 10)
+    index.add(0xF0, "b", 10, 10)
+    index.add(0xFF00, "c", 10, 10)
+    assert len(index) == 2
+    assert index.find(0x0F, 10, 10) is None
+    assert index.find(0xFF00, 10, 10)[:2] == ("c", 10)
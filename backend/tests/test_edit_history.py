@@ -0,0 +1,84 @@
+from PIL import Image, ImageDraw
+from services.edit_history import EditHistory
+
+
+def edited(image: Image.Image, box, color) -> Image.Image:
+    result = image.copy()
+    ImageDraw.Draw(result).rectangle(box, fill=color)
+    return result
+
+
+def record_versions(history: EditHistory, session_id: str, count: int):
+    """记录 count 次编辑，返回各版本的 (图片, 指纹)"""
+    versions = [(Image.new("RGB", (64, 48), "white"), "h0")]
+    for i in range(1, count + 1):
+        before, before_hash = versions[-1]
+        after = edited(before, [i * 4, i * 3, i * 4 + 10, i * 3 + 8], (i * 40, 0, 255 - i * 40))
+        after_hash = f"h{i}"
+        history.record(session_id, history.diff(before, after, before_hash, after_hash))
+        versions.append((after, after_hash))
+    return versions
+
+
+def checkout_and_move(history, session_id, current, current_hash, version):
+    image, image_hash, from_version = history.checkout(session_id, current, version, current_hash)
+    assert history.move(session_id, from_version, version)
+    return image, image_hash
+
+
+def test_undo_redo_round_trip_restores_exact_pixels():
+    history = EditHistory(max_bytes=0, max_versions=0)
+    versions = record_versions(history, "s", 3)
+    current, current_hash = versions[-1]
+
+    for version in (2, 1, 0, 3, 1, 2):
+        current, current_hash = checkout_and_move(history, "s", current, current_hash, version)
+        expected, expected_hash = versions[version]
+        assert current.tobytes() == expected.tobytes()
+        assert current_hash == expected_hash
+        assert history.version("s") == version
+
+
+def test_deltas_only_store_the_changed_region():
+    history = EditHistory(max_bytes=0, max_versions=0)
+    before = Image.new("RGB", (1024, 1024), "white")
+    after = edited(before, [10, 10, 19, 19], "red")
+    delta = history.diff(before, after, "a", "b")
+    assert delta.before.box == (10, 10, 20, 20)
+    assert delta.nbytes < 1024
+
+
+def test_new_edit_after_undo_drops_redo_records():
+    history = EditHistory(max_bytes=0, max_versions=0)
+    versions = record_versions(history, "s", 2)
+    current, current_hash = checkout_and_move(history, "s", *versions[-1], 1)
+    branch = edited(current, [0, 0, 5, 5], "black")
+    history.record("s", history.diff(current, branch, current_hash, "branch"))
+    state = history.describe("s")
+    assert (state["version"], state["latest_version"], state["can_redo"]) == (2, 2, False)
+
+
+def test_checkout_refuses_a_mismatched_current_image():
+    history = EditHistory(max_bytes=0, max_versions=0)
+    versions = record_versions(history, "s", 2)
+    assert history.checkout("s", versions[-1][0], 0, current_hash="edited-elsewhere") is None
+    assert history.checkout("s", versions[-1][0], 5, current_hash="h2") is None
+
+
+def test_max_versions_evicts_the_oldest_versions():
+    history = EditHistory(max_bytes=0, max_versions=2)
+    versions = record_versions(history, "s", 4)
+    state = history.describe("s")
+    assert (state["oldest_version"], state["version"]) == (2, 4)
+    assert history.checkout("s", versions[-1][0], 1, "h4") is None
+    image, _ = checkout_and_move(history, "s", versions[-1][0], "h4", 2)
+    assert image.tobytes() == versions[2][0].tobytes()
+
+
+def test_drop_releases_memory():
+    history = EditHistory(max_bytes=0, max_versions=0)
+    record_versions(history, "s", 2)
+    assert history.stats()["total_bytes"] > 0
+    history.drop("s")
+    assert history.stats()["total_bytes"] == 0
+    assert history.version("s") == 0
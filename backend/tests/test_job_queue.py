@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from services.job_queue import JobQueue, QueueFullError, SUCCEEDED, CANCELLED, SUPERSEDED, QUEUED
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_jobs_run_and_report_results():
+    async def scenario():
+        queue = JobQueue("test", workers=1, maxsize=4)
+
+        async def work():
+            return 42
+
+        job = queue.submit(work)
+        await queue.wait(job, 1)
+        await queue.close()
+        return job
+
+    job = run(scenario())
+    assert job.status == SUCCEEDED
+    assert job.result == 42
+
+
+def test_superseded_queued_job_frees_its_slot():
+    async def scenario():
+        queue = JobQueue("test", workers=1, maxsize=1)
+        gate = asyncio.Event()
+
+        async def blocked():
+            await gate.wait()
+
+        running = queue.submit(blocked, group="other")
+        await asyncio.sleep(0)
+        first = queue.submit(blocked, group="session")
+        # 同组的新任务取代排队中的旧任务，不因自己的旧任务被拒绝
+        second = queue.submit(blocked, group="session")
+        with pytest.raises(QueueFullError):
+            queue.submit(blocked, group="third")
+        depth = queue.stats()["depth"]
+        gate.set()
+        await queue.wait(second, 1)
+        await queue.close()
+        return running, first, second, depth
+
+    running, first, second, depth = run(scenario())
+    assert first.status == SUPERSEDED
+    assert second.status == SUCCEEDED
+    assert running.status == SUCCEEDED
+    assert depth == 1
+
+
+def test_cancelled_jobs_do_not_count_towards_depth():
+    async def scenario():
+        queue = JobQueue("test", workers=1, maxsize=1)
+        gate = asyncio.Event()
+
+        async def blocked():
+            await gate.wait()
+
+        queue.submit(blocked)
+        await asyncio.sleep(0)
+        queued = queue.submit(blocked)
+        assert queued.status == QUEUED
+        assert queue.cancel(queued.job_id)
+        replacement = queue.submit(blocked)
+        gate.set()
+        await queue.wait(replacement, 1)
+        stats = queue.stats()
+        await queue.close()
+        return queued, replacement, stats
+
+    queued, replacement, stats = run(scenario())
+    assert queued.status == CANCELLED
+    assert replacement.status == SUCCEEDED
+    assert stats["depth"] == 0
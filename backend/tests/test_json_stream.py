@@ -0,0 +1,40 @@
+import json
+import pytest
+from services.utils import JsonArrayStream
+
+ITEMS = [
+    {"label": "Buy [cheap] {now}", "query": "say \"hi\" \\ back"},
+    {"label": "Nested", "steps": [{"a": 1}, {"b": [2, 3]}]},
+    {"label": "Unicode 雨伞 ☂"},
+]
+TEXT = "```json\n" + json.dumps(ITEMS, ensure_ascii=False) + "\n```"
+
+
+def feed_in_chunks(text: str, size: int) -> list:
+    parser = JsonArrayStream()
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    return items
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, len(TEXT)])
+def test_objects_split_across_chunks(size):
+    assert feed_in_chunks(TEXT, size) == ITEMS
+
+
+def test_objects_are_returned_as_soon_as_they_close():
+    parser = JsonArrayStream()
+    assert parser.feed('[{"a": 1}, {"b"') == [{"a": 1}]
+    assert parser.feed(': 2}') == [{"b": 2}]
+    assert parser.feed(']') == []
+
+
+def test_invalid_objects_are_skipped():
+    assert feed_in_chunks('[{"a": 1}, {bad}, ["not", "a", "dict"], {"c": 3}]', 4) == [{"a": 1}, {"c": 3}]
+
+
+def test_content_after_the_array_is_ignored():
+    parser = JsonArrayStream()
+    assert parser.feed('[{"a": 1}] trailing {"b": 2}') == [{"a": 1}]
+    assert parser.feed('{"c": 3}') == []
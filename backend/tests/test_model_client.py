@@ -0,0 +1,230 @@
+import asyncio
+import pytest
+from services.backends import UsageMetadata
+from services.model_client import ModelClient
+from services.rate_limiter import RateLimiter
+from services.resilience import CircuitOpenError, DeadlineExceeded, Upstream, UpstreamUnavailable, bind_deadline
+from services.context_cache import ContextCache
+
+MODEL = "test-model"
+
+
+class _Cache:
+    def __init__(self, name: str, tokens: int):
+        self.name = name
+        self.usage_metadata = UsageMetadata(prompt_token_count=tokens)
+
+
+class CacheBackend:
+    """只实现 create_cache 的测试后端，按顺序抛出 errors 中的异常后成功"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def create_cache(self, model, system_instruction, contents, ttl_seconds):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return _Cache(f"cachedContents/{self.calls}", 100)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(Upstream, "backoff", staticmethod(lambda attempt: 0.0))
+
+
+def make_client(backend, rpm=0):
+    client = ModelClient(backend=backend)
+    if rpm:
+        client._limiters[MODEL] = RateLimiter(MODEL, rpm=rpm, workers=1)
+    return client
+
+
+def test_create_cache_retries_transient_errors():
+    backend = CacheBackend(errors=[ConnectionError("reset")])
+    client = make_client(backend)
+    assert asyncio.run(client.create_cache(MODEL, "system", ["image"], 60)) == "cachedContents/2"
+    assert client.upstream(MODEL).retries == 1
+
+
+def test_create_cache_takes_model_quota():
+    backend = CacheBackend()
+    client = make_client(backend, rpm=1)
+
+    async def scenario():
+        bind_deadline(0.2)
+        assert await client.create_cache(MODEL, "system", ["image"], 60) == "cachedContents/1"
+        # 配额已用完：第二次创建在截止时间内等不到配额，不会发出
+        with pytest.raises(UpstreamUnavailable):
+            await client.create_cache(MODEL, "system", ["image"], 60)
+
+    asyncio.run(scenario())
+    assert backend.calls == 1
+    assert client.rate_limiter(MODEL).granted["analysis"] == 1
+
+
+def test_context_cache_skips_once_when_upstream_is_unavailable():
+    backend = CacheBackend(errors=[ConnectionError("reset")] * 10)
+    client = make_client(backend)
+    client.upstream(MODEL).max_retries = 0
+    cache = ContextCache(client, enabled=True)
+
+    async def scenario():
+        first = await cache.get(MODEL, "infer", "image-hash", "system", "image")
+        backend.errors.clear()
+        second = await cache.get(MODEL, "infer", "image-hash", "system", "image")
+        return first, second
+
+    assert asyncio.run(scenario()) == (None, "cachedContents/2")
+    assert cache.stats()["failures"] == 0
+
+
+class _Response:
+    def __init__(self, tokens: int):
+        self.text = "ok"
+        self.usage_metadata = UsageMetadata(prompt_token_count=tokens)
+
+
+class GenerateBackend:
+    """按 delay 秒后返回固定用量的响应；errors 中的异常按顺序抛出"""
+
+    def __init__(self, delay: float = 0.0, tokens: int = 10, errors=()):
+        self.delay = delay
+        self.tokens = tokens
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return _Response(self.tokens)
+
+
+def make_limited_client(backend, rpm=0, tpm=0, **kwargs):
+    client = ModelClient(backend=backend, **kwargs)
+    client._limiters[MODEL] = RateLimiter(MODEL, rpm=rpm, tpm=tpm, workers=1)
+    return client
+
+
+def frozen_limiter(client):
+    """停止令牌补充，让桶中的余量只反映预扣与结算"""
+    limiter = client.rate_limiter(MODEL)
+    limiter.requests.rate = 0
+    limiter.tokens.rate = 0
+    return limiter
+
+
+def test_quota_wait_is_not_part_of_the_call_timeout():
+    backend = GenerateBackend()
+    client = make_limited_client(backend, rpm=600)
+    client.upstream(MODEL).timeout = 0.05
+    # 桶已空：下一个请求需要等待约 0.1 秒，超过单次调用超时
+    client.rate_limiter(MODEL).requests.level = 0
+
+    response = asyncio.run(client.generate_content(MODEL, ["prompt"]))
+    assert response.text == "ok"
+    assert backend.calls == 1
+    assert client.upstream(MODEL).retries == 0
+    assert client.upstream(MODEL).breaker.failures == 0
+
+
+def test_quota_wait_past_the_deadline_does_not_open_the_breaker():
+    backend = GenerateBackend()
+    client = make_limited_client(backend, rpm=1)
+    client.rate_limiter(MODEL).requests.level = 0
+    breaker = client.upstream(MODEL).breaker
+
+    async def call():
+        bind_deadline(0.02)
+        await client.generate_content(MODEL, ["prompt"])
+
+    for _ in range(breaker.failure_threshold + 1):
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(call())
+    assert backend.calls == 0
+    assert breaker.failures == 0
+    assert breaker.state == breaker.CLOSED
+
+
+def test_concurrency_wait_is_not_part_of_the_call_timeout():
+    backend = GenerateBackend(delay=0.04)
+    client = make_limited_client(backend, default_concurrency=1)
+    client.upstream(MODEL).timeout = 0.06
+
+    async def scenario():
+        return await asyncio.gather(*(client.generate_content(MODEL, ["prompt"]) for _ in range(3)))
+
+    assert len(asyncio.run(scenario())) == 3
+    assert backend.calls == 3
+    assert client.upstream(MODEL).retries == 0
+
+
+def test_quota_is_settled_by_actual_usage():
+    client = make_limited_client(GenerateBackend(tokens=10), rpm=100, tpm=60000)
+    limiter = frozen_limiter(client)
+    asyncio.run(client.generate_content(MODEL, ["prompt"]))
+    assert limiter.tokens.level == pytest.approx(60000 - 10, abs=0.01)
+    assert limiter.requests.level == pytest.approx(99, abs=0.01)
+
+
+def test_failed_call_returns_its_tokens():
+    client = make_limited_client(GenerateBackend(errors=[ValueError("bad request")]), rpm=100, tpm=60000)
+    limiter = frozen_limiter(client)
+    with pytest.raises(ValueError):
+        asyncio.run(client.generate_content(MODEL, ["prompt"]))
+    assert limiter.tokens.level == pytest.approx(60000, abs=0.01)
+    # 请求已经发出，请求数不归还
+    assert limiter.requests.level == pytest.approx(99, abs=0.01)
+
+
+def test_cancelled_and_timed_out_calls_return_their_tokens():
+    client = make_limited_client(GenerateBackend(delay=1.0), rpm=100, tpm=60000)
+    limiter = frozen_limiter(client)
+    client.upstream(MODEL).max_retries = 0
+
+    async def scenario():
+        task = asyncio.create_task(client.generate_content(MODEL, ["prompt"]))
+        await asyncio.sleep(0.02)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        client.upstream(MODEL).timeout = 0.02
+        with pytest.raises(UpstreamUnavailable):
+            await client.generate_content(MODEL, ["prompt"])
+
+    asyncio.run(scenario())
+    assert limiter.tokens.level == pytest.approx(60000, abs=0.01)
+    assert limiter.requests.level == pytest.approx(98, abs=0.01)
+
+
+def test_losing_hedge_returns_its_tokens():
+    class HedgeBackend(GenerateBackend):
+        async def generate_content(self, model, contents, config=None):
+            self.calls += 1
+            # 第一个请求很慢，对冲请求立即返回
+            await asyncio.sleep(1.0 if self.calls == 1 else 0.0)
+            return _Response(10)
+
+    client = make_limited_client(HedgeBackend(), rpm=100, tpm=60000)
+    limiter = frozen_limiter(client)
+    client.upstream(MODEL).hedge_delay = 0.02
+    asyncio.run(client.generate_content(MODEL, ["prompt"], hedge=True))
+    assert limiter.tokens.level == pytest.approx(60000 - 10, abs=0.01)
+    assert limiter.requests.level == pytest.approx(98, abs=0.01)
+
+
+def test_call_rejected_by_the_breaker_returns_its_request():
+    backend = GenerateBackend()
+    client = make_limited_client(backend, rpm=100, tpm=60000)
+    limiter = frozen_limiter(client)
+    breaker = client.upstream(MODEL).breaker
+    breaker.failures = breaker.failure_threshold
+    breaker._transition(breaker.OPEN)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(client.generate_content(MODEL, ["prompt"]))
+    assert backend.calls == 0
+    assert limiter.requests.level == pytest.approx(100, abs=0.01)
+    assert limiter.tokens.level == pytest.approx(60000, abs=0.01)
@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+from services.rate_limiter import (
+    RateLimiter, RateLimitExceeded, bind_priority, current_priority, fork_priority,
+    INTERACTIVE, ANALYSIS, EDIT, PREFETCH,
+)
+
+NO_RESERVE = {}
+
+
+def empty_limiter(**kwargs):
+    """每秒补充 1 个请求、当前没有余量的限流器；测试通过 release 逐个放行"""
+    kwargs.setdefault("reserve", NO_RESERVE)
+    limiter = RateLimiter("test", rpm=60, workers=1, **kwargs)
+    limiter.requests.level = 0
+    return limiter
+
+
+def release(limiter, requests=1):
+    limiter.settle(0, 0, requests=requests)
+
+
+async def queue(limiter, order, priority):
+    """以 priority 排队，拿到配额后记录到 order"""
+    task = asyncio.create_task(acquire(limiter, order, priority))
+    await asyncio.sleep(0)
+    return task
+
+
+async def acquire(limiter, order, priority, tokens=0):
+    await limiter.acquire(tokens, priority)
+    order.append(priority)
+
+
+def test_queued_calls_are_granted_by_priority():
+    async def scenario():
+        limiter = empty_limiter()
+        order = []
+        tasks = [await queue(limiter, order, priority) for priority in (PREFETCH, EDIT, INTERACTIVE, ANALYSIS)]
+        for _ in tasks:
+            release(limiter)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return limiter, order
+
+    limiter, order = asyncio.run(scenario())
+    assert order == [INTERACTIVE, ANALYSIS, EDIT, PREFETCH]
+    assert limiter.stats()["queued"] == 0
+    assert limiter.granted == {INTERACTIVE: 1, ANALYSIS: 1, EDIT: 1, PREFETCH: 1}
+
+
+def test_low_priority_calls_leave_the_reserve():
+    async def scenario():
+        limiter = RateLimiter("test", rpm=60, workers=1, reserve={PREFETCH: 0.5})
+        limiter.requests.level = 20
+        await limiter.acquire(0, INTERACTIVE)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(limiter.acquire(0, PREFETCH), 0.05)
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert limiter.granted[INTERACTIVE] == 1
+    assert limiter.granted[PREFETCH] == 0
+    assert limiter.stats()["queued"] == 0
+
+
+def test_full_queue_sheds_the_lowest_priority_call():
+    async def scenario():
+        limiter = empty_limiter(max_queue=2)
+        order = []
+        first = await queue(limiter, order, PREFETCH)
+        second = await queue(limiter, order, PREFETCH)
+        # 新请求优先级不高于排队中最低的请求：直接拒绝
+        with pytest.raises(RateLimitExceeded):
+            await limiter.acquire(0, PREFETCH)
+        # 更高优先级的请求挤出最新的 prefetch
+        interactive = await queue(limiter, order, INTERACTIVE)
+        with pytest.raises(RateLimitExceeded):
+            await second
+        release(limiter, 2)
+        await asyncio.gather(first, interactive)
+        return limiter, order
+
+    limiter, order = asyncio.run(scenario())
+    assert order == [INTERACTIVE, PREFETCH]
+    assert limiter.shed == {INTERACTIVE: 0, ANALYSIS: 0, EDIT: 0, PREFETCH: 2}
+
+
+def test_promoted_call_moves_ahead_in_the_queue():
+    async def scenario():
+        limiter = empty_limiter()
+        order = []
+        call = None
+
+        async def background():
+            nonlocal call
+            call = bind_priority(PREFETCH)
+            await limiter.acquire(0)
+            order.append("background")
+
+        prefetch = asyncio.create_task(background())
+        await asyncio.sleep(0)
+        edit = await queue(limiter, order, EDIT)
+        call.promote(INTERACTIVE)
+        release(limiter)
+        await asyncio.sleep(0)
+        release(limiter)
+        await asyncio.gather(prefetch, edit)
+        return limiter, order
+
+    limiter, order = asyncio.run(scenario())
+    assert order == ["background", EDIT]
+    assert limiter.granted[INTERACTIVE] == 1
+    assert limiter.granted[PREFETCH] == 0
+
+
+def test_promotion_reaches_forked_calls_but_never_lowers():
+    async def scenario():
+        parent = bind_priority(PREFETCH)
+        child = fork_priority()
+        assert current_priority() == PREFETCH
+        parent.promote(ANALYSIS)
+        assert child.value == ANALYSIS
+        child.promote(INTERACTIVE)
+        assert parent.value == ANALYSIS
+        child.promote(EDIT)
+        return child.value
+
+    value = asyncio.run(scenario())
+    assert value == INTERACTIVE
+
+
+def test_unknown_priority_is_rejected():
+    with pytest.raises(ValueError):
+        bind_priority("urgent")
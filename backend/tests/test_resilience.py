@@ -0,0 +1,178 @@
+import asyncio
+import pytest
+from services.resilience import (
+    CircuitBreaker, CircuitOpenError, DeadlineExceeded, Upstream, UpstreamUnavailable, bind_deadline, is_transient,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(Upstream, "backoff", staticmethod(lambda attempt: 0.0))
+
+
+class Flaky:
+    """按顺序执行 outcomes：异常实例抛出，数字表示先等待的秒数再返回，其余值直接返回"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        if isinstance(outcome, BaseException):
+            raise outcome
+        if isinstance(outcome, float):
+            await asyncio.sleep(outcome)
+            return "slow"
+        return outcome
+
+
+def make_upstream(**kwargs):
+    breaker = CircuitBreaker("test", failure_threshold=kwargs.pop("threshold", 3), reset_seconds=kwargs.pop("reset", 60))
+    return Upstream("test", breaker=breaker, **kwargs)
+
+
+def test_transient_errors_are_retried():
+    upstream = make_upstream(max_retries=2)
+    fn = Flaky(ConnectionError("reset"), TimeoutError(), "done")
+    assert asyncio.run(upstream.call(fn)) == "done"
+    assert fn.calls == 3
+    assert upstream.retries == 2
+    assert upstream.breaker.failures == 0
+
+
+def test_timeouts_count_as_failures_and_exhaust_retries():
+    upstream = make_upstream(timeout=0.05, max_retries=1)
+    fn = Flaky(1.0, 1.0)
+    with pytest.raises(UpstreamUnavailable) as error:
+        asyncio.run(upstream.call(fn))
+    assert not isinstance(error.value, CircuitOpenError)
+    assert fn.calls == 2
+    assert upstream.breaker.failures == 2
+
+
+def test_non_transient_errors_are_not_retried_or_counted():
+    upstream = make_upstream(max_retries=3)
+    upstream.breaker.failures = 2
+    fn = Flaky(ValueError("bad request"))
+    with pytest.raises(ValueError):
+        asyncio.run(upstream.call(fn))
+    assert fn.calls == 1
+    assert upstream.breaker.failures == 0
+
+
+def test_breaker_opens_then_recovers_through_a_probe(monkeypatch):
+    upstream = make_upstream(max_retries=0, threshold=2, reset=0.05)
+    for _ in range(2):
+        with pytest.raises(UpstreamUnavailable):
+            asyncio.run(upstream.call(Flaky(ConnectionError())))
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+
+    fn = Flaky("ok")
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(upstream.call(fn))
+    assert fn.calls == 0
+
+    asyncio.run(asyncio.sleep(0.06))
+    assert asyncio.run(upstream.call(fn)) == "ok"
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_the_breaker():
+    upstream = make_upstream(max_retries=0, threshold=1, reset=0.0)
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(upstream.call(Flaky(ConnectionError())))
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(upstream.call(Flaky(ConnectionError())))
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+    assert upstream.breaker.opened == 2
+
+
+def test_cancelled_probe_returns_the_half_open_slot():
+    upstream = make_upstream(max_retries=0, threshold=1, reset=0.0)
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(upstream.call(Flaky(ConnectionError())))
+
+    async def scenario():
+        probe = asyncio.create_task(upstream.call(Flaky(1.0)))
+        await asyncio.sleep(0.01)
+        assert upstream.breaker.state == CircuitBreaker.HALF_OPEN
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return await upstream.call(Flaky("ok"))
+
+    assert asyncio.run(scenario()) == "ok"
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_exhausted_deadline_fails_without_counting():
+    upstream = make_upstream(timeout=10, max_retries=3)
+
+    async def scenario():
+        bind_deadline(0.05)
+        await upstream.call(Flaky(1.0))
+
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(scenario())
+    # 截止时间耗尽后不再重试
+    assert upstream.retries <= 1
+
+    async def expired():
+        bind_deadline(0.01)
+        await asyncio.sleep(0.02)
+        await upstream.call(Flaky("ok"))
+
+    failures = upstream.breaker.failures
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(expired())
+    assert upstream.breaker.failures == failures
+
+
+def test_hedge_returns_the_first_result():
+    upstream = make_upstream(hedge_delay=0.02)
+    fn = Flaky(1.0, "fast")
+    assert asyncio.run(upstream.call(fn, hedge=True)) == "fast"
+    assert (upstream.hedges, upstream.hedge_wins) == (1, 1)
+
+
+def test_stream_retries_only_before_the_first_item():
+    upstream = make_upstream(max_retries=2)
+    attempts = []
+
+    def stream():
+        attempt = len(attempts)
+        attempts.append(attempt)
+
+        async def items():
+            if attempt == 0:
+                raise ConnectionError()
+            yield "a"
+            if attempt == 1:
+                raise ConnectionError()
+            yield "b"
+
+        return items()
+
+    async def collect():
+        received = []
+        async for item in upstream.stream(stream):
+            received.append(item)
+        return received
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(collect())
+    assert attempts == [0, 1]
+    assert upstream.breaker.failures == 2
+
+
+def test_transient_classification():
+    class StatusError(Exception):
+        def __init__(self, code):
+            self.code = code
+
+    assert is_transient(StatusError(503))
+    assert is_transient(StatusError(429))
+    assert not is_transient(StatusError(400))
+    assert not is_transient(UpstreamUnavailable("x", "down"))
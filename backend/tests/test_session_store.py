@@ -0,0 +1,151 @@
+import time
+import asyncio
+import threading
+import pytest
+from PIL import Image
+from schemas import DetectedObject
+from services.session_store import SessionStore, MemorySessionStore, SQLiteSessionStore, image_nbytes
+
+
+def make_image(width=8, height=8, color=(255, 0, 0)):
+    return Image.new("RGB", (width, height), color)
+
+
+OBJECTS = [DetectedObject(id=1, label="cup", box_2d=[0, 0, 4, 4], center=(2, 2))]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+    class Partial(SessionStore):
+        def create(self, image, objects, image_hash=None):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+@pytest.mark.parametrize("encoding", ["raw", "png"])
+def test_sqlite_round_trip(db_path, encoding):
+    store = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0, max_sessions=0, image_encoding=encoding)
+    image = make_image(color=(1, 2, 3))
+    session = store.create(image, OBJECTS, image_hash="hash-1")
+
+    loaded = store.get(session.session_id)
+    assert loaded.image.tobytes() == image.tobytes()
+    assert loaded.objects == OBJECTS
+    assert loaded.image_hash == "hash-1"
+    assert store.get_objects(session.session_id) == (OBJECTS, "hash-1")
+
+    updated = store.update_image(session.session_id, make_image(color=(9, 9, 9)), image_hash="hash-2")
+    assert updated.image_hash == "hash-2"
+    assert store.get(session.session_id).image.getpixel((0, 0)) == (9, 9, 9)
+    assert store.get("missing") is None
+    assert store.update_image("missing", image) is None
+
+
+def test_sqlite_evicts_least_recently_used_and_notifies(db_path):
+    size = image_nbytes(make_image())
+    store = SQLiteSessionStore(db_path, max_bytes=size * 2, ttl_seconds=0, max_sessions=0)
+    evicted = []
+    store.add_eviction_listener(evicted.append)
+
+    first = store.create(make_image(), OBJECTS)
+    second = store.create(make_image(), OBJECTS)
+    # 访问第一个会话后，第二个会话成为最久未使用的
+    time.sleep(0.01)
+    store.get_objects(first.session_id)
+    third = store.create(make_image(), OBJECTS)
+
+    assert evicted == [second.session_id]
+    assert store.get(second.session_id) is None
+    assert store.get(first.session_id) is not None
+    assert store.get(third.session_id) is not None
+    stats = store.stats()
+    assert stats["sessions"] == 2
+    assert stats["total_bytes"] == size * 2
+    assert stats["evictions"] == 1
+
+
+def test_sqlite_totals_follow_updates_and_deletes(db_path):
+    store = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0, max_sessions=0)
+    session = store.create(make_image(8, 8), OBJECTS)
+    store.update_image(session.session_id, make_image(16, 8))
+    assert store.stats()["total_bytes"] == image_nbytes(make_image(16, 8))
+    assert store.delete(session.session_id)
+    assert not store.delete(session.session_id)
+    assert store.stats()["sessions"] == 0
+    assert store.stats()["total_bytes"] == 0
+
+
+def test_sqlite_expired_session_is_dropped(db_path):
+    store = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0.05, max_sessions=0)
+    evicted = []
+    store.add_eviction_listener(evicted.append)
+    session = store.create(make_image(), OBJECTS)
+    time.sleep(0.1)
+    assert store.get_objects(session.session_id) is None
+    assert evicted == [session.session_id]
+
+
+def test_sqlite_notifies_sessions_evicted_by_another_worker(db_path):
+    worker_a = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0, max_sessions=1, sync_interval=0)
+    worker_b = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0, max_sessions=1, sync_interval=0)
+    evicted = []
+    worker_a.add_eviction_listener(evicted.append)
+
+    session = worker_a.create(make_image(), OBJECTS)
+    # 另一个 worker 创建会话时淘汰了 worker_a 的会话
+    worker_b.create(make_image(), OBJECTS)
+    assert evicted == []
+    worker_a.stats()
+    worker_a.get_objects("unrelated")
+    assert evicted == [session.session_id]
+
+
+def test_memory_store_evicts_by_count():
+    store = MemorySessionStore(max_bytes=0, ttl_seconds=0, max_sessions=1)
+    evicted = []
+    store.add_eviction_listener(evicted.append)
+    first = store.create(make_image(), OBJECTS)
+    second = store.create(make_image(), OBJECTS)
+    assert evicted == [first.session_id]
+    assert store.get(second.session_id).objects == OBJECTS
+
+
+def test_evictions_in_threadpool_are_delivered_on_the_loop(db_path):
+    store = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0, max_sessions=1)
+    calls = []
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        store.bind_loop(loop)
+        store.add_eviction_listener(lambda session_id: calls.append((session_id, threading.get_ident())))
+        first = await asyncio.to_thread(store.create, make_image(), OBJECTS)
+        await asyncio.to_thread(store.create, make_image(), OBJECTS)
+        await asyncio.sleep(0)
+        return first.session_id
+
+    loop_thread = threading.get_ident()
+    first_id = asyncio.run(scenario())
+    assert calls == [(first_id, loop_thread)]
+
+
+def test_evictions_on_the_loop_thread_are_delivered_immediately(db_path):
+    store = SQLiteSessionStore(db_path, max_bytes=0, ttl_seconds=0, max_sessions=1)
+    evicted = []
+    store.add_eviction_listener(evicted.append)
+
+    async def scenario():
+        store.bind_loop(asyncio.get_running_loop())
+        first = store.create(make_image(), OBJECTS)
+        store.create(make_image(), OBJECTS)
+        assert evicted == [first.session_id]
+
+    asyncio.run(scenario())
@@ -0,0 +1,143 @@
+import asyncio
+from PIL import Image
+from schemas import DetectedObject
+from services.intent_cache import IntentCache, intent_cache_key
+from services.prefetch import IntentPrefetcher
+from services.rate_limiter import RateLimiter, bind_priority, INTERACTIVE, EDIT, PREFETCH
+from services.singleflight import SingleFlight
+
+
+def empty_limiter():
+    limiter = RateLimiter("test", rpm=60, workers=1, reserve={})
+    limiter.requests.level = 0
+    return limiter
+
+
+def test_concurrent_calls_share_one_result():
+    async def scenario():
+        flights = SingleFlight("test")
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return object()
+
+        results = await asyncio.gather(*(flights.do("key", fetch) for _ in range(3)))
+        return flights, calls, results
+
+    flights, calls, results = asyncio.run(scenario())
+    assert calls == 1
+    assert results[0] is results[1] is results[2]
+    assert flights.stats() == {"in_flight": 0, "calls": 1, "coalesced": 2, "cancelled": 0}
+
+
+def test_shared_call_is_cancelled_when_every_caller_leaves():
+    async def scenario():
+        flights = SingleFlight("test")
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(flights.do("key", fetch)) for _ in range(2)]
+        await started.wait()
+        callers[0].cancel()
+        await asyncio.sleep(0)
+        assert not cancelled.is_set()
+        callers[1].cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flights
+
+    flights = asyncio.run(scenario())
+    assert flights.cancelled == 1
+    assert flights.in_flight() == 0
+
+
+def test_joining_caller_promotes_the_shared_call():
+    async def scenario():
+        flights = SingleFlight("test")
+        limiter = empty_limiter()
+        order = []
+
+        async def fetch():
+            await limiter.acquire(0)
+            order.append("shared")
+            return "done"
+
+        async def caller(priority):
+            bind_priority(priority)
+            return await flights.do("key", fetch)
+
+        async def edit():
+            bind_priority(EDIT)
+            await limiter.acquire(0)
+            order.append(EDIT)
+
+        prefetch = asyncio.create_task(caller(PREFETCH))
+        await asyncio.sleep(0)
+        other = asyncio.create_task(edit())
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(caller(INTERACTIVE))
+        await asyncio.sleep(0)
+        limiter.settle(0, 0, requests=1)
+        await asyncio.sleep(0)
+        limiter.settle(0, 0, requests=1)
+        results = await asyncio.gather(prefetch, interactive, other)
+        return limiter, order, results
+
+    limiter, order, results = asyncio.run(scenario())
+    assert order == ["shared", EDIT]
+    assert results[:2] == ["done", "done"]
+    assert limiter.granted[INTERACTIVE] == 1
+
+
+def test_joined_prefetch_runs_at_the_callers_priority():
+    async def scenario():
+        limiter = empty_limiter()
+        flights = SingleFlight("ai")
+        order = []
+
+        async def infer(image, label, nearby_labels, image_key=None):
+            # 与 AIService 一样经过 single-flight，提升需要传递到共享调用
+            async def call():
+                await limiter.acquire(0)
+                order.append(PREFETCH)
+                return []
+            return await flights.do(("infer", label), call)
+
+        prefetcher = IntentPrefetcher(infer, IntentCache(), lambda objects, obj: [], top_k=1)
+        obj = DetectedObject(id=1, label="cup", box_2d=[0, 0, 10, 10], center=(5, 5))
+        prefetcher.schedule("session", Image.new("RGB", (10, 10)), [obj], "hash")
+        await asyncio.sleep(0)
+
+        async def edit():
+            bind_priority(EDIT)
+            await limiter.acquire(0)
+            order.append(EDIT)
+
+        async def click():
+            bind_priority(INTERACTIVE)
+            return await prefetcher.join(intent_cache_key("cup", [], "hash"))
+
+        other = asyncio.create_task(edit())
+        await asyncio.sleep(0)
+        joined = asyncio.create_task(click())
+        await asyncio.sleep(0)
+        limiter.settle(0, 0, requests=1)
+        await asyncio.sleep(0)
+        limiter.settle(0, 0, requests=1)
+        intents, _ = await asyncio.gather(joined, other)
+        return prefetcher, order, intents
+
+    prefetcher, order, intents = asyncio.run(scenario())
+    assert order == [PREFETCH, EDIT]
+    assert intents == []
+    assert prefetcher.joined == 1
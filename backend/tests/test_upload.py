@@ -0,0 +1,94 @@
+import io
+import asyncio
+import pytest
+from fastapi import FastAPI, File, UploadFile, Request
+from fastapi.testclient import TestClient
+from PIL import Image
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from services.upload import UploadSizeLimitMiddleware, UploadError, hash_upload, decode_image
+
+LIMIT = 128 * 1024
+# 中间件为 multipart 边界预留的余量
+MARGIN = 64 * 1024
+
+
+def make_app():
+    app = FastAPI()
+    app.add_middleware(UploadSizeLimitMiddleware, max_bytes=LIMIT)
+
+    @app.post("/form")
+    async def form(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    @app.post("/raw")
+    async def raw(request: Request):
+        return {"size": len(await request.body())}
+
+    return app
+
+
+def chunks(total: int, size: int = 16 * 1024):
+    sent = 0
+    while sent < total:
+        yield b"x" * min(size, total - sent)
+        sent += size
+
+
+def multipart_chunks(payload_size: int):
+    boundary = b"testboundary"
+    yield b"--" + boundary + b'\r\nContent-Disposition: form-data; name="file"; filename="a.bin"\r\n\r\n'
+    yield from chunks(payload_size)
+    yield b"\r\n--" + boundary + b"--\r\n"
+
+
+@pytest.fixture
+def client():
+    return TestClient(make_app())
+
+
+def test_declared_content_length_over_the_limit_is_rejected(client):
+    response = client.post("/raw", content=b"x" * (LIMIT + MARGIN + 1))
+    assert response.status_code == 413
+
+
+def test_chunked_body_within_the_limit_is_accepted(client):
+    response = client.post("/raw", content=chunks(LIMIT))
+    assert response.status_code == 200
+    assert response.json() == {"size": LIMIT}
+
+
+def test_chunked_body_over_the_limit_is_rejected(client):
+    response = client.post("/raw", content=chunks(LIMIT + MARGIN + 1))
+    assert response.status_code == 413
+
+
+def test_chunked_multipart_over_the_limit_is_rejected(client):
+    headers = {"Content-Type": "multipart/form-data; boundary=testboundary"}
+    response = client.post("/form", content=multipart_chunks(LIMIT + MARGIN + 1), headers=headers)
+    assert response.status_code == 413
+    response = client.post("/form", content=multipart_chunks(LIMIT), headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"size": LIMIT}
+
+
+def test_hash_upload_enforces_the_byte_limit():
+    upload = StarletteUploadFile(io.BytesIO(b"x" * 100), filename="a.bin")
+    with pytest.raises(UploadError) as error:
+        asyncio.run(hash_upload(upload, max_bytes=99))
+    assert error.value.status_code == 413
+
+    upload = StarletteUploadFile(io.BytesIO(b""), filename="a.bin")
+    with pytest.raises(UploadError) as error:
+        asyncio.run(hash_upload(upload))
+    assert error.value.status_code == 400
+
+
+def test_decode_image_rejects_oversized_images():
+    buffered = io.BytesIO()
+    Image.new("RGB", (100, 100)).save(buffered, format="PNG")
+    buffered.seek(0)
+    with pytest.raises(UploadError) as error:
+        decode_image(buffered, max_pixels=100 * 99)
+    assert error.value.status_code == 413
+    buffered.seek(0)
+    assert decode_image(buffered, max_edge=50).size == (50, 50)
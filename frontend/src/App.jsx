@@ -2,7 +2,7 @@ import { useState, useRef } from 'react';
 import axios from 'axios';
 import FingerprintCursor from './components/FingerprintCursor';
 import RippleMenu from './components/RippleMenu';
-import { Scan, Upload, Loader2 } from 'lucide-react';
+import { Scan, Upload, Loader2, Undo2, Redo2 } from 'lucide-react';
 import visibleIcon from './assets/visable.png';
 import invisibleIcon from './assets/invisable.png';
 
@@ -15,9 +15,35 @@ const getApiUrl = () => {
 
 const API_URL = getApiUrl();
 
+// 读取 /infer/stream 返回的 Server-Sent Events，逐个回调 (event, data)
+const streamIntents = async (formData, onEvent) => {
+  const res = await fetch(`${API_URL}/infer/stream`, { method: 'POST', body: formData });
+  if (!res.ok || !res.body) {
+    throw new Error(`Stream request failed: ${res.status}`);
+  }
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      const event = block.match(/^event: (.*)$/m)?.[1];
+      const data = block.match(/^data: (.*)$/m)?.[1];
+      if (event && data) onEvent(event, JSON.parse(data));
+    }
+  }
+};
+
 function App() {
   const [image, setImage] = useState(null);
   const [objects, setObjects] = useState([]); // 缓存的物体框 (Pre-indexing)
+  const [sessionId, setSessionId] = useState(null); // 后端会话 ID（/analyze 返回）
+  const [imageSize, setImageSize] = useState(null); // 后端解码后的图片尺寸（物体坐标所在的坐标系，UPLOAD_MAX_EDGE 时小于原图）
   const [menuState, setMenuState] = useState({ isOpen: false, x: 0, y: 0 });
   const [intents, setIntents] = useState([]);
   const [isLoading, setIsLoading] = useState(false);
@@ -26,6 +52,7 @@ function App() {
   const [clickAbsPosition, setClickAbsPosition] = useState(null); // 新增状态来存储点击的绝对屏幕坐标
   const [showBoundingBoxes, setShowBoundingBoxes] = useState(true); // 控制 bounding box 的显示/隐藏
   const [enableImageEdit, setEnableImageEdit] = useState(true); // 控制是否启用图像编辑
+  const [history, setHistory] = useState({ can_undo: false, can_redo: false }); // 编辑历史状态
   
   const imageRef = useRef(null);
 
@@ -36,6 +63,7 @@ function App() {
 
     const imgUrl = URL.createObjectURL(file);
     setImage(imgUrl);
+    setImageSize(null);
     setStatus("Analyzing scene...");
     setIsLoading(true);
 
@@ -46,6 +74,9 @@ function App() {
       // 调用后端 Level 2 便宜模型进行全图扫描
       const res = await axios.post(`${API_URL}/analyze`, formData);
       setObjects(res.data.objects);
+      setImageSize({ width: res.data.image_width, height: res.data.image_height });
+      setSessionId(res.data.session_id);
+      setHistory({ can_undo: false, can_redo: false });
       setStatus("Ready to interact. Click any object.");
     } catch (err) {
       console.error(err);
@@ -70,8 +101,8 @@ function App() {
     const y = e.clientY - rect.top;
     
     // 映射回图片的真实像素坐标 (因为图片可能被缩放显示)
-    const scaleX = imageRef.current.naturalWidth / rect.width;
-    const scaleY = imageRef.current.naturalHeight / rect.height;
+    const scaleX = (imageSize?.width || imageRef.current.naturalWidth) / rect.width;
+    const scaleY = (imageSize?.height || imageRef.current.naturalHeight) / rect.height;
     const realX = x * scaleX;
     const realY = y * scaleY;
 
@@ -97,13 +128,25 @@ function App() {
     setMenuState(prev => ({ ...prev, isOpen: true }));
 
     const formData = new FormData();
+    formData.append('session_id', sessionId);
     formData.append('clicked_label', clickedObject.label);
     formData.append('click_x', Math.floor(realX));
     formData.append('click_y', Math.floor(realY));
 
     try {
-      const res = await axios.post(`${API_URL}/infer`, formData);
-      setIntents(res.data.intents);
+      // 流式接收意图：第一个意图生成后立即显示，done 事件给出最终校验后的列表
+      const streamed = [];
+      await streamIntents(formData, (event, data) => {
+        if (event === 'intent') {
+          streamed.push(data);
+          setIntents([...streamed]);
+          setIsLoading(false);
+        } else if (event === 'done') {
+          setIntents(data.intents);
+        } else if (event === 'error') {
+          throw new Error(data.detail);
+        }
+      });
       setStatus(`Suggestions ready for ${clickedObject.label}`);
     } catch (err) {
       console.error(err);
@@ -113,6 +156,19 @@ function App() {
     }
   };
 
+  // 撤销 / 重做编辑（后端按差量重建，不调用模型）
+  const handleHistory = async (action) => {
+    try {
+      const res = await axios.post(`${API_URL}/history/${sessionId}/${action}`);
+      setImage(new URL(res.data.image_url, API_URL).href);
+      setHistory(res.data);
+      setStatus(`${action === 'undo' ? 'Undo' : 'Redo'}: version ${res.data.version}`);
+    } catch (err) {
+      console.error(err);
+      setStatus(`Nothing to ${action}.`);
+    }
+  };
+
   // 3. 处理意图执行 (Execution) - 支持多种操作类型
   const handleIntentSelect = async (intent) => {
     setMenuState({ ...menuState, isOpen: false });
@@ -136,6 +192,7 @@ function App() {
     const formData = new FormData();
     formData.append('intent_id', intent.id);
     formData.append('action_type', actionType);
+    formData.append('session_id', sessionId);
     
     // 根据操作类型添加不同的数据
     if (actionType === 'edit') {
@@ -149,13 +206,23 @@ function App() {
     }
 
     try {
-      const res = await axios.post(`${API_URL}/execute`, formData);
+      let res = await axios.post(`${API_URL}/execute`, formData);
       
       // 根据操作类型处理响应
       if (actionType === 'edit') {
+        // 图像编辑在后端队列中执行：长轮询结果直到完成（202 表示仍在排队/执行）
+        while (res.data.job_id && res.data.status !== 'success') {
+          const jobId = res.data.job_id;
+          res = await axios.get(`${API_URL}/jobs/${jobId}/result`, { params: { wait: 25 } });
+          if (res.status === 202) {
+            setStatus(`Editing: ${intent.label} (${res.data.status})...`);
+          }
+        }
         // 图像编辑：更新图片
-        if (res.data.image_base64) {
-          setImage(`data:image/png;base64,${res.data.image_base64}`);
+        if (res.data.image_url) {
+          // 后端返回内容寻址的图片地址（相对 API 所在的域名）
+          setImage(new URL(res.data.image_url, API_URL).href);
+          setHistory({ can_undo: res.data.version > 0, can_redo: false });
         }
         setStatus(enableImageEdit ? "Image edited successfully." : "Preview mode (editing disabled).");
       } else if (actionType === 'info') {
@@ -193,6 +260,11 @@ function App() {
       }
     } catch (err) {
       console.error(err);
+      if (err.response?.status === 410) {
+        // 编辑被更新的请求取代或被取消
+        setStatus("Edit superseded.");
+        return;
+      }
       setStatus(`Error executing ${actionType} action.`);
     } finally {
       setIsLoading(false);
@@ -224,6 +296,28 @@ function App() {
             </button>
           )}
           
+          {/* 撤销 / 重做 */}
+          {sessionId && (
+            <div className="flex gap-1">
+              <button
+                onClick={() => handleHistory('undo')}
+                disabled={!history.can_undo}
+                className="flex items-center justify-center bg-white/10 hover:bg-white/20 disabled:opacity-30 px-3 py-2 rounded-full transition"
+                title="Undo edit"
+              >
+                <Undo2 size={16} />
+              </button>
+              <button
+                onClick={() => handleHistory('redo')}
+                disabled={!history.can_redo}
+                className="flex items-center justify-center bg-white/10 hover:bg-white/20 disabled:opacity-30 px-3 py-2 rounded-full transition"
+                title="Redo edit"
+              >
+                <Redo2 size={16} />
+              </button>
+            </div>
+          )}
+          
           {/* 图像编辑开关按钮 */}
           <button
             onClick={() => setEnableImageEdit(!enableImageEdit)}
@@ -286,8 +380,8 @@ function App() {
             {/* 可视化 Bounding Box - 蓝色科幻细线 */}
             {showBoundingBoxes && objects.length > 0 && imageRef.current && (() => {
               const rect = imageRef.current.getBoundingClientRect();
-              const scaleX = rect.width / imageRef.current.naturalWidth;
-              const scaleY = rect.height / imageRef.current.naturalHeight;
+              const scaleX = rect.width / (imageSize?.width || imageRef.current.naturalWidth);
+              const scaleY = rect.height / (imageSize?.height || imageRef.current.naturalHeight);
               
               return (
                 <svg